@@ -0,0 +1,216 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+from PIL import Image
+
+log = logging.getLogger("red.aikaterna.leveler.cache")
+
+
+def content_key(*parts) -> str:
+    """Stable hash of everything that affects a rendered picture."""
+    material = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+class RenderCache:
+    """LRU cache of rendered card PNG bytes, keyed by `content_key`.
+
+    An optional on-disk tier keeps renders across restarts; it is written
+    and read in the default executor so the event loop never waits on disk.
+    """
+
+    def __init__(self, max_items: int = 256, max_files: int = 5000):
+        self.max_items = max_items
+        self.max_files = max_files
+        self.path: Optional[Path] = None
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._writes_since_prune = 0
+
+    def set_disk_path(self, path: Optional[Path]):
+        if path is not None:
+            path.mkdir(parents=True, exist_ok=True)
+        self.path = path
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self._memory.get(key)
+        if data is None and self.path is not None:
+            data = await asyncio.get_running_loop().run_in_executor(None, self._read_file, key)
+            if data is not None:
+                self._remember(key, data)
+        if data is None:
+            self.misses += 1
+            return None
+        self._memory.move_to_end(key)
+        self.hits += 1
+        return data
+
+    async def put(self, key: str, data: bytes):
+        self._remember(key, data)
+        if self.path is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_file, key, data)
+
+    def clear(self):
+        self._memory.clear()
+
+    def _remember(self, key: str, data: bytes):
+        self._memory[key] = data
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _read_file(self, key: str) -> Optional[bytes]:
+        try:
+            return (self.path / f"{key}.png").read_bytes()
+        except OSError:
+            return None
+
+    def _write_file(self, key: str, data: bytes):
+        try:
+            (self.path / f"{key}.png").write_bytes(data)
+        except OSError as exc:
+            log.warning("Could not write a render to the disk cache", exc_info=exc)
+            return
+        self._writes_since_prune += 1
+        if self._writes_since_prune >= 100:
+            self._writes_since_prune = 0
+            self._prune_files()
+
+    def _prune_files(self):
+        files = sorted(self.path.glob("*.png"), key=lambda f: f.stat().st_mtime)
+        for stale in files[: max(len(files) - self.max_files, 0)]:
+            with contextlib.suppress(OSError):
+                os.remove(stale)
+
+
+
+class _Asset:
+    __slots__ = ("data", "etag", "last_modified", "fetched_at", "variants", "cost")
+
+    def __init__(self, data: bytes, etag: Optional[str], last_modified: Optional[str]):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+        self.variants: Dict[Optional[Tuple[int, int]], Image.Image] = {}
+        self.cost = 0
+
+
+class ImageAssetCache:
+    """Downloaded images keyed by URL, kept decoded as RGBA at the sizes they are drawn at.
+
+    The source bytes are kept once per URL and each requested size is decoded
+    and resized on first use. Entries older than `ttl` seconds are revalidated
+    with the ETag / Last-Modified the server sent, and the least recently used
+    URLs are dropped once the cache holds more than `max_bytes`.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, max_bytes: int = 64 * 1024 * 1024, ttl: int = 3600):
+        self.session = session
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.size = 0
+        self._assets: "OrderedDict[str, _Asset]" = OrderedDict()
+        self._fetching: Dict[str, asyncio.Task] = {}
+
+    async def get(self, url: str, size: Optional[Tuple[int, int]] = None) -> Image.Image:
+        """Return the image at `url` as RGBA, resized to `size` if one is given.
+
+        The returned image is a copy and can be changed freely.
+        Raises `aiohttp.ClientError` or `OSError` if it cannot be fetched or decoded.
+        """
+        asset = self._assets.get(url)
+        if asset is None or time.monotonic() - asset.fetched_at > self.ttl:
+            asset = await self._fetch(url)
+        else:
+            self._assets.move_to_end(url)
+        image = asset.variants.get(size)
+        if image is None:
+            self.misses += 1
+            image = await asyncio.get_running_loop().run_in_executor(None, self._decode, asset.data, size)
+            # it may have been evicted or replaced while decoding
+            if self._assets.get(url) is asset:
+                asset.variants[size] = image
+                self._account(url, image.width * image.height * 4)
+        else:
+            self.hits += 1
+        return image.copy()
+
+    def clear(self):
+        self._assets.clear()
+        self.size = 0
+
+    async def _fetch(self, url: str) -> _Asset:
+        # renders of the same background at the same time share one download
+        task = self._fetching.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._download(url, self._assets.get(url)))
+            self._fetching[url] = task
+            task.add_done_callback(lambda _: self._fetching.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def _download(self, url: str, stale: Optional[_Asset]) -> _Asset:
+        headers = {}
+        if stale is not None:
+            if stale.etag:
+                headers["If-None-Match"] = stale.etag
+            if stale.last_modified:
+                headers["If-Modified-Since"] = stale.last_modified
+        try:
+            async with self.session.get(url, headers=headers) as r:
+                if r.status == 304 and stale is not None:
+                    self.revalidated += 1
+                    stale.fetched_at = time.monotonic()
+                    if url in self._assets:
+                        self._assets.move_to_end(url)
+                    return stale
+                r.raise_for_status()
+                data = await r.read()
+                etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+        except aiohttp.ClientError:
+            if stale is None:
+                raise
+            log.debug(f"Could not revalidate {url}, serving the cached copy")
+            stale.fetched_at = time.monotonic()
+            return stale
+        self._drop(url)
+        asset = _Asset(data, etag, last_modified)
+        self._assets[url] = asset
+        self._account(url, len(data))
+        return asset
+
+    @staticmethod
+    def _decode(data: bytes, size: Optional[Tuple[int, int]]) -> Image.Image:
+        image = Image.open(BytesIO(data)).convert("RGBA")
+        if size is not None:
+            image = image.resize(size, Image.ANTIALIAS)
+        return image
+
+    def _account(self, url: str, cost: int):
+        self._assets[url].cost += cost
+        self.size += cost
+        while self.size > self.max_bytes and len(self._assets) > 1:
+            oldest = next(iter(self._assets))
+            if oldest == url:
+                self._assets.move_to_end(url)
+                continue
+            self._drop(oldest)
+
+    def _drop(self, url: str):
+        asset = self._assets.pop(url, None)
+        if asset is not None:
+            self.size -= asset.cost
@@ -0,0 +1,149 @@
+"""Streaming level imports from Mee6, Tatsumaki and exported leaderboard files.
+
+Every source is an async generator of record batches, so pages are parsed and
+written while the next ones are still downloading. Writing them, and what
+happens to levelup rewards afterwards, is left to `Leveler._import_levels`.
+"""
+import asyncio
+import csv
+import io
+import json
+import time
+from collections import deque
+from typing import AsyncIterator, Iterable, List, NamedTuple, Optional, Tuple
+
+import aiohttp
+
+from . import xp
+
+BATCH_SIZE = 500
+
+
+class ImportSourceError(Exception):
+    """The source could not be fetched or parsed."""
+
+
+class ImportRecord(NamedTuple):
+    user_id: str
+    username: Optional[str]
+    level: int
+
+
+class ImportStats:
+    """Counters reported once an import has finished."""
+
+    def __init__(self):
+        self.records = 0
+        self.imported = 0
+        self.skipped = 0
+        self.batches = 0
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def summary(self, dry_run: bool = False) -> str:
+        verb = "Would import" if dry_run else "Imported"
+        return (
+            f"{verb} {self.imported} of {self.records} users in {self.batches} batches, "
+            f"{self.elapsed:.1f}s ({self.records / max(self.elapsed, 1e-6):.0f} users/s). "
+            f"{self.skipped} users could not be found and were skipped."
+        )
+
+
+def _row(row: dict) -> Optional[Tuple[str, Optional[str], Optional[int], int]]:
+    """(user_id, username, level, exp) of one row; Mee6 rows carry `id`/`level`, Tatsumaki rows `user_id`/`score`."""
+    if not isinstance(row, dict):
+        return None
+    user_id = row.get("user_id") or row.get("id")
+    if not user_id:
+        return None
+    try:
+        user_id = str(int(user_id))
+        level = int(row["level"]) if row.get("level") not in (None, "") else None
+        exp = 0 if level is not None else int(float(row.get("xp") or row.get("exp") or row.get("score") or 0))
+    except (TypeError, ValueError) as exc:
+        raise ImportSourceError(f"Invalid row for user {user_id}: {exc}") from None
+    return user_id, row.get("username") or row.get("name") or None, level, exp
+
+
+def _records(rows: Iterable[dict]) -> List[ImportRecord]:
+    parsed = [row for row in map(_row, rows) if row is not None]
+    # rows without a level get it from their exp, for the whole page at once
+    levels = xp.find_level_batch([exp for _, _, _, exp in parsed]).tolist()
+    return [
+        ImportRecord(user_id, username, max(level if level is not None else from_exp, 0))
+        for (user_id, username, level, exp), from_exp in zip(parsed, levels)
+    ]
+
+
+def _chunks(records: List[ImportRecord]):
+    for i in range(0, len(records), BATCH_SIZE):
+        yield records[i : i + BATCH_SIZE]
+
+
+async def _get_json(session: aiohttp.ClientSession, url: str, **kwargs):
+    try:
+        async with session.get(url, **kwargs) as r:
+            if r.status != 200:
+                raise ImportSourceError(f"{url} answered with HTTP {r.status}")
+            return await r.json(content_type=None)
+    except (aiohttp.ClientError, ValueError) as exc:
+        raise ImportSourceError(f"Could not fetch {url}: {exc}") from None
+
+
+async def mee6_levels(
+    session: aiohttp.ClientSession, guild_id: int, pages: int, prefetch: int = 3
+) -> AsyncIterator[List[ImportRecord]]:
+    """Mee6 leaderboard pages of 999 users, fetching up to `prefetch` pages ahead of the consumer."""
+    url = "https://mee6.xyz/api/plugins/levels/leaderboard/{}?page={}&limit=999"
+    pending = deque()
+    next_page = 0
+    try:
+        while next_page < pages or pending:
+            while next_page < pages and len(pending) < prefetch:
+                pending.append(asyncio.ensure_future(_get_json(session, url.format(guild_id, next_page))))
+                next_page += 1
+            data = await pending.popleft()
+            players = data.get("players") or []
+            if not players:
+                return
+            yield _records(players)
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def tatsumaki_levels(
+    session: aiohttp.ClientSession, guild_id: int, token: str
+) -> AsyncIterator[List[ImportRecord]]:
+    """The whole Tatsumaki leaderboard, which the API only serves in one response."""
+    data = await _get_json(
+        session, f"https://api.tatsumaki.xyz/guilds/{guild_id}/leaderboard?limit=-1", headers={"Authorization": token}
+    )
+    for batch in _chunks(_records(data or [])):
+        yield batch
+
+
+def parse_export(data: bytes, filename: str) -> List[ImportRecord]:
+    """Records from a CSV file with a header row, or a JSON list of rows (or a Mee6 dump with `players`)."""
+    try:
+        text = data.decode("utf-8-sig")
+        if filename.lower().endswith(".csv"):
+            rows = list(csv.DictReader(io.StringIO(text)))
+        else:
+            rows = json.loads(text)
+            if isinstance(rows, dict):
+                rows = rows.get("players", rows.get("users", []))
+    except (UnicodeDecodeError, ValueError, csv.Error) as exc:
+        raise ImportSourceError(f"Could not read {filename}: {exc}") from None
+    if not isinstance(rows, list):
+        raise ImportSourceError(f"{filename} does not hold a list of users")
+    return _records(rows)
+
+
+async def export_levels(data: bytes, filename: str) -> AsyncIterator[List[ImportRecord]]:
+    records = await asyncio.get_running_loop().run_in_executor(None, parse_export, data, filename)
+    for batch in _chunks(records):
+        yield batch
@@ -0,0 +1,142 @@
+"""The MongoDB indexes Leveler's queries rely on, and checks that they are there and used."""
+import logging
+from typing import Dict, List, NamedTuple, Tuple
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo import errors as mongoerrors
+
+log = logging.getLogger("red.aikaterna.leveler.indexes")
+
+
+class IndexSpec(NamedTuple):
+    keys: Tuple[Tuple[str, int], ...]
+    unique: bool = False
+    # storage backends able to build it, see `storage.BACKENDS`
+    backends: Tuple[str, ...] = ("mongo", "sqlite")
+
+
+REQUIRED_INDEXES: Dict[str, List[IndexSpec]] = {
+    "users": [
+        IndexSpec((("user_id", ASCENDING),), unique=True),
+        IndexSpec((("total_exp", DESCENDING),)),
+        IndexSpec((("rep", DESCENDING),)),
+        # badge keys are named after the badge, a wildcard index finds a badge's holders (MongoDB 4.2+)
+        IndexSpec((("badges.$**", ASCENDING),), backends=("mongo",)),
+    ],
+    "members": [
+        IndexSpec((("server_id", ASCENDING), ("user_id", ASCENDING)), unique=True),
+        IndexSpec((("server_id", ASCENDING), ("member", ASCENDING), ("exp", DESCENDING))),
+    ],
+    "badges": [IndexSpec((("server_id", ASCENDING),), unique=True)],
+    "badgelinks": [IndexSpec((("server_id", ASCENDING),), unique=True)],
+    "roles": [IndexSpec((("server_id", ASCENDING),), unique=True)],
+}
+
+
+def required_indexes(backend: str) -> Dict[str, List[IndexSpec]]:
+    """The `REQUIRED_INDEXES` the `backend` storage can build."""
+    return {
+        collection: [spec for spec in specs if backend in spec.backends]
+        for collection, specs in REQUIRED_INDEXES.items()
+    }
+
+
+async def ensure_indexes(db, backend: str = "mongo") -> List[str]:
+    """Create every required index, returning a message for each one that could not be built.
+
+    A failed index (e.g. duplicate `user_id`s left by an old version) is logged and skipped
+    rather than taking the database connection down with it.
+    """
+    failed = []
+    for collection, specs in REQUIRED_INDEXES.items():
+        for spec in specs:
+            if backend not in spec.backends:
+                log.info(f"Skipping the {_describe(spec.keys)} index on {collection}, {backend} can't build it")
+                continue
+            try:
+                await db[collection].create_index(list(spec.keys), unique=spec.unique)
+            except mongoerrors.OperationFailure as exc:
+                failed.append(f"{collection} {_describe(spec.keys)}: {exc}")
+                log.warning(f"Could not create the {_describe(spec.keys)} index on {collection}", exc_info=exc)
+    return failed
+
+
+async def index_report(db, backend: str = "mongo") -> List[Tuple[str, str, str, str]]:
+    """(collection, index, status, uses) for every required or existing index.
+
+    Status is `ok`, `missing` or `not unique` for the required ones, and `unused` or `extra` for any other.
+    Uses are counted by the server since it last started. Indexes `backend` can't build are left out.
+    """
+    rows = []
+    for collection, specs in required_indexes(backend).items():
+        existing = {}
+        async for index in db[collection].list_indexes():
+            # text and hashed indexes carry a string instead of a direction
+            keys = tuple((f, order if isinstance(order, str) else int(order)) for f, order in index["key"].items())
+            existing[keys] = index
+        usage = {}
+        try:
+            async for stat in db[collection].aggregate([{"$indexStats": {}}]):
+                usage[stat["name"]] = stat["accesses"]["ops"]
+        except mongoerrors.OperationFailure:
+            # $indexStats needs the clusterMonitor role
+            pass
+
+        for spec in specs:
+            index = existing.pop(spec.keys, None)
+            if index is None:
+                rows.append((collection, _describe(spec.keys), "missing", "-"))
+                continue
+            status = "not unique" if spec.unique and not index.get("unique") else "ok"
+            rows.append((collection, index["name"], status, str(usage.get(index["name"], "?"))))
+        for index in existing.values():
+            if index["name"] == "_id_":
+                continue
+            ops = usage.get(index["name"], "?")
+            rows.append((collection, index["name"], "unused" if ops == 0 else "extra", str(ops)))
+    return rows
+
+
+def canonical_queries(db, server_id: str, user_id: str):
+    """The leaderboard, rank and lookup queries run on every command, as (label, cursor)."""
+    return [
+        ("server top", db.members.find({"server_id": server_id, "member": True}).sort("exp", DESCENDING).limit(10)),
+        ("server rank", db.members.find({"server_id": server_id, "member": True, "exp": {"$gt": 0}})),
+        ("global top", db.users.find({}).sort("total_exp", DESCENDING).limit(10)),
+        ("global rank", db.users.find({"total_exp": {"$gt": 0}})),
+        ("global rep top", db.users.find({}).sort("rep", DESCENDING).limit(10)),
+        ("global rep rank", db.users.find({"rep": {"$gt": 0}})),
+        ("user lookup", db.users.find({"user_id": user_id})),
+        ("member lookup", db.members.find({"server_id": server_id, "user_id": user_id})),
+        ("server badges", db.badges.find({"server_id": server_id})),
+        ("badge links", db.badgelinks.find({"server_id": server_id})),
+        ("role links", db.roles.find({"server_id": server_id})),
+    ]
+
+
+def plan_stages(plan: dict) -> List[str]:
+    """Every stage of a winning plan, outermost first."""
+    stages = [plan.get("stage", "?")]
+    if "inputStage" in plan:
+        stages += plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", ()):
+        stages += plan_stages(child)
+    return stages
+
+
+async def explain_queries(db, server_id: str, user_id: str) -> List[Tuple[str, str, bool]]:
+    """(label, plan stages, is a collection scan) for each of the `canonical_queries`."""
+    results = []
+    for label, cursor in canonical_queries(db, server_id, user_id):
+        explained = await cursor.explain()
+        planner = explained.get("queryPlanner", {})
+        # 5.0+ servers using the slot based engine nest the classic plan one level down
+        plan = planner.get("winningPlan", {})
+        plan = plan.get("queryPlan", plan)
+        stages = plan_stages(plan)
+        results.append((label, " > ".join(stages), "COLLSCAN" in stages))
+    return results
+
+
+def _describe(keys) -> str:
+    return ", ".join(f"{field} {'asc' if order == ASCENDING else 'desc'}" for field, order in keys)
@@ -1,32 +1,27 @@
 import asyncio
 import contextlib
+import hashlib
 import logging
 import operator
 import os
-import platform
 import random
 import re
-import string
-import textwrap
 import time
 from asyncio import TimeoutError
-from copy import copy
 from datetime import datetime, timedelta
 
 from discord.ext.commands import BotMissingPermissions
 from tabulate import tabulate
 from io import BytesIO
-from typing import Union
+from collections import defaultdict
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Union
 
 import aiohttp
 import discord
 import math
-import numpy
-import scipy
-import scipy.cluster
-from PIL import Image, ImageDraw, ImageFilter, ImageFont, ImageOps
+from PIL import Image
 from discord.utils import find
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
 from pymongo import errors as mongoerrors
 from redbot.core.bot import Red
 from redbot.core import Config, bank, checks, commands
@@ -35,17 +30,64 @@ from redbot.core.utils.chat_formatting import box, pagify
 from redbot.core.utils.menus import DEFAULT_CONTROLS, menu
 from redbot.core.utils.predicates import MessagePredicate
 
+from . import importer, indexes, queries, render, storage, xp
+from .cache import ImageAssetCache, RenderCache, content_key
+from .snapshots import BoardSnapshot
+
 
 log = logging.getLogger("red.aikaterna.leveler")
 
+# backgrounds are cached already resized to the card they are drawn on
+CANVAS_SIZES = {"profile": (290, 290), "rank": (360, 100), "levelup": (175, 65)}
+
+# member updates in flight at once while a drain's exp is flushed
+FLUSH_CONCURRENCY = 50
+
 
 async def non_global_bank(ctx):
     return not await bank.is_global()
 
 
+class GuildSettings(NamedTuple):
+    """Snapshot of a guild's settings, cached by `Leveler._guild_settings` for the message path."""
+
+    disabled: bool
+    lvl_msg: bool
+    mentions: bool
+    text_only: bool
+    private_lvl_message: bool
+    lvl_msg_lock: Optional[int]
+    msg_credits: int
+    ignored_channels: FrozenSet[int]
+
+
+class QueuedMessage(NamedTuple):
+    """The parts of a message that exp awarding needs, kept instead of the message itself."""
+
+    author_id: int
+    guild_id: int
+    channel_id: int
+    content_hash: str
+    timestamp: float
+
+
+class LevelRewards(NamedTuple):
+    """What reaching one level hands out, cached per guild by `Leveler._level_rewards`."""
+
+    add_roles: FrozenSet[int]
+    remove_roles: FrozenSet[int]
+    badges: Dict[str, dict]
+
+
 class Leveler(commands.Cog):
     """A level up thing with image generation!"""
 
+    ROLE_SYNC_BATCH = 100
+    ROLE_SYNC_DELAY = 1.0
+    KNOWN_USER_TTL = 600
+    BOARD_REFRESH_INTERVAL = 300
+    MEMBERSHIP_RECONCILE_INTERVAL = 3600
+
     def __init__(self, bot: Red):
         self.bot = bot
 
@@ -71,6 +113,12 @@ class Leveler(commands.Cog):
             "default_rank": "http://i.imgur.com/SorwIrc.jpg",
             "default_levelup": "http://i.imgur.com/eEFfKqa.jpg",
             "rep_price": 0,
+            "message_queue_size": 10000,
+            "render_disk_cache": False,
+            "render_workers": 2,
+            "render_processes": False,
+            "members_migrated": False,
+            "storage": "mongo",
         }
         default_guild = {
             "disabled": False,
@@ -81,6 +129,7 @@ class Leveler(commands.Cog):
             "lvl_msg_lock": None,
             "msg_credits": 0,
             "ignored_channels": [],
+            "role_sync": None,
         }
         self.config.init_custom("MONGODB", -1)
         self.config.register_custom("MONGODB", **default_mongodb)
@@ -88,43 +137,72 @@ class Leveler(commands.Cog):
         self.config.register_guild(**default_guild)
 
         self._db_ready = False
-        self.client = None
+        self._backend = None
         self.db = None
+        self._index_failures = []
+        self._settings_cache = {}
+        self._rewards_cache = {}
+        self._role_syncs = {}
+        self._migration = None
+        self._migration_progress = {"users": 0, "entries": 0, "total": 0}
+        self._known_users = {}
+        self._xp_range = None
         self.session = aiohttp.ClientSession(loop=self.bot.loop)
-        self._message_tasks = []
+        self._assets = ImageAssetCache(self.session)
+        self._message_queue = asyncio.Queue()
+        self._message_queue_size = 10000
+        self._queued_keys = set()
+        self._intake_stats = {"queued": 0, "deduplicated": 0, "dropped": 0, "peak_depth": 0}
+        self._pending_exp = {}
+        self._chat_blocks = {}
+        self._render_cache = RenderCache()
+        self._palettes = {}
+        self._renderer = render.RenderPool(
+            initializer=render.preload_fonts, initargs=(str(bundled_data_path(self)),)
+        )
+        self._boards = {"exp": BoardSnapshot("total_exp", 100), "rep": BoardSnapshot("rep", 1)}
         self._message_task_processor = asyncio.create_task(self.process_tasks())
         self._message_task_processor.add_done_callback(self._task_error_logger)
+        self._board_refresher = asyncio.create_task(self._refresh_boards())
+        self._board_refresher.add_done_callback(self._task_error_logger)
+        self._membership_reconciler = asyncio.create_task(self._reconcile_memberships())
+        self._membership_reconciler.add_done_callback(self._task_error_logger)
 
     async def initialize(self):
-        await self._connect_to_mongo()
-
-    async def _connect_to_mongo(self):
-        if self._db_ready:
-            self._db_ready = False
-        self._disconnect_mongo()
-        config = await self.config.custom("MONGODB").all()
-        log.debug(f"Leveler is connecting to a MongoDB server at: {config}")
+        await self._connect_storage()
+
+    async def _connect_storage(self) -> bool:
+        """Connects to the backend chosen with `levelerset storage`, returning whether it worked."""
+        self._db_ready = False
+        self._disconnect_storage()
+        if await self.config.storage() == "sqlite":
+            backend = storage.SQLiteBackend(cog_data_path(self) / "leveler.sqlite3")
+        else:
+            backend = storage.MongoBackend(await self.config.custom("MONGODB").all())
+        log.debug(f"Leveler is connecting to its storage: {backend.describe()}")
         try:
-            self.client = AsyncIOMotorClient(**{k: v for k, v in config.items() if not k == "db_name"})
-            await self.client.server_info()
-            self.db = self.client[config["db_name"]]
-            self._db_ready = True
-        except (
-            mongoerrors.ServerSelectionTimeoutError,
-            mongoerrors.ConfigurationError,
-            mongoerrors.OperationFailure,
-        ) as error:
-            log.exception(
-                "Can't connect to the MongoDB server.\nFollow instructions on Git/online to install MongoDB.",
-                exc_info=error,
-            )
-            self.client = None
+            await backend.connect()
+            self.db = backend.db
+            self._index_failures = await indexes.ensure_indexes(self.db, backend.name)
+        except storage.CONNECT_ERRORS as error:
+            if backend.name == "mongo":
+                log.exception(
+                    "Can't connect to the MongoDB server.\nFollow instructions on Git/online to install MongoDB.",
+                    exc_info=error,
+                )
+            else:
+                log.exception(f"Can't open the {backend.describe()}.", exc_info=error)
+            backend.close()
             self.db = None
-        return self.client
+            return False
+        self._backend = backend
+        self._db_ready = True
+        return True
 
-    def _disconnect_mongo(self):
-        if self.client:
-            self.client.close()
+    def _disconnect_storage(self):
+        if self._backend is not None:
+            self._backend.close()
+            self._backend = None
 
     async def cog_check(self, ctx):
         if (ctx.command.parent is self.levelerset) or ctx.command is self.levelerset:
@@ -135,7 +213,15 @@ class Leveler(commands.Cog):
         self.bot.loop.create_task(self.session.close())
         if self._message_task_processor:
             self._message_task_processor.cancel()
-        self._disconnect_mongo()
+        self._board_refresher.cancel()
+        self._membership_reconciler.cancel()
+        # the checkpoints stay in config, so these pick up where they were on the next load
+        for task in self._role_syncs.values():
+            task.cancel()
+        if self._migration is not None:
+            self._migration.cancel()
+        self._renderer.shutdown()
+        self._disconnect_storage()
 
     def _task_error_logger(self, fut):
         """Logs errors in the _message_task_processor task."""
@@ -146,6 +232,94 @@ class Leveler(commands.Cog):
         except Exception as e:
             log.critical("The leveler task encountered an unexpected error and has stopped.\n", exc_info=e)
 
+    async def _load_runtime_settings(self):
+        self._message_queue_size = await self.config.message_queue_size()
+        start = time.perf_counter()
+        loaded = await self.bot.loop.run_in_executor(None, render.preload_fonts, str(bundled_data_path(self)))
+        log.info(f"Loaded {loaded} fonts in {(time.perf_counter() - start) * 1000:.1f} ms")
+        if await self.config.render_disk_cache():
+            self._render_cache.set_disk_path(cog_data_path(self) / "render_cache")
+        self._renderer.configure(await self.config.render_workers(), await self.config.render_processes())
+
+    async def _guild_settings(self, server) -> GuildSettings:
+        """Cached guild settings, dropped by `_invalidate_settings` whenever a setter changes them."""
+        settings = self._settings_cache.get(server.id)
+        if settings is None:
+            data = await self.config.guild(server).all()
+            data["ignored_channels"] = frozenset(data["ignored_channels"])
+            settings = GuildSettings(**{field: data[field] for field in GuildSettings._fields})
+            self._settings_cache[server.id] = settings
+        return settings
+
+    def _invalidate_settings(self, server):
+        self._settings_cache.pop(server.id, None)
+
+    async def _level_rewards(self, server) -> Dict[int, LevelRewards]:
+        """Cached level -> rewards index, dropped by `_invalidate_rewards` whenever a link, badge or role changes."""
+        index = self._rewards_cache.get(server.id)
+        if index is None:
+            server_roles = await self.db.roles.find_one({"server_id": str(server.id)}) or {}
+            linked_badges = await self.db.badgelinks.find_one({"server_id": str(server.id)}) or {}
+            server_badges = {}
+            if linked_badges.get("badges"):
+                server_badges = (await self.db.badges.find_one({"server_id": str(server.id)}) or {}).get("badges", {})
+
+            add_roles, remove_roles, badges = defaultdict(set), defaultdict(set), defaultdict(dict)
+            for role_name, link in server_roles.get("roles", {}).items():
+                level = int(link["level"])
+                add_role = discord.utils.get(server.roles, name=role_name)
+                if add_role is not None:
+                    add_roles[level].add(add_role.id)
+                remove_role = discord.utils.get(server.roles, name=link["remove_role"])
+                if remove_role is not None:
+                    remove_roles[level].add(remove_role.id)
+            for badge_name, level in linked_badges.get("badges", {}).items():
+                if badge_name in server_badges:
+                    badges[int(level)][badge_name] = server_badges[badge_name]
+
+            index = {
+                level: LevelRewards(frozenset(add_roles[level]), frozenset(remove_roles[level]), badges[level])
+                for level in set(add_roles) | set(remove_roles) | set(badges)
+            }
+            self._rewards_cache[server.id] = index
+        return index
+
+    def _invalidate_rewards(self, server):
+        self._rewards_cache.pop(server.id, None)
+
+    @commands.Cog.listener("on_guild_role_create")
+    @commands.Cog.listener("on_guild_role_delete")
+    async def _role_changed(self, role):
+        # links are stored by role name, so any rename, new or deleted role can change the index
+        self._invalidate_rewards(role.guild)
+
+    @commands.Cog.listener("on_guild_role_update")
+    async def _role_updated(self, before, after):
+        if before.name != after.name:
+            self._invalidate_rewards(after.guild)
+
+    async def _refresh_boards(self):
+        await self.bot.wait_until_red_ready()
+        while True:
+            if self._db_ready:
+                for name, board in self._boards.items():
+                    try:
+                        await board.refresh(self.db.users)
+                    except Exception as err:
+                        log.error(f"Could not refresh the global {name} leaderboard", exc_info=err)
+            await asyncio.sleep(self.BOARD_REFRESH_INTERVAL)
+
+    async def _global_board(self, name: str) -> BoardSnapshot:
+        board = self._boards[name]
+        if board.taken_at is None:
+            await board.refresh(self.db.users)
+        return board
+
+    async def _get_xp_range(self):
+        if self._xp_range is None:
+            self._xp_range = tuple(await self.config.xp())
+        return self._xp_range
+
     @property
     def DEFAULT_BGS(self):
         return {
@@ -277,10 +451,11 @@ class Leveler(commands.Cog):
         global_ranking = await self._find_global_rank(user)
         if global_ranking:
             em.add_field(name="Global Rank:", value=f"#{global_ranking}")
+        memberinfo = await self._member_info(user, server)
         em.add_field(name="Server Rank:", value=f"#{await self._find_server_rank(user, server)}")
-        em.add_field(name="Server Level:", value=format(userinfo["servers"][str(server.id)]["level"]))
+        em.add_field(name="Server Level:", value=format(memberinfo["level"]))
         em.add_field(name="Total Exp:", value=userinfo["total_exp"])
-        em.add_field(name="Server Exp:", value=await self._find_server_exp(user, server))
+        em.add_field(name="Server Exp:", value=memberinfo["exp"])
         u_credits = await bank.get_balance(user)
         em.add_field(name="Credits: ", value=f"${u_credits}")
         em.add_field(name="Info: ", value=test_empty(userinfo["info"]))
@@ -330,16 +505,17 @@ class Leveler(commands.Cog):
     async def rank_text(self, user, server, userinfo):
         em = discord.Embed(colour=user.colour)
         em.add_field(name="Server Rank", value=f"#{await self._find_server_rank(user, server)}")
+        memberinfo = await self._member_info(user, server)
         em.add_field(name="Reps", value=userinfo["rep"])
-        em.add_field(name="Server Level", value=userinfo["servers"][str(server.id)]["level"])
-        em.add_field(name="Server Exp", value=await self._find_server_exp(user, server))
+        em.add_field(name="Server Level", value=memberinfo["level"])
+        em.add_field(name="Server Exp", value=memberinfo["exp"])
         em.set_author(name=f"Rank and Statistics for {user.name}", url=user.avatar_url)
         em.set_thumbnail(url=user.avatar_url)
         return em
 
     # should the user be mentioned based on settings?
     async def _is_mention(self, user):
-        if await self.config.guild(user.guild).mentions():
+        if (await self._guild_settings(user.guild)).mentions:
             return user.mention
         else:
             return user.name
@@ -370,68 +546,36 @@ class Leveler(commands.Cog):
 
         user = ctx.author
         server = ctx.guild
-        q = f"servers.{server.id}"
         space = "\N{EN SPACE}"
-        guild_ids = [str(x.id) for x in ctx.guild.members]
         await self._create_user(user, server)
 
         async with ctx.typing():
             users = []
             user_stat = None
-            if "-rep" in options and "-global" in options:
-                title = "Global Rep Leaderboard for {}\n".format(self.bot.user.name)
-                async for userinfo in self.db.users.find(({"rep": {"$gte": 1}})).sort("rep", -1).limit(300):
-                    await asyncio.sleep(0)
-                    try:
-                        users.append((userinfo["username"], userinfo["rep"]))
-                    except KeyError:
-                        users.append((str(int(userinfo["user_id"])), userinfo["rep"]))
-
-                    if str(user.id) == userinfo["user_id"]:
-                        user_stat = userinfo["rep"]
-
-                board_type = "Rep"
-                global_rep_rank = await self._find_global_rep_rank(user)
-                if global_rep_rank:
-                    footer_text = f"Your Rank: {global_rep_rank}                 {board_type}: {user_stat}"
+            snapshot = None
+            if "-global" in options:
+                # global boards are paged from the in-memory snapshot, refreshed in the background
+                if "-rep" in options:
+                    title = "Global Rep Leaderboard for {}\n".format(self.bot.user.name)
+                    snapshot = await self._global_board("rep")
+                    board_type = "Rep"
                 else:
-                    footer_text = f"{space*40}"
-                icon_url = self.bot.user.avatar_url
-            elif "-global" in options:
-                title = "Global Exp Leaderboard for {}\n".format(self.bot.user.name)
-                async for userinfo in self.db.users.find(({"total_exp": {"$gte": 100}})).sort("total_exp", -1).limit(
-                    300
-                ):
-                    await asyncio.sleep(0)
-                    try:
-                        users.append((userinfo["username"], userinfo["total_exp"]))
-                    except KeyError:
-                        users.append((str(int(userinfo["user_id"])), userinfo["total_exp"]))
-
-                    if str(user.id) == userinfo["user_id"]:
-                        user_stat = userinfo["total_exp"]
-
-                board_type = "Points"
-                global_ranking = await self._find_global_rank(user)
-                if global_ranking:
-                    footer_text = f"Your Rank: {global_ranking}                 {board_type}: {user_stat}"
+                    title = "Global Exp Leaderboard for {}\n".format(self.bot.user.name)
+                    snapshot = await self._global_board("exp")
+                    board_type = "Points"
+                users = snapshot.top
+                ranked = snapshot.rank(user.id)
+                if ranked:
+                    footer_text = f"Your Rank: {ranked[0]}                 {board_type}: {ranked[1]}"
                 else:
                     footer_text = f"{space*40}"
                 icon_url = self.bot.user.avatar_url
             elif "-rep" in options:
                 title = "Rep Leaderboard for {}\n".format(server.name)
-                async for userinfo in self.db.users.find(
-                    {"$and": [{q: {"$exists": "true"}}, {"rep": {"$gte": 1}}]}
-                ).sort("rep", -1):
-                    await asyncio.sleep(0)
-                    if userinfo["user_id"] in guild_ids:
-                        try:
-                            users.append((userinfo["username"], userinfo["rep"]))
-                        except KeyError:
-                            users.append((str(int(userinfo["user_id"])), userinfo["rep"]))
-
-                    if str(user.id) == userinfo["user_id"]:
-                        user_stat = userinfo["rep"]
+                for entry in await self._server_rep_board(server):
+                    users.append((entry.get("username", entry["user_id"]), entry["rep"]))
+                    if str(user.id) == entry["user_id"]:
+                        user_stat = entry["rep"]
 
                 board_type = "Rep"
                 footer_text = "Your Rank: {}               {}: {}".format(
@@ -440,34 +584,27 @@ class Leveler(commands.Cog):
                 icon_url = server.icon_url
             else:
                 title = "Exp Leaderboard for {}\n".format(server.name)
-                async for userinfo in self.db.users.find({q: {"$exists": "true"}}):
-                    await asyncio.sleep(0)
-                    if userinfo["user_id"] in guild_ids:
-                        server_exp = 0
-                        # generate total xp gain for each level gained
-                        for i in range(userinfo["servers"][str(server.id)]["level"]):
-                            await asyncio.sleep(0)
-                            server_exp += self._required_exp(i)
-                        # add current non-completed level exp to count
-                        server_exp += userinfo["servers"][str(server.id)]["current_exp"]
-                        try:
-                            users.append((userinfo["username"], server_exp))
-                        except:
-                            users.append((str(int(userinfo["user_id"])), server_exp))
+                # the server board is served straight from the members collection, one page at a time
+                users = None
                 board_type = "Points"
                 footer_text = "Your Rank: {}                {}: {}".format(
                     await self._find_server_rank(user, server), board_type, await self._find_server_exp(user, server),
                 )
                 icon_url = server.icon_url
-            sorted_list = sorted(users, key=operator.itemgetter(1), reverse=True)
 
-            if not sorted_list:
+            if users is None:
+                total_entries = await self.db.members.count_documents(self._member_filter(server))
+            else:
+                sorted_list = sorted(users, key=operator.itemgetter(1), reverse=True)
+                total_entries = len(sorted_list)
+
+            if not total_entries:
                 return await ctx.send("**There are no results to display.**")
 
             # multiple page support
             page = 1
             per_page = 15
-            pages = math.ceil(len(sorted_list) / per_page)
+            pages = math.ceil(total_entries / per_page)
             for option in options:
                 if str(option).isdigit():
                     if page >= 1 and int(option) <= pages:
@@ -481,9 +618,13 @@ class Leveler(commands.Cog):
             rank = 1 + per_page * (page - 1)
             start_index = per_page * page - per_page
             end_index = per_page * page
-            top_user_value = 8 + len(str(sorted_list[start_index:end_index][0][1])) + 4
+            if users is None:
+                page_list = await self._server_leaderboard_page(server, start_index, per_page)
+            else:
+                page_list = sorted_list[start_index:end_index]
+            top_user_value = 8 + len(str(page_list[0][1])) + 4
 
-            async for single_user in self.asyncit(sorted_list[start_index:end_index]):
+            async for single_user in self.asyncit(page_list):
                 await asyncio.sleep(0)
                 label = "   "
                 rank_text = f"{rank:<2}"
@@ -500,6 +641,8 @@ class Leveler(commands.Cog):
             msg += f"{separator}\n{footer_text}\nPage: {page}/{pages}"
             em = discord.Embed(description=box(msg), colour=user.colour)
             em.set_author(name=title, icon_url=icon_url)
+            if snapshot is not None:
+                em.set_footer(text=f"Updated {snapshot.age}")
 
             await ctx.send(embed=em)
 
@@ -514,7 +657,6 @@ class Leveler(commands.Cog):
         await self._create_user(org_user, server)
         if user:
             await self._create_user(user, server)
-        org_userinfo = await self.db.users.find_one({"user_id": str(org_user.id)})
         curr_time = time.time()
 
         if await self.config.guild(ctx.guild).disabled():
@@ -526,29 +668,32 @@ class Leveler(commands.Cog):
         if user and user.bot:
             await ctx.send("**You can't give a rep to a bot!**")
             return
-        if "rep_block" not in org_userinfo:
-            org_userinfo["rep_block"] = 0
+        if user:
+            # claiming the cooldown and checking it is one update, so two reps at once can't both pass
+            claimed = await self.db.users.find_one_and_update(
+                *queries.rep_claim(org_user.id, curr_time), projection={"_id": 1}
+            )
+            if claimed:
+                await self.db.users.update_one({"user_id": str(user.id)}, {"$inc": {"rep": 1}})
+                return await ctx.send(
+                    "**You have just given {} a reputation point!**".format(await self._is_mention(user))
+                )
 
-        delta = float(curr_time) - float(org_userinfo["rep_block"])
-        if user and delta >= 43200.0 and delta > 0:
-            userinfo = await self.db.users.find_one({"user_id": str(user.id)})
-            await self.db.users.update_one({"user_id": str(org_user.id)}, {"$set": {"rep_block": curr_time}})
-            await self.db.users.update_one({"user_id": str(user.id)}, {"$set": {"rep": userinfo["rep"] + 1}})
-            await ctx.send("**You have just given {} a reputation point!**".format(await self._is_mention(user)))
-        else:
-            # calculate time left
-            seconds = 43200 - delta
-            if seconds < 0:
-                await ctx.send("**You can give a rep!**")
-                return
+        org_userinfo = await self.db.users.find_one({"user_id": str(org_user.id)}, {"rep_block": 1})
+        delta = float(curr_time) - float(org_userinfo.get("rep_block", 0))
+        # calculate time left
+        seconds = queries.REP_COOLDOWN - delta
+        if seconds < 0:
+            await ctx.send("**You can give a rep!**")
+            return
 
-            m, s = divmod(seconds, 60)
-            h, m = divmod(m, 60)
-            await ctx.send(
-                "**You need to wait {} hours, {} minutes, and {} seconds until you can give reputation again!**".format(
-                    int(h), int(m), int(s)
-                )
+        m, s = divmod(seconds, 60)
+        h, m = divmod(m, 60)
+        await ctx.send(
+            "**You need to wait {} hours, {} minutes, and {} seconds until you can give reputation again!**".format(
+                int(h), int(m), int(s)
             )
+        )
 
     @commands.cooldown(1, 30, commands.BucketType.user)
     @commands.command()
@@ -573,7 +718,7 @@ class Leveler(commands.Cog):
 
         curr_time = time.time()
         delta = float(curr_time) - float(userinfo["rep_block"])
-        if delta >= 43200.0 and delta > 0:
+        if delta >= queries.REP_COOLDOWN and delta > 0:
             return await ctx.send("**You can give a rep without resetting your rep cooldown!**")
 
         if not await bank.can_spend(user, rep_price):
@@ -619,13 +764,9 @@ class Leveler(commands.Cog):
         msg += f"Name: {user.name}\n"
         msg += f"Title: {userinfo['title']}\n"
         msg += f"Reps: {userinfo['rep']}\n"
-        msg += f"Server Level: {userinfo['servers'][str(server.id)]['level']}\n"
-        total_server_exp = 0
-        for i in range(userinfo["servers"][str(server.id)]["level"]):
-            await asyncio.sleep(0)
-            total_server_exp += self._required_exp(i)
-        total_server_exp += userinfo["servers"][str(server.id)]["current_exp"]
-        msg += f"Server Exp: {total_server_exp}\n"
+        memberinfo = await self._member_info(user, server)
+        msg += f"Server Level: {memberinfo['level']}\n"
+        msg += f"Server Exp: {memberinfo['exp']}\n"
         msg += f"Total Exp: {userinfo['total_exp']}\n"
         msg += f"Info: {userinfo['info']}\n"
         msg += f"Profile background: {userinfo['profile_background']}\n"
@@ -661,25 +802,55 @@ class Leveler(commands.Cog):
     @commands.group()
     async def levelerset(self, ctx):
         """
-        MongoDB server configuration options.
+        Storage and MongoDB server configuration options.
         
         Use this command in DMs to see current settings.
         """
         if not ctx.invoked_subcommand and ctx.channel.type == discord.ChannelType.private:
-            settings = [
+            settings = [("Storage", await self.config.storage())] + [
                 (setting.replace("_", " ").title(), value)
                 for setting, value in (await self.config.custom("MONGODB").get_raw()).items()
                 if value
             ]
             await ctx.send(box(tabulate(settings, tablefmt="plain")))
 
+    @levelerset.command(name="storage")
+    async def levelerset_storage(self, ctx, backend: str):
+        """
+        Choose where Leveler keeps its data.
+
+        **backend** can be one of: `mongo` `sqlite`
+        `mongo` uses the MongoDB server set with the other `levelerset` commands
+        `sqlite` keeps everything in a file in the cog's data folder, no database server needed
+
+        Data is not copied over when switching.
+        """
+        backend = backend.lower()
+        if backend not in storage.BACKENDS:
+            return await ctx.send(f"Storage has to be one of: {', '.join(storage.BACKENDS)}.")
+        await self.config.storage.set(backend)
+        message = await ctx.send(f"Storage set to {backend}.\nNow trying to connect...")
+        connected = await self._connect_storage()
+        if not connected:
+            return await message.edit(
+                content=message.content.replace("Now trying to connect...", "")
+                + "Failed to connect. Check the logs for the reason."
+            )
+        # boards and known users were read from the previous storage
+        self._known_users.clear()
+        for board in self._boards.values():
+            await board.refresh(self.db.users)
+        await message.edit(
+            content=message.content.replace("Now trying to connect...", f"Connected to the {self._backend.describe()}.")
+        )
+
     @levelerset.command()
     async def host(self, ctx, host: str = "localhost"):
         """Set the MongoDB server host."""
         await self.config.custom("MONGODB").host.set(host)
         message = await ctx.send(f"MongoDB host set to {host}.\nNow trying to connect to the new host...")
-        client = await self._connect_to_mongo()
-        if not client:
+        connected = await self._connect_storage()
+        if not connected:
             return await message.edit(
                 content=message.content.replace("Now trying to connect to the new host...", "")
                 + "Failed to connect. Please try again with a valid host."
@@ -691,8 +862,8 @@ class Leveler(commands.Cog):
         """Set the MongoDB server port."""
         await self.config.custom("MONGODB").port.set(port)
         message = await ctx.send(f"MongoDB port set to {port}.\nNow trying to connect to the new port...")
-        client = await self._connect_to_mongo()
-        if not client:
+        connected = await self._connect_storage()
+        if not connected:
             return await message.edit(
                 content=message.content.replace("Now trying to connect to the new port...", "")
                 + "Failed to connect. Please try again with a valid port."
@@ -705,8 +876,8 @@ class Leveler(commands.Cog):
         await self.config.custom("MONGODB").username.set(username)
         await self.config.custom("MONGODB").password.set(password)
         message = await ctx.send("MongoDB credentials set.\nNow trying to connect...")
-        client = await self._connect_to_mongo()
-        if not client:
+        connected = await self._connect_storage()
+        if not connected:
             return await message.edit(
                 content=message.content.replace("Now trying to connect...", "")
                 + "Failed to connect. Please try again with valid credentials."
@@ -718,8 +889,8 @@ class Leveler(commands.Cog):
         """Set the MongoDB db name."""
         await self.config.custom("MONGODB").db_name.set(dbname)
         message = await ctx.send("MongoDB db name set.\nNow trying to connect...")
-        client = await self._connect_to_mongo()
-        if not client:
+        connected = await self._connect_storage()
+        if not connected:
             return await message.edit(
                 content=message.content.replace("Now trying to connect...", "")
                 + "Failed to connect. Please try again with a valid db name."
@@ -1056,45 +1227,16 @@ class Leveler(commands.Cog):
         await self.db.users.update_one({"user_id": str(user.id)}, {"$set": {section_name: set_color[0]}})
         await ctx.send("**Color for level-up {} set.**".format(section))
 
-    # uses k-means algorithm to find color from bg, rank is abundance of color, descending
+    # picks colours from the background's palette, rank is abundance of color, descending
     async def _auto_color(self, ctx, url: str, ranks):
-        phrases = ["Calculating colors...", "Reticulating Splines..."]  # in case I want more
-        await ctx.send("**{}**".format(random.choice(phrases)))
-        clusters = 10
-
-        async with self.session.get(url) as r:
-            image = await r.content.read()
-        with open(f"{cog_data_path(self)}/temp_auto.png", "wb") as f:
-            f.write(image)
-
-        im = Image.open(f"{cog_data_path(self)}/temp_auto.png").convert("RGBA")
-        im = im.resize((290, 290))  # resized to reduce time
-        ar = numpy.asarray(im)
-        shape = ar.shape
-        ar = ar.reshape(scipy.product(shape[:2]), shape[2])
-
-        codes, dist = scipy.cluster.vq.kmeans(ar.astype(float), clusters)
-        vecs, dist = scipy.cluster.vq.vq(ar, codes)  # assign codes
-        counts, bins = scipy.histogram(vecs, len(codes))  # count occurrences
-
-        # sort counts
-        freq_index = []
-        index = 0
-        for count in counts:
-            await asyncio.sleep(0)
-            freq_index.append((index, count))
-            index += 1
-        sorted_list = sorted(freq_index, key=operator.itemgetter(1), reverse=True)
-
-        colors = []
-        for rank in ranks:
-            await asyncio.sleep(0)
-            color_index = min(rank, len(codes))
-            peak = codes[sorted_list[color_index][0]]  # gets the original index
-            peak = peak.astype(int)
-
-            colors.append("".join(format(c, "02x") for c in peak))
-        return colors  # returns array
+        colors = self._palettes.get(url)
+        if colors is None:
+            phrases = ["Calculating colors...", "Reticulating Splines..."]  # in case I want more
+            await ctx.send("**{}**".format(random.choice(phrases)))
+            im = await self._assets.get(url, (290, 290))  # resized to reduce time
+            colors = await self._renderer.run(render.palette, im)
+            self._palettes[url] = colors
+        return [colors[min(rank, len(colors) - 1)] for rank in ranks]
 
     # converts hex to rgb
     @staticmethod
@@ -1329,6 +1471,7 @@ class Leveler(commands.Cog):
             return
 
         await self.config.guild(server).msg_credits.set(currency)
+        self._invalidate_settings(server)
         await ctx.send("**Credits per message logged set to `{}`.**".format(currency))
 
     @lvladmin.command()
@@ -1349,10 +1492,12 @@ class Leveler(commands.Cog):
         if channel.id in await self.config.guild(server).ignored_channels():
             async with self.config.guild(server).ignored_channels() as channels:
                 channels.remove(channel.id)
+            self._invalidate_settings(server)
             await ctx.send(f"**Messages in {channel.mention} will give exp now.**")
         else:
             async with self.config.guild(server).ignored_channels() as channels:
                 channels.append(channel.id)
+            self._invalidate_settings(server)
             await ctx.send(f"**Messages in {channel.mention} will not give exp now.**")
 
     @lvladmin.command(name="lock")
@@ -1363,9 +1508,11 @@ class Leveler(commands.Cog):
 
         if not channel:
             await self.config.guild(server).lvl_msg_lock.set(None)
+            self._invalidate_settings(server)
             await ctx.send("**Level-up message lock disabled.**")
         else:
             await self.config.guild(server).lvl_msg_lock.set(channel.id)
+            self._invalidate_settings(server)
             await ctx.send("**Level-up messages locked to `#{}`**".format(channel.name))
 
     async def _process_purchase(self, ctx):
@@ -1397,10 +1544,12 @@ class Leveler(commands.Cog):
         else:
             return True
 
-    async def _give_chat_credit(self, user, server):
-        msg_credits = await self.config.guild(server).msg_credits()
+    async def _chat_credit(self, server) -> int:
+        """Credits a qualifying message earns, deposited with the exp by `_flush_pending_exp`."""
+        msg_credits = (await self._guild_settings(server)).msg_credits
         if msg_credits and not await bank.is_global():
-            await bank.deposit_credits(user, msg_credits)
+            return msg_credits
+        return 0
 
     @checks.is_owner()
     @lvladmin.command()
@@ -1433,7 +1582,6 @@ class Leveler(commands.Cog):
         channel = ctx.channel
         # creates user if doesn't exist
         await self._create_user(user, server)
-        userinfo = await self.db.users.find_one({"user_id": str(user.id)})
 
         if await self.config.guild(ctx.guild).disabled():
             await ctx.send("**Leveler commands for this server are disabled.**")
@@ -1447,32 +1595,18 @@ class Leveler(commands.Cog):
             await ctx.send("**Please enter a number that is less than 10,000.**")
             return
 
-        # get rid of old level exp
-        old_server_exp = 0
-        for i in range(userinfo["servers"][str(server.id)]["level"]):
-            await asyncio.sleep(0)
-            old_server_exp += self._required_exp(i)
-        userinfo["total_exp"] -= old_server_exp
-        userinfo["total_exp"] -= userinfo["servers"][str(server.id)]["current_exp"]
-
-        # add in new exp
+        # swap the old level exp for the new one, the total moves by the difference
         total_exp = self._level_exp(level)
-        userinfo["servers"][str(server.id)]["current_exp"] = 0
-        userinfo["servers"][str(server.id)]["level"] = level
-        userinfo["total_exp"] += total_exp
-
-        await self.db.users.update_one(
-            {"user_id": str(user.id)},
-            {
-                "$set": {
-                    "servers.{}.level".format(server.id): level,
-                    "servers.{}.current_exp".format(server.id): 0,
-                    "total_exp": userinfo["total_exp"],
-                }
-            },
+        before = await self.db.members.find_one_and_update(
+            {"server_id": str(server.id), "user_id": str(user.id)},
+            {"$set": {"level": level, "current_exp": 0, "exp": total_exp, "username": user.name, "member": True}},
+            projection={"_id": 0, "exp": 1},
+            upsert=True,
         )
+        old_exp = before["exp"] if before else 0
+        await self.db.users.update_one({"user_id": str(user.id)}, {"$inc": {"total_exp": total_exp - old_exp}})
         await ctx.send("**{}'s Level has been set to `{}`.**".format(await self._is_mention(user), level))
-        await self._handle_levelup(user, userinfo, server, channel)
+        await self._handle_levelup(user, level, server, channel)
 
     @checks.is_owner()
     @lvladmin.command()
@@ -1519,6 +1653,7 @@ class Leveler(commands.Cog):
         except Exception as exc:
             await ctx.send("Unable to add chat block: {}".format(exc))
         else:
+            self._chat_blocks.pop(user.id, None)
             await ctx.tick()
 
     @checks.is_owner()
@@ -1528,22 +1663,28 @@ class Leveler(commands.Cog):
         """Toggle mentions on messages."""
         if await self.config.guild(ctx.guild).mentions():
             await self.config.guild(ctx.guild).mentions.set(False)
+            self._invalidate_settings(ctx.guild)
             await ctx.send("**Mentions disabled.**")
         else:
             await self.config.guild(ctx.guild).mentions.set(True)
+            self._invalidate_settings(ctx.guild)
             await ctx.send("**Mentions enabled.**")
 
-    async def _valid_image_url(self, url):
+    async def _valid_image_url(self, url, size=None):
         try:
-            async with self.session.get(url) as r:
-                image = await r.read()
-            return Image.open(BytesIO(image)).convert("RGBA")
+            return await self._assets.get(url, size)
         except Exception as exc:
             log.exception(
                 "Something went wrong while trying to get a badge image or convert it: ", exc_info=exc,
             )
             return None
 
+    async def _avatar_image(self, user):
+        try:
+            return await self._assets.get(str(user.avatar_url_as(format="png", size=128)))
+        except (aiohttp.ClientError, OSError):
+            return Image.open(f"{bundled_data_path(self)}/defaultavatar.png").convert("RGBA")
+
     @checks.admin_or_permissions(manage_guild=True)
     @lvladmin.command()
     @commands.guild_only()
@@ -1552,9 +1693,11 @@ class Leveler(commands.Cog):
         server = ctx.guild
         if await self.config.guild(server).disabled():
             await self.config.guild(server).disabled.set(False)
+            self._invalidate_settings(server)
             await ctx.send("**Leveler enabled on `{}`.**".format(server.name))
         else:
             await self.config.guild(server).disabled.set(True)
+            self._invalidate_settings(server)
             await ctx.send("**Leveler disabled on `{}`.**".format(server.name))
 
     @checks.admin_or_permissions(manage_guild=True)
@@ -1565,9 +1708,11 @@ class Leveler(commands.Cog):
         server = ctx.guild
         if await self.config.guild(server).text_only():
             await self.config.guild(server).text_only.set(False)
+            self._invalidate_settings(server)
             await ctx.send("**Text-only messages disabled for `{}`.**".format(server.name))
         else:
             await self.config.guild(server).text_only.set(True)
+            self._invalidate_settings(server)
             await ctx.send("**Text-only messages enabled for `{}`.**".format(server.name))
 
     @checks.admin_or_permissions(manage_guild=True)
@@ -1580,9 +1725,11 @@ class Leveler(commands.Cog):
 
         if await self.config.guild(server).lvl_msg():
             await self.config.guild(server).lvl_msg.set(False)
+            self._invalidate_settings(server)
             await ctx.send("**Level-up alerts disabled for `{}`.**".format(server.name))
         else:
             await self.config.guild(server).lvl_msg.set(True)
+            self._invalidate_settings(server)
             await ctx.send("**Level-up alerts enabled for `{}`.**".format(server.name))
 
     @checks.admin_or_permissions(manage_guild=True)
@@ -1593,9 +1740,11 @@ class Leveler(commands.Cog):
         server = ctx.guild
         if await self.config.guild(server).private_lvl_message():
             await self.config.guild(server).private_lvl_message.set(False)
+            self._invalidate_settings(server)
             await ctx.send("**Private level-up alerts disabled for `{}`.**".format(server.name))
         else:
             await self.config.guild(server).private_lvl_message.set(True)
+            self._invalidate_settings(server)
             await ctx.send("**Private level-up alerts enabled for `{}`.**".format(server.name))
 
     @lvladmin.command()
@@ -1605,6 +1754,7 @@ class Leveler(commands.Cog):
         Leaving the entries blank will reset the xp to the default."""
         if not (min_xp and max_xp):
             await self.config.xp.set([15, 20])
+            self._xp_range = None
             return await ctx.send("XP given has been reset to the default range of 15-20 xp per message.")
         elif not max_xp:
             return await ctx.send(f"Enter the values as a range: `{ctx.prefix}lvladmin xp 15 20`")
@@ -1618,8 +1768,111 @@ class Leveler(commands.Cog):
             return await ctx.send("The xp amounts can't be zero or less.")
         else:
             await self.config.xp.set([min_xp, max_xp])
+            self._xp_range = None
             await ctx.send(f"XP given has been set to a range of {min_xp} to {max_xp} xp per message.")
 
+    @lvladmin.command()
+    @checks.is_owner()
+    async def queuesize(self, ctx, size: int = 10000):
+        """Set how many messages can wait for exp processing before new ones are dropped."""
+        if size < 100:
+            return await ctx.send("The message queue needs to hold at least 100 messages.")
+        await self.config.message_queue_size.set(size)
+        self._message_queue_size = size
+        await ctx.send(f"Up to {size} messages will now be queued for exp processing.")
+
+    @lvladmin.command()
+    @checks.is_owner()
+    async def rendercache(self, ctx):
+        """Toggle keeping rendered cards on disk so they survive restarts."""
+        if await self.config.render_disk_cache():
+            await self.config.render_disk_cache.set(False)
+            self._render_cache.set_disk_path(None)
+            await ctx.send("Rendered cards will only be cached in memory.")
+        else:
+            await self.config.render_disk_cache.set(True)
+            self._render_cache.set_disk_path(cog_data_path(self) / "render_cache")
+            await ctx.send("Rendered cards will also be cached on disk.")
+
+    @lvladmin.command()
+    @checks.is_owner()
+    async def renderpool(self, ctx, workers: int = 2, mode: str = "thread"):
+        """Set how many cards are drawn at once, and whether in threads or processes.
+
+        `mode` is `thread` or `process`. Processes keep heavy renders off the
+        bot's process entirely, at the cost of sending images to the workers.
+        """
+        mode = mode.lower()
+        if mode not in ("thread", "process"):
+            return await ctx.send("**Mode must be `thread` or `process`.**")
+        if not 1 <= workers <= 16:
+            return await ctx.send("**Workers must be between 1 and 16.**")
+        await self.config.render_workers.set(workers)
+        await self.config.render_processes.set(mode == "process")
+        self._renderer.configure(workers, mode == "process")
+        await ctx.send(f"Cards will now be drawn by {workers} {mode} worker(s).")
+
+    @lvladmin.command()
+    @checks.is_owner()
+    async def stats(self, ctx):
+        """Show the message intake, cache and render pool counters since the cog was loaded."""
+        stats = [
+            ("Queue depth", f"{self._message_queue.qsize()}/{self._message_queue_size}"),
+            ("Peak depth", self._intake_stats["peak_depth"]),
+            ("Queued", self._intake_stats["queued"]),
+            ("Deduplicated", self._intake_stats["deduplicated"]),
+            ("Dropped (queue full)", self._intake_stats["dropped"]),
+            ("Render cache hits", self._render_cache.hits),
+            ("Render cache misses", self._render_cache.misses),
+            ("Image cache hits", self._assets.hits),
+            ("Image cache misses", self._assets.misses),
+            ("Image cache revalidated", self._assets.revalidated),
+            ("Image cache size", f"{self._assets.size // 1024} KiB"),
+            ("Render workers", f"{self._renderer.workers} ({'process' if self._renderer.processes else 'thread'})"),
+            ("Renders running", self._renderer.active),
+            ("Renders waiting", f"{self._renderer.waiting} (peak {self._renderer.peak_waiting})"),
+            ("Renders done", self._renderer.completed),
+            *(
+                (f"Global {name} board", f"{len(board.top)} shown, updated {board.age} in {board.refresh_time:.1f}s")
+                for name, board in self._boards.items()
+            ),
+            (
+                "Average render",
+                f"{self._renderer.render_time / self._renderer.completed * 1000:.0f} ms"
+                if self._renderer.completed
+                else "-",
+            ),
+        ]
+        await ctx.send(box(tabulate(stats, tablefmt="plain")))
+
+    @lvladmin.command(name="migrate")
+    @checks.is_owner()
+    async def migrate_members(self, ctx):
+        """Move server levels stored on user documents by older versions into the members collection.
+
+        Runs in the background while the bot keeps working, and is started on its own after an update."""
+        if self._migration is not None and not self._migration.done():
+            return await ctx.send(self._migration_text())
+        self._migration_progress = {"users": 0, "entries": 0, "total": 0}
+        self._start_member_migration(ctx.channel)
+
+    @lvladmin.command(name="indexes")
+    @checks.is_owner()
+    async def index_check(self, ctx):
+        """Report missing or unused database indexes and which common queries scan a whole collection."""
+        async with ctx.typing():
+            report = await indexes.index_report(self.db, self._backend.name)
+            plans = await indexes.explain_queries(self.db, str(ctx.guild.id if ctx.guild else 0), str(ctx.author.id))
+        msg = tabulate(report, headers=["Collection", "Index", "Status", "Uses"])
+        if self._index_failures:
+            msg += "\n\nFailed to build on startup:\n" + "\n".join(self._index_failures)
+        msg += "\n\n" + tabulate(
+            [(label, "COLLSCAN" if scan else "ok", stages) for label, stages, scan in plans],
+            headers=["Query", "", "Plan"],
+        )
+        for page in pagify(msg, shorten_by=10):
+            await ctx.send(box(page))
+
     @commands.group()
     @commands.guild_only()
     async def badges(self, ctx):
@@ -1840,6 +2093,26 @@ class Leveler(commands.Cog):
             await self.db.users.update_one({"user_id": userinfo["user_id"]}, {"$set": {"badges": {}}})
         return await self.db.users.find_one({"user_id": userinfo["user_id"]})
 
+    async def _update_badge_holders(self, ctx, badge_name: str, update: dict, done: str):
+        """Applies `update` to every user holding `badge_name` in one `update_many`, reporting how many and how long.
+
+        Holders are found through the wildcard index on the badges, so users without the badge are never read.
+        """
+        query = queries.badge_holders(badge_name)
+        start = time.perf_counter()
+        holders = await self.db.users.count_documents(query)
+        progress = None
+        if holders:
+            progress = await ctx.send(f"Updating the {holders} users holding `{badge_name}`...")
+        result = await self.db.users.update_many(query, update)
+        took = time.perf_counter() - start
+        log.info(f"Badge {badge_name}: updated {result.modified_count} of {holders} holders in {took:.2f}s")
+        summary = f"{done}\n{result.modified_count} users updated in {took:.1f}s."
+        if progress is None:
+            return await ctx.send(summary)
+        with contextlib.suppress(discord.HTTPException):
+            await progress.edit(content=summary)
+
     @checks.mod_or_permissions(manage_roles=True)
     @badges.command(name="add")
     @commands.guild_only()
@@ -1926,24 +2199,17 @@ class Leveler(commands.Cog):
         else:
             # update badge in the server
             badges["badges"][name] = new_badge
-            await self.db.badges.update_one({"server_id": serverid}, {"$set": {"badges": badges["badges"]}})
-
-            # go though all users and update the badge.
-            # Doing it this way because dynamic does more accesses when doing profile
-            async for user in self.db.users.find({}):
-                await asyncio.sleep(0)
-                try:
-                    user = await self._badge_convert_dict(user)
-                    userbadges = user["badges"]
-                    badge_name = "{}_{}".format(name, serverid)
-                    if badge_name in userbadges.keys():
-                        user_priority_num = userbadges[badge_name]["priority_num"]
-                        new_badge["priority_num"] = user_priority_num  # maintain old priority number set by user
-                        userbadges[badge_name] = new_badge
-                        await self.db.users.update_one({"user_id": user["user_id"]}, {"$set": {"badges": userbadges}})
-                except:
-                    pass
-            await ctx.send("**The `{}` badge has been updated.**".format(name))
+            await self.db.badges.update_one({"server_id": str(serverid)}, {"$set": {"badges": badges["badges"]}})
+            self._invalidate_rewards(server)
+
+            # users keep a copy of the badge, update every holder's but keep the priority they set
+            badge_name = "{}_{}".format(name, serverid)
+            await self._update_badge_holders(
+                ctx,
+                badge_name,
+                queries.badge_update(badge_name, new_badge),
+                "**The `{}` badge has been updated.**".format(name),
+            )
 
     @checks.is_owner()
     @badges.command(name="type")
@@ -1989,21 +2255,15 @@ class Leveler(commands.Cog):
             await self.db.badges.update_one(
                 {"server_id": serverbadges["server_id"]}, {"$set": {"badges": serverbadges["badges"]}},
             )
+            self._invalidate_rewards(server)
             # remove the badge if there
-            async for user_info_temp in self.db.users.find({}):
-                try:
-                    user_info_temp = await self._badge_convert_dict(user_info_temp)
-
-                    badge_name = "{}_{}".format(name, serverid)
-                    if badge_name in user_info_temp["badges"].keys():
-                        del user_info_temp["badges"][badge_name]
-                        await self.db.users.update_one(
-                            {"user_id": user_info_temp["user_id"]}, {"$set": {"badges": user_info_temp["badges"]}},
-                        )
-                except Exception as exc:
-                    log.error(f"Unable to delete badge {name} from {user_info_temp['user_id']}: {exc}")
-
-            await ctx.send("**The `{}` badge has been removed.**".format(name))
+            badge_name = "{}_{}".format(name, serverid)
+            await self._update_badge_holders(
+                ctx,
+                badge_name,
+                queries.badge_removal(badge_name),
+                "**The `{}` badge has been removed.**".format(name),
+            )
         else:
             await ctx.send("**That badge does not exist.**")
 
@@ -2115,6 +2375,7 @@ class Leveler(commands.Cog):
                 await self.db.badgelinks.update_one(
                     {"server_id": str(server.id)}, {"$set": {"badges": server_linked_badges["badges"]}},
                 )
+            self._invalidate_rewards(server)
             await ctx.send("**The `{}` badge has been linked to level `{}`.**".format(badge_name, level))
 
     @checks.admin_or_permissions(manage_roles=True)
@@ -2131,6 +2392,7 @@ class Leveler(commands.Cog):
             await ctx.send("**Badge/Level association `{}`/`{}` removed.**".format(badge_name, badge_links[badge_name]))
             del badge_links[badge_name]
             await self.db.badgelinks.update_one({"server_id": str(server.id)}, {"$set": {"badges": badge_links}})
+            self._invalidate_rewards(server)
         else:
             await ctx.send("**The `{}` badge is not linked to any levels!**".format(badge_name))
 
@@ -2196,6 +2458,7 @@ class Leveler(commands.Cog):
                 await self.db.roles.update_one(
                     {"server_id": str(server.id)}, {"$set": {"roles": server_roles["roles"]}}
                 )
+            self._invalidate_rewards(server)
 
             if remove_role is None:
                 await ctx.send("**The `{}` role has been linked to level `{}`**".format(role_name, level))
@@ -2218,6 +2481,7 @@ class Leveler(commands.Cog):
             await ctx.send("**Role/Level association `{}`/`{}` removed.**".format(role_name, roles[role_name]["level"]))
             del roles[role_name]
             await self.db.roles.update_one({"server_id": str(server.id)}, {"$set": {"roles": roles}})
+            self._invalidate_rewards(server)
         else:
             await ctx.send("**The `{}` role is not linked to any levels!**".format(role_name))
 
@@ -2251,6 +2515,36 @@ class Leveler(commands.Cog):
         em.description = msg
         await ctx.send(embed=em)
 
+    @rolelink.command(name="sync")
+    @commands.bot_has_permissions(manage_roles=True)
+    @commands.guild_only()
+    async def syncroles(self, ctx):
+        """Give every member the linked roles due for their level and remove the ones they have passed.
+
+        Runs in the background and keeps going after a restart."""
+        task = self._role_syncs.get(ctx.guild.id)
+        if task is not None and not task.done():
+            return await ctx.send("**A role sync is already running on this server.**")
+        resume = await self.config.guild(ctx.guild).role_sync() is not None
+        self._start_role_sync(ctx.guild, ctx.channel.id, resume=resume)
+        if resume:
+            await ctx.send("**Resuming the unfinished role sync.**")
+
+    @rolelink.command(name="syncstop")
+    @commands.guild_only()
+    async def syncroles_stop(self, ctx):
+        """Stop a running role sync."""
+        task = self._role_syncs.get(ctx.guild.id)
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+        checkpoint = await self.config.guild(ctx.guild).role_sync()
+        await self.config.guild(ctx.guild).role_sync.clear()
+        if checkpoint is None:
+            return await ctx.send("**No role sync is running on this server.**")
+        await ctx.send(self._role_sync_progress(checkpoint).replace("running", "stopped"))
+
     @lvladmin.group(name="bg")
     async def lvladminbg(self, ctx):
         """Background configuration."""
@@ -2264,7 +2558,7 @@ class Leveler(commands.Cog):
         backgrounds = await self.get_backgrounds()
         if name in backgrounds["profile"].keys():
             await ctx.send("**That profile background name already exists!**")
-        elif not await self._valid_image_url(url):
+        elif not await self._valid_image_url(url, CANVAS_SIZES["profile"]):
             await ctx.send("**That is not a valid image url!**")
         else:
             async with self.config.backgrounds() as backgrounds:
@@ -2279,7 +2573,7 @@ class Leveler(commands.Cog):
         backgrounds = await self.get_backgrounds()
         if name in backgrounds["profile"].keys():
             await ctx.send("**That rank background name already exists!**")
-        elif not await self._valid_image_url(url):
+        elif not await self._valid_image_url(url, CANVAS_SIZES["rank"]):
             await ctx.send("**That is not a valid image url!**")
         else:
             async with self.config.backgrounds() as backgrounds:
@@ -2294,7 +2588,7 @@ class Leveler(commands.Cog):
         backgrounds = await self.get_backgrounds()
         if name in backgrounds["levelup"].keys():
             await ctx.send("**That level-up background name already exists!**")
-        elif not await self._valid_image_url(url):
+        elif not await self._valid_image_url(url, CANVAS_SIZES["levelup"]):
             await ctx.send("**That is not a valid image url!**")
         else:
             async with self.config.backgrounds() as backgrounds:
@@ -2319,7 +2613,7 @@ class Leveler(commands.Cog):
             await ctx.send("**That is not a valid user id!**")
             return
 
-        if not await self._valid_image_url(img_url):
+        if not await self._valid_image_url(img_url, CANVAS_SIZES[type_input]):
             await ctx.send("**That is not a valid image url!**")
             return
 
@@ -2511,437 +2805,82 @@ class Leveler(commands.Cog):
     async def draw_profile(self, user, server):
         if not self._db_ready:
             return
-        font_file = f"{bundled_data_path(self)}/font.ttf"
-        font_bold_file = f"{bundled_data_path(self)}/font_bold.ttf"
-        font_unicode_file = f"{bundled_data_path(self)}/unicode.ttf"
-        # name_fnt = ImageFont.truetype(font_bold_file, 22, encoding="utf-8")
-        header_u_fnt = ImageFont.truetype(font_unicode_file, 18, encoding="utf-8")
-        # title_fnt = ImageFont.truetype(font_file, 18, encoding="utf-8")
-        sub_header_fnt = ImageFont.truetype(font_bold_file, 14, encoding="utf-8")
-        # badge_fnt = ImageFont.truetype(font_bold_file, 10, encoding="utf-8")
-        exp_fnt = ImageFont.truetype(font_bold_file, 14, encoding="utf-8")
-        # large_fnt = ImageFont.truetype(font_bold_file, 33, encoding="utf-8")
-        level_label_fnt = ImageFont.truetype(font_bold_file, 22, encoding="utf-8")
-        general_info_fnt = ImageFont.truetype(font_bold_file, 15, encoding="utf-8")
-        general_info_u_fnt = ImageFont.truetype(font_unicode_file, 12, encoding="utf-8")
-        rep_fnt = ImageFont.truetype(font_bold_file, 26, encoding="utf-8")
-        text_fnt = ImageFont.truetype(font_bold_file, 12, encoding="utf-8")
-        text_u_fnt = ImageFont.truetype(font_unicode_file, 8, encoding="utf-8")
-        # credit_fnt = ImageFont.truetype(font_bold_file, 10, encoding="utf-8")
-
-        def _write_unicode(text, init_x, y, font, unicode_font, fill):
-            write_pos = init_x
-
-            for char in text:
-                if char.isalnum() or char in string.punctuation or char in string.whitespace:
-                    draw.text((write_pos, y), "{}".format(char), font=font, fill=fill)
-                    write_pos += font.getsize(char)[0]
-                else:
-                    draw.text((write_pos, y), "{}".format(char), font=unicode_font, fill=fill)
-                    write_pos += unicode_font.getsize(char)[0]
-
         # get urls
         userinfo = await self.db.users.find_one({"user_id": str(user.id)})
+        memberinfo = await self._member_info(user, server)
         await self._badge_convert_dict(userinfo)
         bg_url = userinfo["profile_background"]
-        # profile_url = user.avatar_url
-
-        # create image objects
-        # bg_image = Image
-        # profile_image = Image
-
-        async with self.session.get(bg_url) as r:
-            image = await r.content.read()
-        profile_background = BytesIO(image)
-        profile_avatar = BytesIO()
-        try:
-            await user.avatar_url.save(profile_avatar, seek_begin=True)
-        except discord.HTTPException:
-            profile_avatar = f"{bundled_data_path(self)}/defaultavatar.png"
-
-        bg_image = Image.open(profile_background).convert("RGBA")
-        profile_image = Image.open(profile_avatar).convert("RGBA")
-
-        # set canvas
-        bg_color = (255, 255, 255, 0)
-        result = Image.new("RGBA", (290, 290), bg_color)
-        process = Image.new("RGBA", (290, 290), bg_color)
-
-        # draw
-        draw = ImageDraw.Draw(process)
-
-        # puts in background
-        bg_image = bg_image.resize((290, 290), Image.ANTIALIAS)
-        bg_image = bg_image.crop((0, 0, 290, 290))
-        result.paste(bg_image, (0, 0))
-
-        # draw filter
-        draw.rectangle([(0, 0), (290, 290)], fill=(0, 0, 0, 10))
-
-        # draw transparent overlay
-        vert_pos = 110
-        left_pos = 70
-        right_pos = 285
-        title_height = 22
-        # gap = 3
-
-        # determines rep section color
-        if "rep_color" not in userinfo.keys() or not userinfo["rep_color"]:
-            rep_fill = (92, 130, 203, 230)
-        else:
-            rep_fill = tuple(userinfo["rep_color"])
-        # determines badge section color, should be behind the titlebar
-        if "badge_col_color" not in userinfo.keys() or not userinfo["badge_col_color"]:
-            badge_fill = (128, 151, 165, 230)
-        else:
-            badge_fill = tuple(userinfo["badge_col_color"])
-
-        if "profile_info_color" in userinfo.keys():
-            info_color = tuple(userinfo["profile_info_color"])
-        else:
-            info_color = (30, 30, 30, 220)
-
-        draw.rectangle([(left_pos - 20, vert_pos + title_height), (right_pos, 156)], fill=info_color)  # title box
-        draw.rectangle([(100, 159), (285, 212)], fill=info_color)  # general content
-        draw.rectangle([(100, 215), (285, 285)], fill=info_color)  # info content
-
-        # stick in credits if needed
-        # if bg_url in bg_credits.keys():
-        # credit_text = "  ".join("Background by {}".format(bg_credits[bg_url]))
-        # credit_init = 290 - credit_fnt.getsize(credit_text)[0]
-        # draw.text((credit_init, 0), credit_text,  font=credit_fnt, fill=(0,0,0,100))
-        draw.rectangle(
-            [(5, vert_pos), (right_pos, vert_pos + title_height)], fill=(230, 230, 230, 230)
-        )  # name box in front
-
-        # draw level circle
-        multiplier = 8
-        lvl_circle_dia = 104
-        circle_left = 1
-        circle_top = 42
-        raw_length = lvl_circle_dia * multiplier
-
-        # create mask
-        mask = Image.new("L", (raw_length, raw_length), 0)
-        draw_thumb = ImageDraw.Draw(mask)
-        draw_thumb.ellipse((0, 0) + (raw_length, raw_length), fill=255, outline=0)
-
-        # drawing level bar calculate angle
-        start_angle = -90  # from top instead of 3oclock
-        angle = (
-            int(
-                360
-                * (
-                    userinfo["servers"][str(server.id)]["current_exp"]
-                    / self._required_exp(userinfo["servers"][str(server.id)]["level"])
-                )
-            )
-            + start_angle
-        )
-
-        # level outline
-        lvl_circle = Image.new("RGBA", (raw_length, raw_length))
-        draw_lvl_circle = ImageDraw.Draw(lvl_circle)
-        draw_lvl_circle.ellipse(
-            [0, 0, raw_length, raw_length],
-            fill=(badge_fill[0], badge_fill[1], badge_fill[2], 180),
-            outline=(255, 255, 255, 250),
-        )
-        # determines exp bar color
-        if "profile_exp_color" not in userinfo.keys() or not userinfo["profile_exp_color"]:
-            exp_fill = (255, 255, 255, 230)
-        else:
-            exp_fill = tuple(userinfo["profile_exp_color"])
-        draw_lvl_circle.pieslice(
-            [0, 0, raw_length, raw_length], start_angle, angle, fill=exp_fill, outline=(255, 255, 255, 255),
-        )
-        # put on level bar circle
-        lvl_circle = lvl_circle.resize((lvl_circle_dia, lvl_circle_dia), Image.ANTIALIAS)
-        lvl_bar_mask = mask.resize((lvl_circle_dia, lvl_circle_dia), Image.ANTIALIAS)
-        process.paste(lvl_circle, (circle_left, circle_top), lvl_bar_mask)
-
-        # draws boxes
-        draw.rectangle([(5, 133), (100, 285)], fill=badge_fill)  # badges
-        draw.rectangle([(10, 138), (95, 168)], fill=rep_fill)  # reps
-
-        total_gap = 10
-        # border = int(total_gap / 2)
-        profile_size = lvl_circle_dia - total_gap
-        # raw_length = profile_size * multiplier
-        # put in profile picture
-        total_gap = 6
-        border = int(total_gap / 2)
-        profile_size = lvl_circle_dia - total_gap
-        mask = mask.resize((profile_size, profile_size), Image.ANTIALIAS)
-        profile_image = profile_image.resize((profile_size, profile_size), Image.ANTIALIAS)
-        process.paste(profile_image, (circle_left + border, circle_top + border), mask)
-
-        # write label text
-        white_color = (240, 240, 240, 255)
-        light_color = (160, 160, 160, 255)
-
-        head_align = 105
-        _write_unicode(
-            self._truncate_text(self._name(user, 22), 22),
-            head_align,
-            vert_pos + 3,
-            level_label_fnt,
-            header_u_fnt,
-            (110, 110, 110, 255),
-        )  # NAME
-        _write_unicode(userinfo["title"], head_align, 136, level_label_fnt, header_u_fnt, white_color)
-
-        # draw level box
-        level_right = 290
-        level_left = level_right - 78
-        draw.rectangle(
-            [(level_left, 0), (level_right, 21)], fill=(badge_fill[0], badge_fill[1], badge_fill[2], 160),
-        )  # box
-        lvl_text = "LEVEL {}".format(userinfo["servers"][str(server.id)]["level"])
-        if badge_fill == (128, 151, 165, 230):
-            lvl_color = white_color
-        else:
-            lvl_color = self._contrast(badge_fill, rep_fill, exp_fill)
-        draw.text(
-            (self._center(level_left + 2, level_right, lvl_text, level_label_fnt), 2),
-            lvl_text,
-            font=level_label_fnt,
-            fill=(lvl_color[0], lvl_color[1], lvl_color[2], 255),
-        )  # Level #
-
-        rep_text = "{} REP".format(userinfo["rep"])
-        draw.text(
-            (self._center(7, 100, rep_text, rep_fnt), 144), rep_text, font=rep_fnt, fill=white_color,
-        )
-
-        exp_text = "{}/{}".format(
-            userinfo["servers"][str(server.id)]["current_exp"],
-            self._required_exp(userinfo["servers"][str(server.id)]["level"]),
-        )  # Exp
-        exp_color = exp_fill
-        draw.text((105, 99), exp_text, font=exp_fnt, fill=(exp_color[0], exp_color[1], exp_color[2], 255))  # Exp Text
-
-        # determine info text color
-        dark_text = (35, 35, 35, 230)
-        info_text_color = self._contrast(info_color, light_color, dark_text)
-
-        # lvl_left = 100
-        label_align = 105
-        _write_unicode("Rank:", label_align, 165, general_info_fnt, general_info_u_fnt, info_text_color)
-        draw.text((label_align, 180), "Exp:", font=general_info_fnt, fill=info_text_color)  # Exp
-        draw.text((label_align, 195), "Credits:", font=general_info_fnt, fill=info_text_color)  # Credits
-
-        # local stats
-        num_local_align = 172
-        # local_symbol = "\U0001F3E0 "
-        if "linux" in platform.system().lower():
-            local_symbol = "\U0001F3E0 "
-        else:
-            local_symbol = "S "
-
-        s_rank_txt = local_symbol + self._truncate_text(f"#{await self._find_server_rank(user, server)}", 8)
-        _write_unicode(
-            s_rank_txt,
-            num_local_align - general_info_u_fnt.getsize(local_symbol)[0],
-            165,
-            general_info_fnt,
-            general_info_u_fnt,
-            info_text_color,
-        )  # Rank
-
-        s_exp_txt = self._truncate_text(f"{await self._find_server_exp(user, server)}", 8)
-        _write_unicode(s_exp_txt, num_local_align, 180, general_info_fnt, general_info_u_fnt, info_text_color)  # Exp
-        credits = await bank.get_balance(user)
-        credit_txt = "${}".format(credits)
-        draw.text(
-            (num_local_align, 195), self._truncate_text(credit_txt, 18), font=general_info_fnt, fill=info_text_color,
-        )  # Credits
-
-        # global stats
-        num_align = 230
-        if "linux" in platform.system().lower():
-            global_symbol = "\U0001F30E "
-            fine_adjust = 1
-        else:
-            global_symbol = "G "
-            fine_adjust = 0
 
+        # everything drawn on the card, a repeat render with the same inputs is served from the cache
+        server_rank = await self._find_server_rank(user, server)
+        server_exp = memberinfo["exp"]
         global_rank = await self._find_global_rank(user)
-        rank_number = global_rank if global_rank else "1000+"
-        rank_txt = global_symbol + self._truncate_text(f"#{rank_number}", 8)
-        exp_txt = self._truncate_text(f"{userinfo['total_exp']}", 8)
-        _write_unicode(
-            rank_txt,
-            num_align - general_info_u_fnt.getsize(global_symbol)[0] + fine_adjust,
-            165,
-            general_info_fnt,
-            general_info_u_fnt,
-            info_text_color,
-        )  # Rank
-        _write_unicode(exp_txt, num_align, 180, general_info_fnt, general_info_u_fnt, info_text_color)  # Exp
-
-        draw.text((105, 220), "Info Box", font=sub_header_fnt, fill=white_color)  # Info Box
-        margin = 105
-        offset = 238
-        for line in textwrap.wrap(userinfo["info"], width=42):
-            await asyncio.sleep(0)
-            # draw.text((margin, offset), line, font=text_fnt, fill=(70,70,70,255))
-            _write_unicode(line, margin, offset, text_fnt, text_u_fnt, info_text_color)
-            offset += text_fnt.getsize(line)[1] + 2
+        credits = await bank.get_balance(user)
+        badge_type = await self.config.badge_type()
+        cache_key = content_key(
+            "profile",
+            bg_url,
+            str(user.avatar_url),
+            self._name(user, 22),
+            userinfo["title"],
+            userinfo["info"],
+            userinfo["rep"],
+            memberinfo["level"],
+            server_rank,
+            server_exp,
+            global_rank,
+            userinfo["total_exp"],
+            credits,
+            userinfo["badges"],
+            badge_type,
+            [userinfo.get(k) for k in ("rep_color", "badge_col_color", "profile_info_color", "profile_exp_color")],
+        )
+        filename = f"profile_{user.id}_{server.id}_{int(datetime.now().timestamp())}.png"
+        cached = await self._render_cache.get(cache_key)
+        if cached is not None:
+            return discord.File(BytesIO(cached), filename)
 
         # sort badges
         priority_badges = []
-
         for badgename in userinfo["badges"].keys():
-            await asyncio.sleep(0)
             badge = userinfo["badges"][badgename]
             priority_num = badge["priority_num"]
             if priority_num != 0 and priority_num != -1:
                 priority_badges.append((badge, priority_num))
         sorted_badges = sorted(priority_badges, key=operator.itemgetter(1), reverse=True)
-
-        # TODO: simplify this. it shouldn't be this complicated... sacrifices conciseness for customizability
-        if await self.config.badge_type() == "circles":
-            # circles require antialiasing
-            vert_pos = 171
-            right_shift = 0
-            left = 9 + right_shift
-            # right = 52 + right_shift
-            size = 27
-            total_gap = 4  # /2
-            hor_gap = 3
-            vert_gap = 2
-            border_width = int(total_gap / 2)
-            mult = [
-                (0, 0),
-                (1, 0),
-                (2, 0),
-                (0, 1),
-                (1, 1),
-                (2, 1),
-                (0, 2),
-                (1, 2),
-                (2, 2),
-                (0, 3),
-                (1, 3),
-                (2, 3),
-            ]
-            i = 0
-            for pair in sorted_badges[:12]:
-                try:
-                    coord = (
-                        left + int(mult[i][0]) * int(hor_gap + size),
-                        vert_pos + int(mult[i][1]) * int(vert_gap + size),
-                    )
-                    badge = pair[0]
-                    bg_color = badge["bg_img"]
-                    border_color = badge["border_color"]
-                    multiplier = 6  # for antialiasing
-                    raw_length = size * multiplier
-
-                    # draw mask circle
-                    mask = Image.new("L", (raw_length, raw_length), 0)
-                    draw_thumb = ImageDraw.Draw(mask)
-                    draw_thumb.ellipse((0, 0) + (raw_length, raw_length), fill=255, outline=0)
-
-                    # check image
-                    badge_image = await self._valid_image_url(bg_color)
-                    if not badge_image:
-                        continue
-
-                    badge_image = badge_image.resize((raw_length, raw_length), Image.ANTIALIAS)
-
-                    # structured like this because if border = 0, still leaves outline.
-                    if border_color:
-                        square = Image.new("RGBA", (raw_length, raw_length), border_color)
-                        # put border on ellipse/circle
-                        output = ImageOps.fit(square, (raw_length, raw_length), centering=(0.5, 0.5))
-                        output = output.resize((size, size), Image.ANTIALIAS)
-                        outer_mask = mask.resize((size, size), Image.ANTIALIAS)
-                        process.paste(output, coord, outer_mask)
-
-                        # put on ellipse/circle
-                        output = ImageOps.fit(badge_image, (raw_length, raw_length), centering=(0.5, 0.5))
-                        output = output.resize((size - total_gap, size - total_gap), Image.ANTIALIAS)
-                        inner_mask = mask.resize((size - total_gap, size - total_gap), Image.ANTIALIAS)
-                        process.paste(
-                            output, (coord[0] + border_width, coord[1] + border_width), inner_mask,
-                        )
-                    else:
-                        # put on ellipse/circle
-                        output = ImageOps.fit(badge_image, (raw_length, raw_length), centering=(0.5, 0.5))
-                        output = output.resize((size, size), Image.ANTIALIAS)
-                        outer_mask = mask.resize((size, size), Image.ANTIALIAS)
-                        process.paste(output, coord, outer_mask)
-                except:
-                    pass
-                i += 1
-        elif await self.config.badge_type() == "bars":
-            vert_pos = 187
-            i = 0
-            for pair in sorted_badges[:5]:
-                badge = pair[0]
-                bg_color = badge["bg_img"]
-                border_color = badge["border_color"]
-                left_pos = 10
-                right_pos = 95
-                total_gap = 4
-                border_width = int(total_gap / 2)
-                bar_size = (85, 15)
-
-                # check image
-                badge_image = await self._valid_image_url(bg_color)
-                if not badge_image:
-                    continue
-
-                if border_color is not None:
-                    draw.rectangle(
-                        [(left_pos, vert_pos + i * 17), (right_pos, vert_pos + 15 + i * 17)],
-                        fill=border_color,
-                        outline=border_color,
-                    )  # border
-                    badge_image = badge_image.resize(
-                        (bar_size[0] - total_gap + 1, bar_size[1] - total_gap + 1), Image.ANTIALIAS,
-                    )
-                    process.paste(
-                        badge_image, (left_pos + border_width, vert_pos + border_width + i * 17),
-                    )
-                else:
-                    badge_image = badge_image.resize(bar_size, Image.ANTIALIAS)
-                    process.paste(badge_image, (left_pos, vert_pos + i * 17))
-
-                vert_pos += 3  # spacing
-                i += 1
-
-        image_object = BytesIO()
-        result = Image.alpha_composite(result, process)
-        result.save(image_object, format="PNG")
-        image_object.seek(0)
-        return discord.File(image_object, f"profile_{user.id}_{server.id}_{int(datetime.now().timestamp())}.png")
-
-    # returns color that contrasts better in background
-    def _contrast(self, bg_color, color1, color2):
-        color1_ratio = self._contrast_ratio(bg_color, color1)
-        color2_ratio = self._contrast_ratio(bg_color, color2)
-        if color1_ratio >= color2_ratio:
-            return color1
-        else:
-            return color2
-
-    @staticmethod
-    def _luminance(color):
-        # convert to greyscale
-        luminance = float((0.2126 * color[0]) + (0.7152 * color[1]) + (0.0722 * color[2]))
-        return luminance
-
-    def _contrast_ratio(self, bgcolor, foreground):
-        f_lum = float(self._luminance(foreground) + 0.05)
-        bg_lum = float(self._luminance(bgcolor) + 0.05)
-
-        if bg_lum > f_lum:
-            return bg_lum / f_lum
-        else:
-            return f_lum / bg_lum
+        badges = []
+        for badge, _ in sorted_badges[: 12 if badge_type == "circles" else 5]:
+            badge_image = await self._valid_image_url(
+                badge["bg_img"], render.badge_size(badge_type, badge["border_color"])
+            )
+            if badge_image:
+                badges.append((badge_image, badge["border_color"]))
+
+        spec = render.ProfileSpec(
+            data_path=str(bundled_data_path(self)),
+            background=await self._assets.get(bg_url, CANVAS_SIZES["profile"]),
+            avatar=await self._avatar_image(user),
+            name=self._name(user, 22),
+            title=userinfo["title"],
+            info=userinfo["info"],
+            rep=userinfo["rep"],
+            level=memberinfo["level"],
+            current_exp=memberinfo["current_exp"],
+            server_rank=server_rank,
+            server_exp=server_exp,
+            global_rank=global_rank,
+            total_exp=userinfo["total_exp"],
+            credits=credits,
+            rep_color=userinfo.get("rep_color"),
+            badge_col_color=userinfo.get("badge_col_color"),
+            info_color=userinfo.get("profile_info_color"),
+            exp_color=userinfo.get("profile_exp_color"),
+            badge_type=badge_type,
+            badges=badges,
+        )
+        data = await self._renderer.run(render.render_profile, spec)
+        await self._render_cache.put(cache_key, data)
+        return discord.File(BytesIO(data), filename)
 
     # returns a string with possibly a nickname
     def _name(self, user, max_length):
@@ -2952,398 +2891,92 @@ class Leveler(commands.Cog):
                 user.name, self._truncate_text(user.display_name, max_length - len(user.name) - 3), max_length,
             )
 
-    @staticmethod
-    async def _add_dropshadow(image, offset=(4, 4), background=0x000, shadow=0x0F0, border=3, iterations=5):
-        totalWidth = image.size[0] + abs(offset[0]) + 2 * border
-        totalHeight = image.size[1] + abs(offset[1]) + 2 * border
-        back = Image.new(image.mode, (totalWidth, totalHeight), background)
-
-        # Place the shadow, taking into account the offset from the image
-        shadowLeft = border + max(offset[0], 0)
-        shadowTop = border + max(offset[1], 0)
-        back.paste(shadow, [shadowLeft, shadowTop, shadowLeft + image.size[0], shadowTop + image.size[1]])
-
-        n = 0
-        while n < iterations:
-            back = back.filter(ImageFilter.BLUR)
-            n += 1
-
-        # Paste the input image onto the shadow backdrop
-        imageLeft = border - min(offset[0], 0)
-        imageTop = border - min(offset[1], 0)
-        back.paste(image, (imageLeft, imageTop))
-        return back
-
     async def draw_rank(self, user, server):
-        # fonts
-        # font_file = f"{bundled_data_path(self)}/font.ttf"
-        font_bold_file = f"{bundled_data_path(self)}/font_bold.ttf"
-        font_unicode_file = f"{bundled_data_path(self)}/unicode.ttf"
-        name_fnt = ImageFont.truetype(font_bold_file, 22)
-        header_u_fnt = ImageFont.truetype(font_unicode_file, 18)
-        # sub_header_fnt = ImageFont.truetype(font_bold_file, 14)
-        # badge_fnt = ImageFont.truetype(font_bold_file, 12)
-        # large_fnt = ImageFont.truetype(font_bold_file, 33)
-        level_label_fnt = ImageFont.truetype(font_bold_file, 22)
-        general_info_fnt = ImageFont.truetype(font_bold_file, 15)
-        # general_info_u_fnt = ImageFont.truetype(font_unicode_file, 11)
-        # credit_fnt = ImageFont.truetype(font_bold_file, 10)
-
-        def _write_unicode(text, init_x, y, font, unicode_font, fill):
-            write_pos = init_x
-
-            for char in text:
-                if char.isalnum() or char in string.punctuation or char in string.whitespace:
-                    draw.text((write_pos, y), char, font=font, fill=fill)
-                    write_pos += font.getsize(char)[0]
-                else:
-                    draw.text((write_pos, y), "{}".format(char), font=unicode_font, fill=fill)
-                    write_pos += unicode_font.getsize(char)[0]
-
         userinfo = await self.db.users.find_one({"user_id": str(user.id)})
+        memberinfo = await self._member_info(user, server)
         # get urls
         bg_url = userinfo["rank_background"]
         server_icon_url = server.icon_url_as(format="png", size=256)
 
-        # guild icon image
-        if not server_icon_url._url:
-            server_icon = f"{bundled_data_path(self)}/defaultguildicon.png"
-        else:
-            server_icon = BytesIO()
-            try:
-                await server_icon_url.save(server_icon, seek_begin=True)
-            except discord.HTTPException:
-                server_icon = f"{bundled_data_path(self)}/defaultguildicon.png"
-
-        # rank bg image
-        async with self.session.get(bg_url) as r:
-            image = await r.content.read()
-        rank_background = BytesIO(image)
-
-        # user icon image
-        rank_avatar = BytesIO()
-        try:
-            await user.avatar_url.save(rank_avatar, seek_begin=True)
-        except discord.HTTPException:
-            rank_avatar = f"{bundled_data_path(self)}/defaultavatar.png"
-
-        # set all to RGBA
-        bg_image = Image.open(rank_background).convert("RGBA")
-        profile_image = Image.open(rank_avatar).convert("RGBA")
-        server_icon_image = Image.open(server_icon).convert("RGBA")
-
-        # set canvas
-        width = 360
-        height = 100
-        bg_color = (255, 255, 255, 0)
-        result = Image.new("RGBA", (width, height), bg_color)
-        process = Image.new("RGBA", (width, height), bg_color)
-
-        # puts in background
-        bg_image = bg_image.resize((width, height), Image.ANTIALIAS)
-        bg_image = bg_image.crop((0, 0, width, height))
-        result.paste(bg_image, (0, 0))
-
-        # draw
-        draw = ImageDraw.Draw(process)
-
-        # draw transparent overlay
-        vert_pos = 5
-        left_pos = 70
-        right_pos = width - vert_pos
-        title_height = 22
-        gap = 3
-
-        draw.rectangle(
-            [(left_pos - 20, vert_pos), (right_pos, vert_pos + title_height)], fill=(230, 230, 230, 230),
-        )  # title box
-        content_top = vert_pos + title_height + gap
-        content_bottom = 100 - vert_pos
-
-        if "rank_info_color" in userinfo.keys():
-            info_color = tuple(userinfo["rank_info_color"])
-            info_color = (
-                info_color[0],
-                info_color[1],
-                info_color[2],
-                160,
-            )  # increase transparency
-        else:
-            info_color = (30, 30, 30, 160)
-        draw.rectangle(
-            [(left_pos - 20, content_top), (right_pos, content_bottom)], fill=info_color, outline=(180, 180, 180, 180),
-        )  # content box
-
-        # stick in credits if needed
-        # if bg_url in bg_credits.keys():
-        # credit_text = " ".join("{}".format(bg_credits[bg_url]))
-        # draw.text((2, 92), credit_text,  font=credit_fnt, fill=(0,0,0,190))
-
-        # draw level circle
-        multiplier = 6
-        lvl_circle_dia = 94
-        circle_left = 15
-        circle_top = int((height - lvl_circle_dia) / 2)
-        raw_length = lvl_circle_dia * multiplier
-
-        # create mask
-        mask = Image.new("L", (raw_length, raw_length), 0)
-        draw_thumb = ImageDraw.Draw(mask)
-        draw_thumb.ellipse((0, 0) + (raw_length, raw_length), fill=255, outline=0)
-
-        # drawing level bar calculate angle
-        start_angle = -90  # from top instead of 3oclock
-        angle = (
-            int(
-                360
-                * (
-                    userinfo["servers"][str(server.id)]["current_exp"]
-                    / self._required_exp(userinfo["servers"][str(server.id)]["level"])
-                )
-            )
-            + start_angle
+        # everything drawn on the card, a repeat render with the same inputs is served from the cache
+        server_rank = await self._find_server_rank(user, server)
+        server_exp = memberinfo["exp"]
+        credits = await bank.get_balance(user)
+        cache_key = content_key(
+            "rank",
+            bg_url,
+            str(user.avatar_url),
+            str(server_icon_url),
+            self._name(user, 20),
+            memberinfo["level"],
+            server_rank,
+            server_exp,
+            credits,
+            [userinfo.get(k) for k in ("rank_info_color", "rank_exp_color")],
         )
+        filename = f"rank_{user.id}_{server.id}_{int(datetime.now().timestamp())}.png"
+        cached = await self._render_cache.get(cache_key)
+        if cached is not None:
+            return discord.File(BytesIO(cached), filename)
 
-        lvl_circle = Image.new("RGBA", (raw_length, raw_length))
-        draw_lvl_circle = ImageDraw.Draw(lvl_circle)
-        draw_lvl_circle.ellipse([0, 0, raw_length, raw_length], fill=(180, 180, 180, 180), outline=(255, 255, 255, 220))
-        # determines exp bar color
-        if "rank_exp_color" not in userinfo.keys() or not userinfo["rank_exp_color"]:
-            exp_fill = (255, 255, 255, 230)
-        else:
-            exp_fill = tuple(userinfo["rank_exp_color"])
-        draw_lvl_circle.pieslice(
-            [0, 0, raw_length, raw_length], start_angle, angle, fill=exp_fill, outline=(255, 255, 255, 230),
-        )
-        # put on level bar circle
-        lvl_circle = lvl_circle.resize((lvl_circle_dia, lvl_circle_dia), Image.ANTIALIAS)
-        lvl_bar_mask = mask.resize((lvl_circle_dia, lvl_circle_dia), Image.ANTIALIAS)
-        process.paste(lvl_circle, (circle_left, circle_top), lvl_bar_mask)
-
-        # draws mask
-        total_gap = 10
-        border = int(total_gap / 2)
-        profile_size = lvl_circle_dia - total_gap
-        raw_length = profile_size * multiplier
-        # put in profile picture
-        output = ImageOps.fit(profile_image, (raw_length, raw_length), centering=(0.5, 0.5))
-        output.resize((profile_size, profile_size), Image.ANTIALIAS)
-        mask = mask.resize((profile_size, profile_size), Image.ANTIALIAS)
-        profile_image = profile_image.resize((profile_size, profile_size), Image.ANTIALIAS)
-        process.paste(profile_image, (circle_left + border, circle_top + border), mask)
-
-        # draw level box
-        level_left = 274
-        level_right = right_pos
-        draw.rectangle([(level_left, vert_pos), (level_right, vert_pos + title_height)], fill="#AAA")  # box
-        lvl_text = "LEVEL {}".format(userinfo["servers"][str(server.id)]["level"])
-        draw.text(
-            (self._center(level_left, level_right, lvl_text, level_label_fnt), vert_pos + 3),
-            lvl_text,
-            font=level_label_fnt,
-            fill=(110, 110, 110, 255),
-        )  # Level #
-
-        # labels text colors
-        white_text = (240, 240, 240, 255)
-        dark_text = (35, 35, 35, 230)
-        label_text_color = self._contrast(info_color, white_text, dark_text)
-
-        # draw text
-        grey_color = (110, 110, 110, 255)
-        # white_color = (230, 230, 230, 255)
-
-        # put in server picture
-        server_size = content_bottom - content_top - 10
-        server_border_size = server_size + 4
-        radius = 20
-        light_border = (150, 150, 150, 180)
-        dark_border = (90, 90, 90, 180)
-        border_color = self._contrast(info_color, light_border, dark_border)
-
-        draw_server_border = Image.new(
-            "RGBA", (server_border_size * multiplier, server_border_size * multiplier), border_color,
-        )
-        draw_server_border = self._add_corners(draw_server_border, int(radius * multiplier / 2))
-        draw_server_border = draw_server_border.resize((server_border_size, server_border_size), Image.ANTIALIAS)
-        server_icon_image = server_icon_image.resize(
-            (server_size * multiplier, server_size * multiplier), Image.ANTIALIAS
-        )
-        server_icon_image = self._add_corners(server_icon_image, int(radius * multiplier / 2) - 10)
-        server_icon_image = server_icon_image.resize((server_size, server_size), Image.ANTIALIAS)
-        process.paste(
-            draw_server_border, (circle_left + profile_size + 2 * border + 8, content_top + 3), draw_server_border,
-        )
-        process.paste(
-            server_icon_image, (circle_left + profile_size + 2 * border + 10, content_top + 5), server_icon_image,
+        # guild icon image
+        server_icon_image = None
+        if server_icon_url._url:
+            try:
+                server_icon_image = await self._assets.get(str(server_icon_url))
+            except (aiohttp.ClientError, OSError):
+                pass
+        if server_icon_image is None:
+            server_icon_image = Image.open(f"{bundled_data_path(self)}/defaultguildicon.png").convert("RGBA")
+
+        spec = render.RankSpec(
+            data_path=str(bundled_data_path(self)),
+            background=await self._assets.get(bg_url, CANVAS_SIZES["rank"]),
+            avatar=await self._avatar_image(user),
+            server_icon=server_icon_image,
+            name=self._name(user, 20),
+            level=memberinfo["level"],
+            current_exp=memberinfo["current_exp"],
+            server_rank=server_rank,
+            server_exp=server_exp,
+            credits=credits,
+            info_color=userinfo.get("rank_info_color"),
+            exp_color=userinfo.get("rank_exp_color"),
         )
-
-        # name
-        left_text_align = 130
-        _write_unicode(
-            self._truncate_text(self._name(user, 20), 20),
-            left_text_align - 12,
-            vert_pos + 3,
-            name_fnt,
-            header_u_fnt,
-            grey_color,
-        )  # Name
-
-        # divider bar
-        draw.rectangle([(187, 45), (188, 85)], fill=(160, 160, 160, 220))
-
-        # labels
-        label_align = 200
-        draw.text((label_align, 38), "Server Rank:", font=general_info_fnt, fill=label_text_color)  # Server Rank
-        draw.text((label_align, 58), "Server Exp:", font=general_info_fnt, fill=label_text_color)  # Server Exp
-        draw.text((label_align, 78), "Credits:", font=general_info_fnt, fill=label_text_color)  # Credit
-        # info
-        right_text_align = 290
-        rank_txt = f"#{await self._find_server_rank(user, server)}"
-        draw.text(
-            (right_text_align, 38), self._truncate_text(rank_txt, 12), font=general_info_fnt, fill=label_text_color,
-        )  # Rank
-        exp_txt = f"{await self._find_server_exp(user, server)}"
-        draw.text(
-            (right_text_align, 58), self._truncate_text(exp_txt, 12), font=general_info_fnt, fill=label_text_color,
-        )  # Exp
-        credits = await bank.get_balance(user)
-        credit_txt = f"${credits}"
-        draw.text(
-            (right_text_align, 78), self._truncate_text(credit_txt, 12), font=general_info_fnt, fill=label_text_color,
-        )  # Credits
-
-        image_object = BytesIO()
-        result = Image.alpha_composite(result, process)
-        result.save(image_object, format="PNG")
-        image_object.seek(0)
-        return discord.File(image_object, f"rank_{user.id}_{server.id}_{int(datetime.now().timestamp())}.png")
-
-    @staticmethod
-    def _add_corners(im, rad, multiplier=6):
-        raw_length = rad * 2 * multiplier
-        circle = Image.new("L", (raw_length, raw_length), 0)
-        draw = ImageDraw.Draw(circle)
-        draw.ellipse((0, 0, raw_length, raw_length), fill=255)
-        circle = circle.resize((rad * 2, rad * 2), Image.ANTIALIAS)
-
-        alpha = Image.new("L", im.size, 255)
-        w, h = im.size
-        alpha.paste(circle.crop((0, 0, rad, rad)), (0, 0))
-        alpha.paste(circle.crop((0, rad, rad, rad * 2)), (0, h - rad))
-        alpha.paste(circle.crop((rad, 0, rad * 2, rad)), (w - rad, 0))
-        alpha.paste(circle.crop((rad, rad, rad * 2, rad * 2)), (w - rad, h - rad))
-        im.putalpha(alpha)
-        return im
+        data = await self._renderer.run(render.render_rank, spec)
+        await self._render_cache.put(cache_key, data)
+        return discord.File(BytesIO(data), filename)
 
     async def draw_levelup(self, user, server):
         if not self._db_ready:
             return
-        font_bold_file = f"{bundled_data_path(self)}/font_bold.ttf"
         userinfo = await self.db.users.find_one({"user_id": str(user.id)})
+        level = (await self._member_info(user, server))["level"]
         # get urls
         bg_url = userinfo["levelup_background"]
-        # profile_url = user.avatar_url
 
-        # create image objects
-        # bg_image = Image
-        # profile_image = Image
-
-        async with self.session.get(bg_url) as r:
-            image = await r.content.read()
-
-        level_background = BytesIO(image)
-        level_avatar = BytesIO()
-        try:
-            await user.avatar_url.save(level_avatar, seek_begin=True)
-        except discord.HTTPException:
-            level_avatar = f"{bundled_data_path(self)}/defaultavatar.png"
-
-        bg_image = Image.open(level_background).convert("RGBA")
-        profile_image = Image.open(level_avatar).convert("RGBA")
-
-        # set canvas
-        width = 175
-        height = 65
-        bg_color = (255, 255, 255, 0)
-        result = Image.new("RGBA", (width, height), bg_color)
-        process = Image.new("RGBA", (width, height), bg_color)
-
-        # draw
-        draw = ImageDraw.Draw(process)
-
-        # puts in background
-        bg_image = bg_image.resize((width, height), Image.ANTIALIAS)
-        bg_image = bg_image.crop((0, 0, width, height))
-        result.paste(bg_image, (0, 0))
-
-        # draw transparent overlay
-        if "levelup_info_color" in userinfo.keys():
-            info_color = tuple(userinfo["levelup_info_color"])
-            info_color = (
-                info_color[0],
-                info_color[1],
-                info_color[2],
-                150,
-            )  # increase transparency
-        else:
-            info_color = (30, 30, 30, 150)
-        draw.rectangle([(38, 5), (170, 60)], fill=info_color)  # info portion
-
-        # draw level circle
-        multiplier = 6
-        lvl_circle_dia = 60
-        circle_left = 4
-        circle_top = int((height - lvl_circle_dia) / 2)
-        raw_length = lvl_circle_dia * multiplier
-
-        # create mask
-        mask = Image.new("L", (raw_length, raw_length), 0)
-        draw_thumb = ImageDraw.Draw(mask)
-        draw_thumb.ellipse((0, 0) + (raw_length, raw_length), fill=255, outline=0)
-
-        # drawing level bar calculate angle
-        # start_angle = -90  # from top instead of 3oclock
-
-        lvl_circle = Image.new("RGBA", (raw_length, raw_length))
-        draw_lvl_circle = ImageDraw.Draw(lvl_circle)
-        draw_lvl_circle.ellipse([0, 0, raw_length, raw_length], fill=(255, 255, 255, 220), outline=(255, 255, 255, 220))
-
-        # put on level bar circle
-        lvl_circle = lvl_circle.resize((lvl_circle_dia, lvl_circle_dia), Image.ANTIALIAS)
-        lvl_bar_mask = mask.resize((lvl_circle_dia, lvl_circle_dia), Image.ANTIALIAS)
-        process.paste(lvl_circle, (circle_left, circle_top), lvl_bar_mask)
-
-        # draws mask
-        total_gap = 6
-        border = int(total_gap / 2)
-        profile_size = lvl_circle_dia - total_gap
-        raw_length = profile_size * multiplier
-        # put in profile picture
-        output = ImageOps.fit(profile_image, (raw_length, raw_length), centering=(0.5, 0.5))
-        # output = output.resize((profile_size, profile_size), Image.ANTIALIAS)
-        mask = mask.resize((profile_size, profile_size), Image.ANTIALIAS)
-        profile_image = profile_image.resize((profile_size, profile_size), Image.ANTIALIAS)
-        process.paste(profile_image, (circle_left + border, circle_top + border), mask)
-
-        # fonts
-        # level_fnt2 = ImageFont.truetype(font_bold_file, 19)
-        level_fnt = ImageFont.truetype(font_bold_file, 26)
-
-        # write label text
-        white_text = (240, 240, 240, 255)
-        dark_text = (35, 35, 35, 230)
-        level_up_text = self._contrast(info_color, white_text, dark_text)
-        lvl_text = "LEVEL {}".format(userinfo["servers"][str(server.id)]["level"])
-        draw.text(
-            (self._center(50, 170, lvl_text, level_fnt), 22), lvl_text, font=level_fnt, fill=level_up_text,
-        )  # Level Number
-
-        image_object = BytesIO()
-        result = Image.alpha_composite(result, process)
-        result.save(image_object, format="PNG")
-        image_object.seek(0)
-        return discord.File(image_object, f"levelup_{user.id}_{server.id}_{int(datetime.now().timestamp())}.png")
+        cache_key = content_key(
+            "levelup",
+            bg_url,
+            str(user.avatar_url),
+            level,
+            userinfo.get("levelup_info_color"),
+        )
+        filename = f"levelup_{user.id}_{server.id}_{int(datetime.now().timestamp())}.png"
+        cached = await self._render_cache.get(cache_key)
+        if cached is not None:
+            return discord.File(BytesIO(cached), filename)
+
+        spec = render.LevelupSpec(
+            data_path=str(bundled_data_path(self)),
+            background=await self._assets.get(bg_url, CANVAS_SIZES["levelup"]),
+            avatar=await self._avatar_image(user),
+            level=level,
+            info_color=userinfo.get("levelup_info_color"),
+        )
+        data = await self._renderer.run(render.render_levelup, spec)
+        await self._render_cache.put(cache_key, data)
+        return discord.File(BytesIO(data), filename)
 
     @commands.Cog.listener("on_message_without_command")
     async def _handle_on_message(self, message):
@@ -3351,14 +2984,41 @@ class Leveler(commands.Cog):
         user = message.author
         if not server or user.bot:
             return
-        if await self.config.guild(server).disabled():
+        if (await self._guild_settings(server)).disabled:
+            return
+        # only one award per cooldown can succeed, so one queued message per (user, server) is enough
+        key = (user.id, server.id)
+        if key in self._queued_keys:
+            self._intake_stats["deduplicated"] += 1
+            return
+        text = message.content
+        if len(text) <= 10:
+            return
+        prefix = await self.bot.command_prefix(self.bot, message)
+        if any(text.startswith(x) for x in prefix):
+            return
+        if self._message_queue.qsize() >= self._message_queue_size:
+            self._intake_stats["dropped"] += 1
             return
-        self._message_tasks.append([user, server, message])  # Add to task list
+        self._queued_keys.add(key)
+        self._message_queue.put_nowait(
+            QueuedMessage(user.id, server.id, message.channel.id, self._hash_message(text), time.time())
+        )
+        self._intake_stats["queued"] += 1
+        self._intake_stats["peak_depth"] = max(self._intake_stats["peak_depth"], self._message_queue.qsize())
+
+    @staticmethod
+    def _hash_message(text: str):
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
 
     async def process_tasks(self):  # Run all tasks and resets task list
         log.debug("_process_tasks is starting for batch xp writing")
         log.debug(f"DB ready state: {self._db_ready}")
         await self.bot.wait_until_red_ready()
+        await self._load_runtime_settings()
+        await self._resume_role_syncs()
+        if not await self.config.members_migrated():
+            self._start_member_migration()
         with contextlib.suppress(asyncio.CancelledError):
             while True:
                 if not self._db_ready:
@@ -3366,186 +3026,254 @@ class Leveler(commands.Cog):
                     await asyncio.sleep(5)
                     log.debug("_process_tasks is trying to connect again")
                     continue
-                tasks = copy(self._message_tasks)
-                self._message_tasks = []
-                for a in tasks:
+                while not self._message_queue.empty():
+                    queued = self._message_queue.get_nowait()
+                    self._queued_keys.discard((queued.author_id, queued.guild_id))
                     try:
-                        await self._process_user_on_message(*a)
-                        await asyncio.sleep(0.1)
+                        await self._process_user_on_message(queued)
                     except asyncio.CancelledError:
                         raise asyncio.CancelledError
                     except Exception as err:
                         log.error(
-                            f"Error while giving XP to {a[0]}({a[0].id}) in {a[1]}({a[1].id})", exc_info=err,
+                            f"Error while giving XP to {queued.author_id} in {queued.guild_id}", exc_info=err,
                         )
+                self._prune_chat_blocks()
+                self._prune_known_users()
+                try:
+                    await self._flush_pending_exp()
+                except asyncio.CancelledError:
+                    raise asyncio.CancelledError
+                except Exception as err:
+                    log.error("Error while writing the batched XP", exc_info=err)
                 log.debug("Process task sleeping for 30 seconds")
                 await asyncio.sleep(30)
 
-    async def _process_user_on_message(self, user, server, message):  # Process a users message
+    async def _process_user_on_message(self, queued: QueuedMessage):  # Process a users message
         if not self._db_ready:
             log.debug("process_user_on_message has exited early because db is not ready")
             return
-        text = message.content
-        curr_time = time.time()
+        server = self.bot.get_guild(queued.guild_id)
+        user = server and server.get_member(queued.author_id)
+        channel = server and server.get_channel(queued.channel_id)
+        if not (user and channel):
+            return
         log.debug(f"Processing {user} {server}")
-        prefix = await self.bot.command_prefix(self.bot, message)
-        # creates user if doesn't exist, bots are not logged.
-        userinfo = await self._create_user(user, server)
-        if not userinfo:
+        # users still on cooldown are rejected from memory, without touching the db
+        cached_block = self._chat_blocks.get(user.id)
+        if cached_block and not self._chat_block_passed(queued, *cached_block):
+            log.debug(f"{user} {server}'s message DOES NOT qualify for xp awarding (cached cooldown)")
             return
-        user_id = f"{user.id}"
-        userinfo = await self.db.users.find_one({"user_id": user_id})
-        # check if chat_block exists
-        if "chat_block" not in userinfo:
-            userinfo["chat_block"] = 0
-        if "last_message" not in userinfo:
-            userinfo["last_message"] = 0
+        # creates user if doesn't exist, bots are not logged.
+        userinfo = await self._create_user(user, server, fetch=not cached_block)
+        if not cached_block:
+            if not userinfo:
+                return
+            # rebuilt lazily from the stored document, e.g. after a restart
+            cached_block = (userinfo.get("chat_block", 0), userinfo.get("last_message", ""))
+            self._chat_blocks[user.id] = cached_block
         await asyncio.sleep(0)
         if all(
             [
-                float(curr_time) - float(userinfo["chat_block"]) >= 120,
-                not any(text.startswith(x) for x in prefix),
-                len(message.content) > 10,
-                message.content != userinfo["last_message"],
-                message.channel.id not in await self.config.guild(server).ignored_channels(),
+                self._chat_block_passed(queued, *cached_block),
+                channel.id not in (await self._guild_settings(server)).ignored_channels,
             ]
         ):
             log.debug(f"{user} {server}'s message qualifies for xp awarding")
-            await asyncio.sleep(0)
-            xp = await self.config.xp()
-            await self._process_exp(message, server, userinfo, random.randint(xp[0], xp[1]))
-            await asyncio.sleep(0)
-            await self._give_chat_credit(user, server)
+            xp_range = await self._get_xp_range()
+            exp = random.randint(xp_range[0], xp_range[1])
+            self._add_pending_exp(user, server, channel, queued, exp, await self._chat_credit(server))
         else:
             log.debug(f"{user} {server}'s message DOES NOT qualify for xp awarding")
 
-    async def _process_exp(self, message, server, userinfo, exp: int):
-        if not self._db_ready:
-            log.debug("process_exp has exited early because db is not ready")
-            return
-        server = message.guild if not None else server
-        if not server:
-            log.warning("Leveler is in _process_exp: server and message.guild are both None, skipping")
-            return
-        if not message.guild:
-            log.warning(f"Leveler is in _process_exp and message.guild is None, trying {server}")
-        channel = message.channel
-        user = message.author
-        # add to total exp
-        try:
-            required = self._required_exp(userinfo["servers"][str(server.id)]["level"])
-        except Exception as e:
-            log.warning(f"Error while determining XP for {user} in {server}\n", exc_info=e)
-        try:
-            await self.db.users.update_one(
-                {"user_id": str(user.id)}, {"$set": {"total_exp": userinfo["total_exp"] + exp}}
-            )
-            await asyncio.sleep(0)
-        except Exception as e:
-            log.warning(f"Could not add XP to {user}!\n", exc_info=e)
-        if userinfo["servers"][str(server.id)]["current_exp"] + exp >= required:
-            await asyncio.sleep(0)
-            userinfo["servers"][str(server.id)]["level"] += 1
-            await self.db.users.update_one(
-                {"user_id": str(user.id)},
-                {
-                    "$set": {
-                        f"servers.{server.id}.level": userinfo["servers"][str(server.id)]["level"],
-                        f"servers.{server.id}.current_exp": userinfo["servers"][str(server.id)]["current_exp"]
-                        + exp
-                        - required,
-                        "chat_block": time.time(),
-                        "last_message": message.content,
-                    }
-                },
+    @staticmethod
+    def _chat_block_passed(queued: QueuedMessage, chat_block: float, last_message: str):
+        return float(queued.timestamp) - float(chat_block) >= 120 and queued.content_hash != last_message
+
+    def _prune_chat_blocks(self):
+        """Forgets cached cooldowns that have run out, the db is read again on the next message."""
+        curr_time = time.time()
+        self._chat_blocks = {
+            user_id: block for user_id, block in self._chat_blocks.items() if curr_time - float(block[0]) < 120
+        }
+
+    def _add_pending_exp(self, user, server, channel, queued: QueuedMessage, exp: int, credits: int):
+        """Adds exp and chat credits to the (user, server) accumulator written by `_flush_pending_exp`."""
+        pending = self._pending_exp.setdefault(
+            (user.id, server.id), {"exp": 0, "credits": 0, "user": user, "server": server}
+        )
+        pending["exp"] += exp
+        pending["credits"] += credits
+        pending["channel"] = channel
+        pending["chat_block"] = queued.timestamp
+        pending["last_message"] = queued.content_hash
+        self._chat_blocks[user.id] = (queued.timestamp, queued.content_hash)
+
+    async def _flush_pending_exp(self):
+        """Writes all accumulated exp with one atomic update per (user, server), then handles levelups.
+
+        The level overflow is worked out by the members update itself, and the entry it returns is the one
+        from just before the award, so levelups are detected without reading anything first and concurrent
+        writers (e.g. other shards) cannot lose each other's exp. Those updates go out `FLUSH_CONCURRENCY`
+        at a time; an award whose users write can't be made is taken back off the member entry.
+        """
+        if not self._pending_exp:
+            return
+        pending, self._pending_exp = self._pending_exp, {}
+
+        items = list(pending.items())
+        befores = []
+        for start in range(0, len(items), FLUSH_CONCURRENCY):
+            befores += await asyncio.gather(
+                *(
+                    self._award_exp(user_id, server_id, award)
+                    for (user_id, server_id), award in items[start : start + FLUSH_CONCURRENCY]
+                ),
+                return_exceptions=True,
             )
-            await asyncio.sleep(0)
-            await self._handle_levelup(user, userinfo, server, channel)
-        else:
-            await self.db.users.update_one(
-                {"user_id": str(user.id)},
-                {
-                    "$set": {
-                        f"servers.{server.id}.current_exp": userinfo["servers"][str(server.id)]["current_exp"] + exp,
-                        "chat_block": time.time(),
-                        "last_message": message.content,
-                    }
-                },
+        awarded = []
+        for ((user_id, server_id), award), before in zip(items, befores):
+            if isinstance(before, Exception):
+                log.error(f"Error while giving {award['exp']} XP to {user_id} in {server_id}", exc_info=before)
+                continue
+            if before is None:
+                log.warning(f"Dropping {award['exp']} XP for {user_id} in {server_id}: no stored member")
+                continue
+            awarded.append((user_id, server_id, award, before))
+
+        written = await self._write_user_awards(awarded)
+        awarded = [entry for entry, ok in zip(awarded, written) if ok]
+        levelups = []
+        for _, _, award, before in awarded:
+            level = xp.find_level(before["exp"] + award["exp"])
+            if level > before["level"]:
+                levelups.append((award, level))
+        log.debug(f"Flushed {len(awarded)} XP awards, {len(levelups)} levelups")
+
+        # dropped awards don't pay out either
+        for _, _, award, _ in awarded:
+            if award["credits"]:
+                try:
+                    await bank.deposit_credits(award["user"], award["credits"])
+                except Exception as err:
+                    log.error(f"Error while giving chat credits to {award['user']}", exc_info=err)
+
+        for award, level in levelups:
+            try:
+                await self._handle_levelup(award["user"], level, award["server"], award["channel"])
+            except Exception as err:
+                log.error(f"Error while handling the levelup of {award['user']} in {award['server']}", exc_info=err)
+
+    async def _write_user_awards(self, awarded) -> List[bool]:
+        """Adds each award to its user's total_exp in one bulk write, returning which of them were written.
+
+        Requests that fail are retried one by one. A retry only matches a user whose chat_block isn't the
+        award's yet, so one the bulk write did apply isn't counted twice. Awards still failing after that
+        are removed from the member entry again, which keeps total_exp and the server exp in step.
+        """
+        if not awarded:
+            return []
+        updates = [
+            {
+                "$inc": {"total_exp": award["exp"]},
+                "$set": {"chat_block": award["chat_block"], "last_message": award["last_message"]},
+            }
+            for _, _, award, _ in awarded
+        ]
+        try:
+            await self.db.users.bulk_write(
+                [UpdateOne({"user_id": str(user_id)}, update) for (user_id, *_), update in zip(awarded, updates)],
+                ordered=False,
             )
-            log.debug("process_exp has written the exp")
+            return [True] * len(awarded)
+        except mongoerrors.BulkWriteError as err:
+            retry = {error["index"] for error in err.details.get("writeErrors", ())}
+        except Exception as err:
+            log.warning(f"Writing {len(awarded)} XP awards to users failed, retrying one by one", exc_info=err)
+            retry = set(range(len(awarded)))
+
+        written = []
+        for i, ((user_id, server_id, award, _), update) in enumerate(zip(awarded, updates)):
+            if i not in retry:
+                written.append(True)
+                continue
+            try:
+                await self.db.users.update_one(
+                    {"user_id": str(user_id), "chat_block": {"$ne": award["chat_block"]}}, update
+                )
+            except Exception as err:
+                log.error(f"Error while adding {award['exp']} XP to the total of {user_id}", exc_info=err)
+                written.append(False)
+                try:
+                    await self._award_exp(user_id, server_id, {**award, "exp": -award["exp"]})
+                except Exception as exc:
+                    log.error(f"Could not take back {award['exp']} XP from {user_id} in {server_id}", exc_info=exc)
+            else:
+                written.append(True)
+        return written
+
+    async def _award_exp(self, user_id: int, server_id: int, award: dict):
+        """Adds `award` to the member's exp and levels them on the server, returning the entry from before."""
+        return await self.db.members.find_one_and_update(
+            {"server_id": str(server_id), "user_id": str(user_id)},
+            queries.award_pipeline(award["exp"], award["user"].name),
+            projection={"_id": 0, "level": 1, "exp": 1},
+        )
 
-    async def _handle_levelup(self, user, userinfo, server, channel):
+    async def _handle_levelup(self, user, level: int, server, channel):
         if not self._db_ready:
             log.debug("_handle_levelup has exited early because db is not ready")
             return
+        settings = await self._guild_settings(server)
         # channel lock implementation
-        lock_channel_id = await self.config.guild(server).lvl_msg_lock()
+        lock_channel_id = settings.lvl_msg_lock
         if lock_channel_id:
             lock_channel = self.bot.get_channel(lock_channel_id)
             if not lock_channel:
                 await self.config.guild(server).lvl_msg_lock.set(None)
+                self._invalidate_settings(server)
             else:
                 channel = lock_channel
 
         server_identifier = ""  # super hacky
         name = await self._is_mention(user)  # also super hacky
         # private message takes precedent, of course
-        if await self.config.guild(server).private_lvl_message():
+        if settings.private_lvl_message:
             server_identifier = f" on {server.name}"
             channel = user
             name = "You"
 
-        new_level = str(userinfo["servers"][str(server.id)]["level"])
+        new_level = str(level)
         self.bot.dispatch("leveler_levelup", user, new_level)
         # add to appropriate role if necessary
-        # try:
-        server_roles = await self.db.roles.find_one({"server_id": str(server.id)})
-        await asyncio.sleep(0)
-        if server_roles is not None:
-            for role in server_roles["roles"].keys():
-                await asyncio.sleep(0)
-                if int(server_roles["roles"][role]["level"]) == int(new_level):
-                    await asyncio.sleep(0)
-                    add_role = discord.utils.get(server.roles, name=role)
-                    if add_role is not None:
-                        await asyncio.sleep(0)
-                        try:
-                            await user.add_roles(add_role, reason="Levelup")
-                        except discord.Forbidden:
-                            await channel.send("Levelup role adding failed: Missing Permissions")
-                        except discord.HTTPException:
-                            await channel.send("Levelup role adding failed")
-                    remove_role = discord.utils.get(server.roles, name=server_roles["roles"][role]["remove_role"])
-                    if remove_role is not None:
-                        await asyncio.sleep(0)
-                        try:
-                            await user.remove_roles(remove_role, reason="Levelup")
-                        except discord.Forbidden:
-                            await channel.send("Levelup role removal failed: Missing Permissions")
-                        except discord.HTTPException:
-                            await channel.send("Levelup role removal failed")
-        try:
-            server_linked_badges = await self.db.badgelinks.find_one({"server_id": str(server.id)})
-            await asyncio.sleep(0)
-            if server_linked_badges is not None:
-                for badge_name in server_linked_badges["badges"]:
-                    await asyncio.sleep(0)
-                    if int(server_linked_badges["badges"][badge_name]) == int(new_level):
-                        server_badges = await self.db.badges.find_one({"server_id": str(server.id)})
-                        await asyncio.sleep(0)
-                        if server_badges is not None and badge_name in server_badges["badges"].keys():
-                            await asyncio.sleep(0)
-                            userinfo_db = await self.db.users.find_one({"user_id": str(user.id)})
-                            new_badge_name = "{}_{}".format(badge_name, server.id)
-                            userinfo_db["badges"][new_badge_name] = server_badges["badges"][badge_name]
-                            await self.db.users.update_one(
-                                {"user_id": str(user.id)}, {"$set": {"badges": userinfo_db["badges"]}},
-                            )
-        except Exception as exc:
-            await channel.send(f"Error. Badge was not given: {exc}")
+        rewards = (await self._level_rewards(server)).get(level)
+        if rewards is not None:
+            add_roles = [role for role in map(server.get_role, rewards.add_roles) if role is not None]
+            if add_roles:
+                try:
+                    await user.add_roles(*add_roles, reason="Levelup")
+                except discord.Forbidden:
+                    await channel.send("Levelup role adding failed: Missing Permissions")
+                except discord.HTTPException:
+                    await channel.send("Levelup role adding failed")
+            remove_roles = [role for role in map(server.get_role, rewards.remove_roles) if role is not None]
+            if remove_roles:
+                try:
+                    await user.remove_roles(*remove_roles, reason="Levelup")
+                except discord.Forbidden:
+                    await channel.send("Levelup role removal failed: Missing Permissions")
+                except discord.HTTPException:
+                    await channel.send("Levelup role removal failed")
+            if rewards.badges:
+                try:
+                    await self.db.users.update_one(
+                        {"user_id": str(user.id)},
+                        {"$set": {f"badges.{name}_{server.id}": badge for name, badge in rewards.badges.items()}},
+                    )
+                except Exception as exc:
+                    await channel.send(f"Error. Badge was not given: {exc}")
 
-        if await self.config.guild(server).lvl_msg():  # if lvl msg is enabled
-            if await self.config.guild(server).text_only():
+        if settings.lvl_msg:  # if lvl msg is enabled
+            if settings.text_only:
                 if all(
                     [channel.permissions_for(server.me).send_messages, channel.permissions_for(server.me).embed_links,]
                 ):
@@ -3567,163 +3295,402 @@ class Leveler(commands.Cog):
                             "**{} just gained a level{}!**".format(name, server_identifier), file=file,
                         )
 
+    # catch-up role sync: levelups only hand out the rewards of the exact level reached, so anyone
+    # whose level was imported, set by hand or reached while the bot was down is missing roles
+    @staticmethod
+    def _linked_roles_at(index: Dict[int, LevelRewards], level: int):
+        """Linked roles a member at `level` should have and should not have, replaying links in level order."""
+        due, obsolete = set(), set()
+        for linked_level in sorted(lvl for lvl in index if lvl <= level):
+            rewards = index[linked_level]
+            due -= rewards.remove_roles
+            obsolete |= rewards.remove_roles
+            due |= rewards.add_roles
+            obsolete -= rewards.add_roles
+        return frozenset(due), frozenset(obsolete)
+
+    def _start_role_sync(self, server, channel_id: Optional[int] = None, resume: bool = False):
+        """Start (or restart) the background role sync of `server`, unless one is already running."""
+        task = self._role_syncs.get(server.id)
+        if task is not None and not task.done():
+            return task
+        task = asyncio.create_task(self._sync_guild_roles(server, channel_id, resume))
+        task.add_done_callback(self._task_error_logger)
+        task.add_done_callback(lambda _: self._role_syncs.pop(server.id, None))
+        self._role_syncs[server.id] = task
+        return task
+
+    async def _resume_role_syncs(self):
+        for guild_id, data in (await self.config.all_guilds()).items():
+            checkpoint = data.get("role_sync")
+            server = self.bot.get_guild(guild_id)
+            if checkpoint and server is not None:
+                log.info(f"Resuming the role sync of {server}({server.id}) after {checkpoint['last_user']}")
+                self._start_role_sync(server, checkpoint["channel_id"], resume=True)
+
+    async def _sync_guild_roles(self, server, channel_id: Optional[int], resume: bool):
+        while not self._db_ready:
+            await asyncio.sleep(5)
+        checkpoint = await self.config.guild(server).role_sync() if resume else None
+        if checkpoint is None:
+            checkpoint = {
+                "channel_id": channel_id,
+                "last_user": "",
+                "checked": 0,
+                "updated": 0,
+                "failed": 0,
+                "total": await self.db.members.count_documents(self._member_filter(server)),
+            }
+            await self.config.guild(server).role_sync.set(checkpoint)
+
+        channel = server.get_channel(checkpoint["channel_id"]) if checkpoint["channel_id"] else None
+        progress = None
+        if channel is not None and channel.permissions_for(server.me).send_messages:
+            progress = await channel.send(self._role_sync_progress(checkpoint))
+
+        while True:
+            # user ids only ever grow past the checkpoint, so a restart picks up right after it
+            cursor = (
+                self.db.members.find(
+                    {**self._member_filter(server), "user_id": {"$gt": checkpoint["last_user"]}},
+                    {"_id": 0, "user_id": 1, "exp": 1},
+                )
+                .sort("user_id", ASCENDING)
+                .limit(self.ROLE_SYNC_BATCH)
+            )
+            batch = await cursor.to_list(length=None)
+            if not batch:
+                break
+            index = await self._level_rewards(server)
+            plans = {}
+            for entry, level in zip(batch, xp.find_level_batch([entry["exp"] for entry in batch])):
+                checkpoint["checked"] += 1
+                member = server.get_member(int(entry["user_id"]))
+                if member is None or member.bot:
+                    continue
+                level = int(level)
+                if level not in plans:
+                    plans[level] = self._linked_roles_at(index, level)
+                due, obsolete = plans[level]
+                held = {role.id for role in member.roles}
+                add_roles = [r for r in map(server.get_role, due - held) if r is not None and r < server.me.top_role]
+                remove_roles = [
+                    r for r in map(server.get_role, obsolete & held) if r is not None and r < server.me.top_role
+                ]
+                if not add_roles and not remove_roles:
+                    continue
+                try:
+                    if add_roles:
+                        await member.add_roles(*add_roles, reason="Leveler role sync")
+                    if remove_roles:
+                        await member.remove_roles(*remove_roles, reason="Leveler role sync")
+                    checkpoint["updated"] += 1
+                except discord.HTTPException:
+                    checkpoint["failed"] += 1
+                # discord.py waits out 429s, spacing the edits keeps the guild's role bucket from emptying
+                await asyncio.sleep(self.ROLE_SYNC_DELAY)
+            checkpoint["last_user"] = batch[-1]["user_id"]
+            await self.config.guild(server).role_sync.set(checkpoint)
+            if progress is not None:
+                with contextlib.suppress(discord.HTTPException):
+                    await progress.edit(content=self._role_sync_progress(checkpoint))
+
+        await self.config.guild(server).role_sync.clear()
+        log.info(
+            f"Role sync of {server}({server.id}) finished: {checkpoint['checked']} checked, "
+            f"{checkpoint['updated']} updated, {checkpoint['failed']} failed"
+        )
+        if progress is not None:
+            with contextlib.suppress(discord.HTTPException):
+                await progress.edit(content=self._role_sync_progress(checkpoint, done=True))
+
+    @staticmethod
+    def _role_sync_progress(checkpoint: dict, done: bool = False) -> str:
+        state = "finished" if done else "running"
+        return (
+            f"**Role sync {state}:** {checkpoint['checked']}/{checkpoint['total']} members checked, "
+            f"{checkpoint['updated']} updated, {checkpoint['failed']} failed."
+        )
+
     async def _find_server_rank(self, user, server):
         if not self._db_ready:
             return
-        targetid = str(user.id)
-        users = []
-        q = f"servers.{server.id}"
-        guild_ids = [str(x.id) for x in server.members]
-        async for userinfo in self.db.users.find({q: {"$exists": "true"}}):
-            await asyncio.sleep(0)
-            if userinfo["user_id"] in guild_ids:
-                try:
-                    server_exp = 0
-                    userid = userinfo["user_id"]
-                    for i in range(userinfo["servers"][str(server.id)]["level"]):
-                        server_exp += self._required_exp(i)
-                    server_exp += userinfo["servers"][str(server.id)]["current_exp"]
-                    users.append((userid, server_exp))
-                except:
-                    pass
-
-        sorted_list = sorted(users, key=operator.itemgetter(1), reverse=True)
-
-        rank = 1
-        for a_user in sorted_list:
-            await asyncio.sleep(0)
-            if a_user[0] == targetid:
-                return rank
-            rank += 1
+        entry = await self.db.members.find_one({"server_id": str(server.id), "user_id": str(user.id)})
+        if not entry:
+            return
+        return await self._count_rank(self.db.members, self._member_filter(server), "exp", entry["exp"])
+
+    # per-server state lives in the `members` collection, one document per (server, user) holding
+    # the level, current exp and the cumulative server exp, so pages and ranks are plain indexed queries.
+    # `member` is kept up to date by the join/leave listeners and `_reconcile_membership`,
+    # so the queries themselves leave out people who have left the server
+    @staticmethod
+    def _member_filter(server) -> dict:
+        return queries.member_filter(server.id)
+
+    @commands.Cog.listener("on_member_join")
+    async def _member_joined(self, member):
+        await self._set_membership(member, True)
+
+    @commands.Cog.listener("on_member_remove")
+    async def _member_left(self, member):
+        await self._set_membership(member, False)
+
+    async def _set_membership(self, member, present: bool):
+        if not self._db_ready:
+            return
+        await self.db.members.update_one(
+            {"server_id": str(member.guild.id), "user_id": str(member.id)}, {"$set": {"member": present}}
+        )
+
+    async def _reconcile_memberships(self):
+        await self.bot.wait_until_red_ready()
+        while True:
+            if self._db_ready:
+                for server in self.bot.guilds:
+                    try:
+                        fixed = await self._reconcile_membership(server)
+                    except Exception as err:
+                        log.error(f"Could not reconcile the members of {server}({server.id})", exc_info=err)
+                    else:
+                        if fixed:
+                            log.debug(f"Fixed the membership of {fixed} members entries in {server}({server.id})")
+                await asyncio.sleep(0)
+            await asyncio.sleep(self.MEMBERSHIP_RECONCILE_INTERVAL)
+
+    async def _reconcile_membership(self, server) -> int:
+        """Corrects `member` on `server`'s members entries, e.g. for joins and leaves missed while offline."""
+        if not server.chunked:
+            # an incomplete member cache would mark everyone missing from it as gone
+            return 0
+        server_id = str(server.id)
+        fixed = 0
+        requests = []
+        async for entry in self.db.members.find({"server_id": server_id}, {"_id": 0, "user_id": 1, "member": 1}):
+            present = server.get_member(int(entry["user_id"])) is not None
+            if entry.get("member") is not present:
+                requests.append(
+                    UpdateOne({"server_id": server_id, "user_id": entry["user_id"]}, {"$set": {"member": present}})
+                )
+            if len(requests) >= 1000:
+                await self.db.members.bulk_write(requests, ordered=False)
+                fixed += len(requests)
+                requests = []
+        if requests:
+            await self.db.members.bulk_write(requests, ordered=False)
+            fixed += len(requests)
+        return fixed
+
+    async def _member_info(self, user, server) -> dict:
+        """The user's `members` entry for `server`: level, current_exp and the cumulative server exp."""
+        entry = await self.db.members.find_one(
+            {"server_id": str(server.id), "user_id": str(user.id)}, {"_id": 0, "level": 1, "current_exp": 1, "exp": 1}
+        )
+        return entry or {"level": 0, "current_exp": 0, "exp": 0}
+
+    # older versions kept every server's level under `users.servers.<id>`, so a user on many servers
+    # had an ever growing document; these move those entries into `members` while the bot keeps running
+    def _start_member_migration(self, channel=None):
+        if self._migration is not None and not self._migration.done():
+            return self._migration
+        self._migration = asyncio.create_task(self._migrate_members(channel))
+        self._migration.add_done_callback(self._task_error_logger)
+        return self._migration
+
+    async def _migrate_members(self, channel=None):
+        while not self._db_ready:
+            await asyncio.sleep(5)
+        query = {"servers": {"$exists": True}}
+        total = self._migration_progress["total"] = await self.db.users.count_documents(query)
+        if total:
+            log.info(f"Moving the server levels of {total} users into the members collection")
+        progress = None
+        if channel is not None:
+            progress = await channel.send(self._migration_text())
+        start = time.perf_counter()
+        last_id = None
+        while True:
+            # walking the _id index keeps each batch from rescanning the users already moved
+            batch = await (
+                self.db.users.find(
+                    {**query, "_id": {"$gt": last_id}} if last_id else query,
+                    {"user_id": 1, "username": 1, "servers": 1},
+                )
+                .sort("_id", ASCENDING)
+                .limit(500)
+                .to_list(length=None)
+            )
+            if not batch:
+                break
+            last_id = batch[-1]["_id"]
+            self._migration_progress["entries"] += await self._migrate_user_batch(batch)
+            self._migration_progress["users"] += len(batch)
+            if progress is not None:
+                with contextlib.suppress(discord.HTTPException):
+                    await progress.edit(content=self._migration_text())
+        await self.config.members_migrated.set(True)
+        took = time.perf_counter() - start
+        log.info(f"Members migration finished in {took:.1f}s: {self._migration_progress}")
+        if progress is not None:
+            with contextlib.suppress(discord.HTTPException):
+                await progress.edit(content=self._migration_text(took))
+
+    async def _migrate_user_batch(self, batch) -> int:
+        """Merges the `servers` entries of `batch` into `members`, then removes them from the user documents.
+
+        See `queries.migration_pipeline` for the merge; running it twice for the same user gives the same result.
+        """
+        entries = [
+            (userinfo, server_id, info)
+            for userinfo in batch
+            for server_id, info in (userinfo.get("servers") or {}).items()
+        ]
+        # tolist() hands back plain ints, numpy's own can't be stored
+        old_exps = xp.server_exp_batch(
+            [info.get("level", 0) for _, _, info in entries], [info.get("current_exp", 0) for _, _, info in entries]
+        ).tolist()
+        requests = []
+        for (userinfo, server_id, info), old_exp in zip(entries, old_exps):
+            server = self.bot.get_guild(int(server_id))
+            present = server is not None and server.get_member(int(userinfo["user_id"])) is not None
+            pipeline = queries.migration_pipeline(old_exp, userinfo.get("username"), present)
+            requests.append(
+                UpdateOne({"server_id": server_id, "user_id": userinfo["user_id"]}, pipeline, upsert=True)
+            )
+        if requests:
+            await self.db.members.bulk_write(requests, ordered=False)
+        await self.db.users.bulk_write(
+            [UpdateOne({"_id": userinfo["_id"]}, {"$unset": {"servers": ""}}) for userinfo in batch], ordered=False
+        )
+        return len(requests)
+
+    def _migration_text(self, took: Optional[float] = None) -> str:
+        done = self._migration_progress
+        state = "running" if took is None else f"finished in {took:.0f}s"
+        return (
+            f"**Members migration {state}:** {done['users']}/{done['total']} users, "
+            f"{done['entries']} server entries moved."
+        )
+
+    async def _server_leaderboard_page(self, server, skip: int, limit: int):
+        cursor = (
+            self.db.members.find(self._member_filter(server), {"username": 1, "user_id": 1, "exp": 1})
+            .sort("exp", -1)
+            .skip(skip)
+            .limit(limit)
+        )
+        return [(entry.get("username", entry["user_id"]), entry["exp"]) async for entry in cursor]
 
     async def _find_server_rep_rank(self, user, server):
         if not self._db_ready:
             return
-        users = []
-        q = f"servers.{server.id}"
-        guild_ids = [str(x.id) for x in server.members]
-        async for userinfo in self.db.users.find({"$and": [{q: {"$exists": "true"}}, {"rep": {"$gte": 1}}]}).sort(
-            "rep", -1
-        ):
-            await asyncio.sleep(0)
-            if userinfo["user_id"] in guild_ids:
-                users.append((userinfo["user_id"], userinfo["rep"]))
+        userinfo = await self.db.users.find_one({"user_id": str(user.id)}, {"rep": 1})
+        if not userinfo:
+            return
+        pipeline = self._server_rep_pipeline(server) + [{"$match": {"rep": {"$gt": userinfo["rep"]}}}, {"$count": "n"}]
+        higher = await self.db.members.aggregate(pipeline).to_list(length=1)
+        return (higher[0]["n"] if higher else 0) + 1
 
-        sorted_list = sorted(users, key=operator.itemgetter(1), reverse=True)
+    async def _server_rep_board(self, server):
+        pipeline = self._server_rep_pipeline(server) + [{"$sort": {"rep": -1}}]
+        return await self.db.members.aggregate(pipeline).to_list(length=None)
 
-        rank = 1
-        for a_user in sorted_list:
-            await asyncio.sleep(0)
-            if a_user[0] == str(user.id):
-                return rank
-            rank += 1
+    @staticmethod
+    def _server_rep_pipeline(server):
+        return queries.server_rep_pipeline(server.id)
 
     async def _find_server_exp(self, user, server):
         if not self._db_ready:
             return
-        server_exp = 0
-        userinfo = await self.db.users.find_one({"user_id": str(user.id)})
-
-        try:
-            for i in range(userinfo["servers"][str(server.id)]["level"]):
-                await asyncio.sleep(0)
-                server_exp += self._required_exp(i)
-            server_exp += userinfo["servers"][str(server.id)]["current_exp"]
-            return server_exp
-        except:
-            return server_exp
+        return (await self._member_info(user, server))["exp"]
 
     async def _find_global_rank(self, user):
         if not self._db_ready:
             return
-        users = []
-
-        async for userinfo in self.db.users.find(({"total_exp": {"$gte": 10}})).sort("total_exp", -1).limit(1000):
-            await asyncio.sleep(0)
-            try:
-                users.append((userinfo["user_id"], userinfo["total_exp"]))
-            except KeyError:
-                pass
-        sorted_list = sorted(users, key=operator.itemgetter(1), reverse=True)
-
-        rank = 1
-        for stats in sorted_list:
-            await asyncio.sleep(0)
-            if stats[0] == str(user.id):
-                return rank
-            rank += 1
+        userinfo = await self.db.users.find_one({"user_id": str(user.id)}, {"total_exp": 1})
+        if not userinfo:
+            return
+        return await self._count_rank(self.db.users, {}, "total_exp", userinfo["total_exp"])
 
     async def _find_global_rep_rank(self, user):
         if not self._db_ready:
             return
-        users = []
+        userinfo = await self.db.users.find_one({"user_id": str(user.id)}, {"rep": 1})
+        if not userinfo:
+            return
+        return await self._count_rank(self.db.users, {}, "rep", userinfo["rep"])
 
-        async for userinfo in self.db.users.find(({"rep": {"$gte": 1}})).sort("rep", -1).limit(1000):
-            await asyncio.sleep(0)
-            try:
-                userid = userinfo["user_id"]
-                users.append((userid, userinfo["rep"]))
-            except KeyError:
-                pass
-        sorted_list = sorted(users, key=operator.itemgetter(1), reverse=True)
+    @staticmethod
+    async def _count_rank(collection, query: dict, field: str, value):
+        return await queries.count_rank(collection, query, field, value)
 
-        rank = 1
-        for stats in sorted_list:
-            await asyncio.sleep(0)
-            if stats[0] == str(user.id):
-                return rank
-            rank += 1
+    async def _new_account(self):
+        """Fields of a new user document besides `user_id` and `username`."""
+        return {
+            "total_exp": 0,
+            "profile_background": await self.config.default_profile(),
+            "rank_background": await self.config.default_rank(),
+            "levelup_background": await self.config.default_levelup(),
+            "title": "",
+            "info": "I am a mysterious person.",
+            "rep": 0,
+            "badges": {},
+            "active_badges": {},
+            "rep_color": [],
+            "badge_col_color": [],
+            "rep_block": 0,
+            "chat_block": 0,
+            "last_message": "",
+            "profile_block": 0,
+            "rank_block": 0,
+        }
 
     # handles user creation, adding new server, blocking
-    async def _create_user(self, user, server):
+    async def _create_user(self, user, server, fetch: bool = False):
+        """Makes sure `user` has a document with an entry for `server`, in one upsert.
+
+        Pairs set up in the last `KNOWN_USER_TTL` seconds skip the database and return None,
+        unless `fetch` asks for the stored document anyway.
+        """
         if not self._db_ready:
             return
-        # backgrounds = await self.get_backgrounds()   ... This wasn't used here
+        key = (user.id, server.id)
+        if not fetch and self._known_users.get(key, 0) > time.monotonic():
+            return
+        user_id = str(user.id)
         try:
-            user_id = f"{user.id}"
-            userinfo = await self.db.users.find_one({"user_id": user_id})
-            if not userinfo:
-                default_profile = await self.config.default_profile()
-                default_rank = await self.config.default_rank()
-                default_levelup = await self.config.default_levelup()
-                new_account = {
-                    "user_id": user_id,
-                    "username": user.name,
-                    "servers": {},
-                    "total_exp": 0,
-                    "profile_background": default_profile,
-                    "rank_background": default_rank,
-                    "levelup_background": default_levelup,
-                    "title": "",
-                    "info": "I am a mysterious person.",
-                    "rep": 0,
-                    "badges": {},
-                    "active_badges": {},
-                    "rep_color": [],
-                    "badge_col_color": [],
-                    "rep_block": 0,
-                    "chat_block": 0,
-                    "last_message": "",
-                    "profile_block": 0,
-                    "rank_block": 0,
-                }
-                await self.db.users.insert_one(new_account)
-                userinfo = await self.db.users.find_one({"user_id": user_id})
-
-            if "username" not in userinfo or userinfo["username"] != user.name:
-                await self.db.users.update_one({"user_id": user_id}, {"$set": {"username": user.name}}, upsert=True)
-
-            if "servers" not in userinfo or str(server.id) not in userinfo["servers"]:
-                await self.db.users.update_one(
+            userinfo, _ = await asyncio.gather(
+                self.db.users.find_one_and_update(
                     {"user_id": user_id},
-                    {"$set": {f"servers.{server.id}.level": 0, f"servers.{server.id}.current_exp": 0,}},
+                    queries.user_setup(user.name, await self._new_account()),
                     upsert=True,
-                )
-            return userinfo
-        except AttributeError as err:
-            log.debug("error in user creation", exc_info=err)
+                    return_document=ReturnDocument.AFTER,
+                ),
+                self.db.members.update_one(
+                    {"server_id": str(server.id), "user_id": user_id},
+                    queries.member_setup(user.name),
+                    upsert=True,
+                ),
+            )
+            if userinfo.get("servers") is not None:
+                # not reached by the background migration yet, move this user now
+                await self._migrate_user_batch([userinfo])
+                del userinfo["servers"]
         except Exception as err:
             log.debug("error in user creation", exc_info=err)
+            return
+        self._known_users[key] = time.monotonic() + self.KNOWN_USER_TTL
+        return userinfo
+
+    def _prune_known_users(self):
+        now = time.monotonic()
+        self._known_users = {key: expiry for key, expiry in self._known_users.items() if expiry > now}
+
+    @commands.Cog.listener("on_user_update")
+    async def _user_renamed(self, before, after):
+        # the stored username is refreshed the next time the user is set up
+        if before.name != after.name:
+            self._known_users = {key: expiry for key, expiry in self._known_users.items() if key[0] != after.id}
 
     async def asyncit(self, iterable):
         for i in iterable:
@@ -3732,36 +3699,20 @@ class Leveler(commands.Cog):
 
     @staticmethod
     def _truncate_text(text, max_length):
-        if len(text) > max_length:
-            if text.strip("$").isdigit():
-                text = int(text.strip("$"))
-                return "${:.2E}".format(text)
-            return text[: max_length - 3] + "..."
-        return text
-
-    # finds the the pixel to center the text
-    @staticmethod
-    def _center(start, end, text, font):
-        dist = end - start
-        width = font.getsize(text)[0]
-        start_pos = start + ((dist - width) / 2)
-        return int(start_pos)
+        return render.truncate_text(text, max_length)
 
     # calculates required exp for next level
     @staticmethod
     def _required_exp(level: int):
-        if level < 0:
-            return 0
-        return 139 * level + 65
+        return xp.required_exp(level)
 
     @staticmethod
     def _level_exp(level: int):
-        return level * 65 + 139 * level * (level - 1) // 2
+        return xp.level_exp(level)
 
     @staticmethod
     def _find_level(total_exp):
-        # this is specific to the function above
-        return int((1 / 278) * (9 + math.sqrt(81 + 1112 * total_exp)))
+        return xp.find_level(total_exp)
 
     @staticmethod
     def char_in_font(unicode_char, font):
@@ -3789,80 +3740,12 @@ class Leveler(commands.Cog):
     @checks.is_owner()
     @convert.command(name="mee6levels")
     @commands.guild_only()
-    async def mee6convertlevels(self, ctx, pages: int):
+    async def mee6convertlevels(self, ctx, pages: int, dry_run: bool = False):
         """Convert Mee6 levels.
         Each page returns 999 users at most.
-        This command must be run in a channel in the guild to be converted."""
-        if await self.config.guild(ctx.guild).mentions():
-            msg = (
-                "**{}, levelup mentions are on in this server.**\n"
-                "The bot will ping every user that will be leveled up through this process if you continue.\n"
-                "Reply with `yes` if you want this conversion to continue.\n"
-                "If not, reply with `no` and then run `{}lvladmin mention` to turn off mentions before running this command again."
-            ).format(ctx.author.display_name, ctx.prefix)
-            await ctx.send(msg)
-            pred = MessagePredicate.yes_or_no(ctx)
-            try:
-                await self.bot.wait_for("message", check=pred, timeout=15)
-            except TimeoutError:
-                return await ctx.send("**Timed out waiting for a response.**")
-            if pred.result is False:
-                return await ctx.send("**Command cancelled.**")
-        failed = 0
-        for i in range(pages):
-            await asyncio.sleep(0)
-            async with self.session.get(
-                f"https://mee6.xyz/api/plugins/levels/leaderboard/{ctx.guild.id}?page={i}&limit=999"
-            ) as r:
-
-                if r.status == 200:
-                    data = await r.json()
-                else:
-                    return await ctx.send("No data was found within the Mee6 API.")
-
-            for userdata in data["players"]:
-                await asyncio.sleep(0)
-                # _handle_levelup requires a Member
-                user = ctx.guild.get_member(int(userdata["id"]))
-
-                if not user:
-                    failed += 1
-                    continue
-
-                level = userdata["level"]
-                server = ctx.guild
-                channel = ctx.channel
-
-                # creates user if doesn't exist
-                await self._create_user(user, server)
-                userinfo = await self.db.users.find_one({"user_id": str(user.id)})
-
-                # get rid of old level exp
-                old_server_exp = 0
-                for _i in range(userinfo["servers"][str(server.id)]["level"]):
-                    await asyncio.sleep(0)
-                    old_server_exp += self._required_exp(_i)
-                userinfo["total_exp"] -= old_server_exp
-                userinfo["total_exp"] -= userinfo["servers"][str(server.id)]["current_exp"]
-
-                # add in new exp
-                total_exp = self._level_exp(level)
-                userinfo["servers"][str(server.id)]["current_exp"] = 0
-                userinfo["servers"][str(server.id)]["level"] = level
-                userinfo["total_exp"] += total_exp
-
-                await self.db.users.update_one(
-                    {"user_id": str(user.id)},
-                    {
-                        "$set": {
-                            "servers.{}.level".format(server.id): level,
-                            "servers.{}.current_exp".format(server.id): 0,
-                            "total_exp": userinfo["total_exp"],
-                        }
-                    },
-                )
-                await self._handle_levelup(user, userinfo, server, channel)
-        await ctx.send(f"{failed} users could not be found and were skipped.")
+        This command must be run in a channel in the guild to be converted.
+        With `dry_run` nothing is written, only the import report is shown."""
+        await self._import_levels(ctx, importer.mee6_levels(self.session, ctx.guild.id, pages), dry_run)
 
     @checks.is_owner()
     @convert.command(name="mee6ranks")
@@ -3902,90 +3785,133 @@ class Leveler(commands.Cog):
                     await self.db.roles.update_one(
                         {"server_id": str(server.id)}, {"$set": {"roles": server_roles["roles"]}}
                     )
+                self._invalidate_rewards(server)
 
                 await ctx.send("**The `{}` role has been linked to level `{}`**".format(role_name, level))
 
     @checks.is_owner()
     @convert.command(name="tatsulevels")
     @commands.guild_only()
-    async def tatsumakiconvertlevels(self, ctx):
+    async def tatsumakiconvertlevels(self, ctx, dry_run: bool = False):
         """Convert Tatsumaki levels.
-        This command must be run in a channel in the guild to be converted."""
+        This command must be run in a channel in the guild to be converted.
+        With `dry_run` nothing is written, only the import report is shown."""
         token = await self.bot.get_shared_api_tokens("tatsumaki")
         tatsu_token = token.get("api_key", False)
         if not tatsu_token:
             return await ctx.send(f"You do not have a valid Tatsumaki API key set up. "
                                   f"If you have a key, you can set it via `{ctx.clean_prefix}set api tatsumaki api_key <api_key_here>`\n"
                                   f"Keys are not currently available if you do not have one already as the API is in the process of being revamped.")
+        await self._import_levels(ctx, importer.tatsumaki_levels(self.session, ctx.guild.id, tatsu_token), dry_run)
 
-        if await self.config.guild(ctx.guild).mentions():
-            msg = (
-                "**{}, levelup mentions are on in this server.**\n"
-                "The bot will ping every user that will be leveled up through this process if you continue.\n"
-                "Reply with `yes` if you want this conversion to continue.\n"
-                "If not, reply with `no` and then run `{}lvladmin mention` to turn off mentions before running this command again."
-            ).format(ctx.author.display_name, ctx.prefix)
-            await ctx.send(msg)
-            pred = MessagePredicate.yes_or_no(ctx)
-            try:
-                await self.bot.wait_for("message", check=pred, timeout=15)
-            except TimeoutError:
-                return await ctx.send("**Timed out waiting for a response.**")
-            if pred.result is False:
-                return await ctx.send("**Command cancelled.**")
-        failed = 0
-        await asyncio.sleep(0)
-        async with self.session.get(
-            f"https://api.tatsumaki.xyz/guilds/{ctx.guild.id}/leaderboard?limit&=-1"
-        ) as r:
-
-            if r.status == 200:
-                data = await r.json()
-            else:
-                return await ctx.send("No data was found within the Tastumaki API.")
-
-        for userdata in data:
-            if userdata is None:
-                continue
-            await asyncio.sleep(0)
-            # _handle_levelup requires a Member
-            user = ctx.guild.get_member(int(userdata["user_id"]))
-
-            if not user:
-                failed += 1
-                continue
-
-            level = self._find_level(userdata["score"])
-            server = ctx.guild
-            channel = ctx.channel
-
-            # creates user if doesn't exist
-            await self._create_user(user, server)
-            userinfo = await self.db.users.find_one({"user_id": str(user.id)})
-
-            # get rid of old level exp
-            old_server_exp = 0
-            for _i in range(userinfo["servers"][str(server.id)]["level"]):
-                await asyncio.sleep(0)
-                old_server_exp += self._required_exp(_i)
-            userinfo["total_exp"] -= old_server_exp
-            userinfo["total_exp"] -= userinfo["servers"][str(server.id)]["current_exp"]
-
-            # add in new exp
-            total_exp = self._level_exp(level)
-            userinfo["servers"][str(server.id)]["current_exp"] = 0
-            userinfo["servers"][str(server.id)]["level"] = level
-            userinfo["total_exp"] += total_exp
+    @checks.is_owner()
+    @convert.command(name="file")
+    @commands.guild_only()
+    async def convertfile(self, ctx, dry_run: bool = False):
+        """Import levels from an attached JSON or CSV export.
+        Rows need a `user_id` (or `id`) and a `level`, or an `xp`/`score` total to work the level out from.
+        This command must be run in a channel in the guild to be converted.
+        With `dry_run` nothing is written, only the import report is shown."""
+        if not ctx.message.attachments:
+            return await ctx.send("**Please attach a `.json` or `.csv` export to the command.**")
+        attachment = ctx.message.attachments[0]
+        data = await attachment.read()
+        await self._import_levels(ctx, importer.export_levels(data, attachment.filename), dry_run)
+
+    async def _import_levels(self, ctx, batches, dry_run: bool):
+        """Writes imported levels with one bulk write per collection and batch.
+
+        No levelup is handled per user: linked badges up to the imported level are set in the same
+        write, and the linked roles are handed out by one role sync once everything is in."""
+        server = ctx.guild
+        server_id = str(server.id)
+        stats = importer.ImportStats()
+        new_account = await self._new_account()
+        del new_account["total_exp"]
+        index = await self._level_rewards(server)
+        badge_levels = sorted(level for level, rewards in index.items() if rewards.badges)
+        try:
+            async with ctx.typing():
+                async for batch in batches:
+                    stats.batches += 1
+                    stats.records += len(batch)
+                    members = {}
+                    for record in batch:
+                        member = server.get_member(int(record.user_id))
+                        if member is None:
+                            stats.skipped += 1
+                        else:
+                            members[record.user_id] = (member, record.level)
+                    if not members:
+                        continue
 
-            await self.db.users.update_one(
-                {"user_id": str(user.id)},
-                {
-                    "$set": {
-                        "servers.{}.level".format(server.id): level,
-                        "servers.{}.current_exp".format(server.id): 0,
-                        "total_exp": userinfo["total_exp"],
-                    }
-                },
-            )
-            await self._handle_levelup(user, userinfo, server, channel)
-        await ctx.send(f"{failed} users could not be found and were skipped.")
+                    if not dry_run:
+                        # users the background migration hasn't reached yet still hold their old exp in
+                        # `servers`, move it first so the import overwrites it instead of adding to it
+                        pending = await self.db.users.find(
+                            {"user_id": {"$in": list(members)}, "servers": {"$exists": True}},
+                            {"user_id": 1, "username": 1, "servers": 1},
+                        ).to_list(length=None)
+                        if pending:
+                            await self._migrate_user_batch(pending)
+
+                    stored = {}
+                    async for entry in self.db.members.find(
+                        {"server_id": server_id, "user_id": {"$in": list(members)}}, {"_id": 0, "user_id": 1, "exp": 1}
+                    ):
+                        stored[entry["user_id"]] = entry["exp"]
+
+                    new_exps = xp.level_exp_batch([level for _, level in members.values()]).tolist()
+                    user_requests = []
+                    board_requests = []
+                    for (user_id, (member, level)), new_exp in zip(members.items(), new_exps):
+                        old_exp = stored.get(user_id, 0)
+                        badges = {
+                            f"badges.{name}_{server.id}": badge
+                            for linked_level in badge_levels
+                            if linked_level <= level
+                            for name, badge in index[linked_level].badges.items()
+                        }
+                        on_insert = {k: v for k, v in new_account.items() if not (badges and k == "badges")}
+                        user_requests.append(
+                            UpdateOne(
+                                {"user_id": user_id},
+                                {
+                                    "$set": {"username": member.name, **badges},
+                                    "$inc": {"total_exp": new_exp - old_exp},
+                                    "$setOnInsert": on_insert,
+                                },
+                                upsert=True,
+                            )
+                        )
+                        board_requests.append(
+                            UpdateOne(
+                                {"server_id": server_id, "user_id": user_id},
+                                {
+                                    "$set": {
+                                        "level": level,
+                                        "current_exp": 0,
+                                        "exp": new_exp,
+                                        "username": member.name,
+                                        "member": True,
+                                    },
+                                    # the imported level replaces whatever the migration merged in
+                                    "$unset": {"legacy_exp": ""},
+                                },
+                                upsert=True,
+                            )
+                        )
+                    if not dry_run:
+                        await self.db.users.bulk_write(user_requests, ordered=False)
+                        await self.db.members.bulk_write(board_requests, ordered=False)
+                    stats.imported += len(user_requests)
+        except importer.ImportSourceError as exc:
+            log.warning(f"Level import for {server}({server.id}) stopped", exc_info=exc)
+            await ctx.send(f"**The import stopped:** {exc}\n{stats.summary(dry_run)}")
+            if dry_run or not stats.imported:
+                return
+        else:
+            await ctx.send(stats.summary(dry_run))
+        log.info(f"Level import for {server}({server.id}): {stats.summary(dry_run)}")
+        if not dry_run and stats.imported:
+            self._start_role_sync(server, ctx.channel.id)
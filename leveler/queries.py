@@ -0,0 +1,110 @@
+"""The filters, updates and pipelines Leveler sends to its database.
+
+They only take plain ids and values, so the same documents the cog builds can be run against
+either storage backend without a bot (see tests/leveler).
+"""
+from typing import List, Tuple
+
+from . import xp
+
+# seconds between two reps given by the same user
+REP_COOLDOWN = 43200
+
+
+def member_filter(server_id) -> dict:
+    """Members entries of the people still on the server."""
+    return {"server_id": str(server_id), "member": True}
+
+
+async def count_rank(collection, query: dict, field: str, value) -> int:
+    """Rank of `value` among the `field` values matching `query`, 1 being the highest.
+
+    Counts the documents scoring strictly higher on an index on `field`,
+    so ties share a rank and no documents are pulled."""
+    return await collection.count_documents({**query, field: {"$gt": value}}) + 1
+
+
+def user_setup(username: str, account: dict) -> dict:
+    """Upsert of a user document: the name is refreshed, `account` only fills a new one."""
+    return {"$set": {"username": username}, "$setOnInsert": account}
+
+
+def member_setup(username: str) -> dict:
+    """Upsert of a members entry that marks the user as present without touching their exp."""
+    return {
+        "$set": {"username": username, "member": True},
+        "$setOnInsert": {"level": 0, "current_exp": 0, "exp": 0},
+    }
+
+
+def award_pipeline(exp: int, username: str) -> List[dict]:
+    """Adds `exp` to a members entry and works its level and current exp out again, in one update."""
+    return [
+        {"$set": {"exp": {"$add": ["$exp", exp]}}},
+        {"$set": {"level": xp.find_level_expr("$exp")}},
+        {
+            "$set": {
+                "current_exp": {"$toInt": {"$subtract": ["$exp", xp.level_exp_expr("$level")]}},
+                "username": {"$literal": username},
+                "member": True,
+            }
+        },
+    ]
+
+
+def migration_pipeline(old_exp: int, username: str, present: bool) -> List[dict]:
+    """Merges `old_exp` from a `servers` entry into a members entry.
+
+    Whatever an earlier, interrupted run added (kept as `legacy_exp`) is replaced and anything earned
+    since is kept. An entry without `legacy_exp` is the copy of `servers` the leaderboard kept before,
+    and is replaced as a whole.
+    """
+    new_exp = {"$subtract": [{"$ifNull": ["$exp", 0]}, {"$ifNull": ["$legacy_exp", {"$ifNull": ["$exp", 0]}]}]}
+    return [
+        {
+            "$set": {
+                "exp": {"$add": [new_exp, old_exp]},
+                "legacy_exp": {"$literal": old_exp},
+                "username": {"$ifNull": ["$username", {"$literal": username}]},
+                "member": {"$ifNull": ["$member", present]},
+            }
+        },
+        {"$set": {"level": xp.find_level_expr("$exp")}},
+        {"$set": {"current_exp": {"$toInt": {"$subtract": ["$exp", xp.level_exp_expr("$level")]}}}},
+    ]
+
+
+def server_rep_pipeline(server_id) -> List[dict]:
+    """Rep of everyone on the server with any, as {user_id, username, rep}."""
+    # rep lives on the user, membership on the members entry; the join runs on the users.user_id index
+    return [
+        {"$match": member_filter(server_id)},
+        {"$lookup": {"from": "users", "localField": "user_id", "foreignField": "user_id", "as": "user"}},
+        {"$project": {"_id": 0, "user_id": 1, "username": 1, "rep": {"$arrayElemAt": ["$user.rep", 0]}}},
+        {"$match": {"rep": {"$gte": 1}}},
+    ]
+
+
+def rep_claim(user_id, now: float) -> Tuple[dict, dict]:
+    """(filter, update) that take the rep cooldown of `user_id` only if it has run out."""
+    return (
+        {
+            "user_id": str(user_id),
+            "$or": [{"rep_block": {"$lte": now - REP_COOLDOWN}}, {"rep_block": {"$not": {"$type": "number"}}}],
+        },
+        {"$set": {"rep_block": now}},
+    )
+
+
+def badge_holders(badge_name: str) -> dict:
+    """Users holding `badge_name`, found through the wildcard index on the badges."""
+    return {f"badges.{badge_name}": {"$exists": True}}
+
+
+def badge_update(badge_name: str, badge: dict) -> dict:
+    """Refreshes the holders' copy of a badge, leaving the priority each of them set."""
+    return {"$set": {f"badges.{badge_name}.{k}": v for k, v in badge.items() if k != "priority_num"}}
+
+
+def badge_removal(badge_name: str) -> dict:
+    return {"$unset": {f"badges.{badge_name}": ""}}
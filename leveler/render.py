@@ -0,0 +1,806 @@
+"""Card drawing for Leveler.
+
+Everything that touches PIL lives here as plain functions of their arguments,
+so a render can run in a worker thread or process. The cog gathers a spec
+(text, colours and the already decoded images) and awaits the PNG bytes from
+a `RenderPool`.
+"""
+import asyncio
+import functools
+import logging
+import platform
+import textwrap
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, FrozenSet, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy
+from fontTools.ttLib import TTFont
+from PIL import Image, ImageDraw, ImageFilter, ImageFont, ImageOps
+
+from . import xp
+
+log = logging.getLogger("red.aikaterna.leveler.render")
+
+# every face and size the cards are drawn with, see `preload_fonts`
+FONT_FILES = {"bold": "font_bold.ttf", "unicode": "unicode.ttf"}
+FONT_SIZES = {"bold": (12, 14, 15, 22, 26), "unicode": (8, 12, 18)}
+
+_fonts: Dict[Tuple[str, str, int], ImageFont.FreeTypeFont] = {}
+_coverage: Dict[str, FrozenSet[int]] = {}
+_fonts_lock = threading.Lock()
+
+# (image, border colour) pairs, already sorted by priority and sized with `badge_size`
+Badges = List[Tuple[Image.Image, Optional[str]]]
+
+
+class ProfileSpec(NamedTuple):
+    data_path: str
+    background: Image.Image
+    avatar: Image.Image
+    name: str
+    title: str
+    info: str
+    rep: int
+    level: int
+    current_exp: int
+    server_rank: Optional[int]
+    server_exp: int
+    global_rank: Optional[int]
+    total_exp: int
+    credits: int
+    rep_color: Optional[list]
+    badge_col_color: Optional[list]
+    info_color: Optional[list]
+    exp_color: Optional[list]
+    badge_type: str
+    badges: Badges
+
+
+class RankSpec(NamedTuple):
+    data_path: str
+    background: Image.Image
+    avatar: Image.Image
+    server_icon: Image.Image
+    name: str
+    level: int
+    current_exp: int
+    server_rank: Optional[int]
+    server_exp: int
+    credits: int
+    info_color: Optional[list]
+    exp_color: Optional[list]
+
+
+class LevelupSpec(NamedTuple):
+    data_path: str
+    background: Image.Image
+    avatar: Image.Image
+    level: int
+    info_color: Optional[list]
+
+
+def font(data_path: str, face: str, size: int) -> ImageFont.FreeTypeFont:
+    """Shared font for `face` at `size`, loaded on first use if `preload_fonts` did not already."""
+    key = (data_path, face, size)
+    loaded = _fonts.get(key)
+    if loaded is None:
+        with _fonts_lock:
+            loaded = _fonts.get(key)
+            if loaded is None:
+                loaded = ImageFont.truetype(f"{data_path}/{FONT_FILES[face]}", size)
+                _fonts[key] = loaded
+    return loaded
+
+
+def glyph_coverage(loaded: ImageFont.FreeTypeFont) -> FrozenSet[int]:
+    """Code points the font file behind `loaded` has a glyph for, read once per file."""
+    covered = _coverage.get(loaded.path)
+    if covered is None:
+        with _fonts_lock:
+            covered = _coverage.get(loaded.path)
+            if covered is None:
+                with TTFont(loaded.path, lazy=True) as ttf:
+                    covered = frozenset(ttf.getBestCmap() or ())
+                _coverage[loaded.path] = covered
+    return covered
+
+
+def preload_fonts(data_path: str) -> int:
+    """Load every font in `FONT_SIZES` and its glyph coverage so no render has to; returns how many were loaded."""
+    for face, sizes in FONT_SIZES.items():
+        for size in sizes:
+            glyph_coverage(font(data_path, face, size))
+    return len(_fonts)
+
+
+def badge_size(badge_type: str, border_color) -> Tuple[int, int]:
+    """Size a badge image is drawn at on the profile card."""
+    if badge_type == "bars":
+        return (82, 12) if border_color is not None else (85, 15)
+    return 27 * 6, 27 * 6
+
+
+def truncate_text(text, max_length):
+    if len(text) > max_length:
+        if text.strip("$").isdigit():
+            text = int(text.strip("$"))
+            return "${:.2E}".format(text)
+        return text[: max_length - 3] + "..."
+    return text
+
+
+# finds the the pixel to center the text
+def center(start, end, text, font):
+    dist = end - start
+    width = font.getsize(text)[0]
+    start_pos = start + ((dist - width) / 2)
+    return int(start_pos)
+
+
+# returns color that contrasts better in background
+def contrast(bg_color, color1, color2):
+    color1_ratio = _contrast_ratio(bg_color, color1)
+    color2_ratio = _contrast_ratio(bg_color, color2)
+    if color1_ratio >= color2_ratio:
+        return color1
+    else:
+        return color2
+
+
+def _luminance(color):
+    # convert to greyscale
+    luminance = float((0.2126 * color[0]) + (0.7152 * color[1]) + (0.0722 * color[2]))
+    return luminance
+
+
+def _contrast_ratio(bgcolor, foreground):
+    f_lum = float(_luminance(foreground) + 0.05)
+    bg_lum = float(_luminance(bgcolor) + 0.05)
+
+    if bg_lum > f_lum:
+        return bg_lum / f_lum
+    else:
+        return f_lum / bg_lum
+
+
+# The shapes below only depend on their geometry and colours, so each one is
+# drawn once and then shared by every render. Callers paste them, never draw on them.
+
+
+@functools.lru_cache(maxsize=32)
+def circle_mask(raw_length: int, size: int) -> Image.Image:
+    """Circle mask drawn at `raw_length` and scaled down to `size` for antialiasing."""
+    mask = Image.new("L", (raw_length, raw_length), 0)
+    draw_thumb = ImageDraw.Draw(mask)
+    draw_thumb.ellipse((0, 0) + (raw_length, raw_length), fill=255, outline=0)
+    return mask.resize((size, size), Image.ANTIALIAS)
+
+
+@functools.lru_cache(maxsize=512)
+def level_ring(raw_length: int, size: int, fill, outline, exp_fill=None, exp_outline=None, angle=None) -> Image.Image:
+    """Level circle, with the exp pie from 12 o'clock to `angle` if one is given."""
+    lvl_circle = Image.new("RGBA", (raw_length, raw_length))
+    draw_lvl_circle = ImageDraw.Draw(lvl_circle)
+    draw_lvl_circle.ellipse([0, 0, raw_length, raw_length], fill=fill, outline=outline)
+    if angle is not None:
+        draw_lvl_circle.pieslice([0, 0, raw_length, raw_length], -90, angle, fill=exp_fill, outline=exp_outline)
+    return lvl_circle.resize((size, size), Image.ANTIALIAS)
+
+
+@functools.lru_cache(maxsize=32)
+def _corner_alpha(size: Tuple[int, int], rad: int, multiplier: int) -> Image.Image:
+    raw_length = rad * 2 * multiplier
+    circle = Image.new("L", (raw_length, raw_length), 0)
+    draw = ImageDraw.Draw(circle)
+    draw.ellipse((0, 0, raw_length, raw_length), fill=255)
+    circle = circle.resize((rad * 2, rad * 2), Image.ANTIALIAS)
+
+    alpha = Image.new("L", size, 255)
+    w, h = size
+    alpha.paste(circle.crop((0, 0, rad, rad)), (0, 0))
+    alpha.paste(circle.crop((0, rad, rad, rad * 2)), (0, h - rad))
+    alpha.paste(circle.crop((rad, 0, rad * 2, rad)), (w - rad, 0))
+    alpha.paste(circle.crop((rad, rad, rad * 2, rad * 2)), (w - rad, h - rad))
+    return alpha
+
+
+def add_corners(im, rad, multiplier=6):
+    im.putalpha(_corner_alpha(im.size, rad, multiplier))
+    return im
+
+
+@functools.lru_cache(maxsize=16)
+def rounded_square(raw_length: int, size: int, color, rad: int) -> Image.Image:
+    """Square of `color` with corners of radius `rad`, drawn at `raw_length` and scaled to `size`."""
+    square = add_corners(Image.new("RGBA", (raw_length, raw_length), color), rad)
+    return square.resize((size, size), Image.ANTIALIAS)
+
+
+@functools.lru_cache(maxsize=16)
+def _shadow_backdrop(mode, size, offset, background, shadow, border, iterations):
+    totalWidth = size[0] + abs(offset[0]) + 2 * border
+    totalHeight = size[1] + abs(offset[1]) + 2 * border
+    back = Image.new(mode, (totalWidth, totalHeight), background)
+
+    # Place the shadow, taking into account the offset from the image
+    shadowLeft = border + max(offset[0], 0)
+    shadowTop = border + max(offset[1], 0)
+    back.paste(shadow, [shadowLeft, shadowTop, shadowLeft + size[0], shadowTop + size[1]])
+
+    n = 0
+    while n < iterations:
+        back = back.filter(ImageFilter.BLUR)
+        n += 1
+    return back
+
+
+def add_dropshadow(image, offset=(4, 4), background=0x000, shadow=0x0F0, border=3, iterations=5):
+    back = _shadow_backdrop(image.mode, image.size, tuple(offset), background, shadow, border, iterations).copy()
+
+    # Paste the input image onto the shadow backdrop
+    imageLeft = border - min(offset[0], 0)
+    imageTop = border - min(offset[1], 0)
+    back.paste(image, (imageLeft, imageTop))
+    return back
+
+
+@functools.lru_cache(maxsize=4096)
+def _advance(font, text):
+    return font.getsize(text)[0]
+
+
+def _font_runs(text, font, unicode_font) -> Iterator[Tuple[str, ImageFont.FreeTypeFont]]:
+    """Split `text` into runs drawn with the same font.
+
+    A character stays in `font` whenever it has a glyph there and falls back
+    to `unicode_font` only when that one covers it instead.
+    """
+    primary, fallback = glyph_coverage(font), glyph_coverage(unicode_font)
+    run_start, run_font = 0, None
+    for index, char in enumerate(text):
+        code = ord(char)
+        char_font = font if code in primary or code not in fallback else unicode_font
+        if char_font is not run_font:
+            if index > run_start:
+                yield text[run_start:index], run_font
+            run_start, run_font = index, char_font
+    if run_start < len(text):
+        yield text[run_start:], run_font
+
+
+def _write_unicode(draw, text, init_x, y, font, unicode_font, fill):
+    write_pos = init_x
+
+    for run, run_font in _font_runs(text, font, unicode_font):
+        draw.text((write_pos, y), run, font=run_font, fill=fill)
+        write_pos += _advance(run_font, run)
+
+
+def _to_png(result, process) -> bytes:
+    image_object = BytesIO()
+    result = Image.alpha_composite(result, process)
+    result.save(image_object, format="PNG")
+    return image_object.getvalue()
+
+
+def palette(im, clusters=10) -> List[str]:
+    """Hex colours `im` reduces to with PIL's median cut, most abundant first."""
+    quantized = im.convert("RGB").quantize(colors=clusters)
+    counts = numpy.bincount(numpy.asarray(quantized).ravel(), minlength=clusters)
+    flat = quantized.getpalette()
+    return ["".join(format(c, "02x") for c in flat[i * 3 : i * 3 + 3]) for i in numpy.argsort(-counts) if counts[i]]
+
+
+def render_profile(spec: ProfileSpec) -> bytes:
+    header_u_fnt = font(spec.data_path, "unicode", 18)
+    sub_header_fnt = font(spec.data_path, "bold", 14)
+    exp_fnt = font(spec.data_path, "bold", 14)
+    level_label_fnt = font(spec.data_path, "bold", 22)
+    general_info_fnt = font(spec.data_path, "bold", 15)
+    general_info_u_fnt = font(spec.data_path, "unicode", 12)
+    rep_fnt = font(spec.data_path, "bold", 26)
+    text_fnt = font(spec.data_path, "bold", 12)
+    text_u_fnt = font(spec.data_path, "unicode", 8)
+
+    # set canvas
+    bg_color = (255, 255, 255, 0)
+    result = Image.new("RGBA", (290, 290), bg_color)
+    process = Image.new("RGBA", (290, 290), bg_color)
+
+    # draw
+    draw = ImageDraw.Draw(process)
+
+    # puts in background
+    result.paste(spec.background, (0, 0))
+
+    # draw filter
+    draw.rectangle([(0, 0), (290, 290)], fill=(0, 0, 0, 10))
+
+    # draw transparent overlay
+    vert_pos = 110
+    left_pos = 70
+    right_pos = 285
+    title_height = 22
+    # gap = 3
+
+    # determines rep section color
+    rep_fill = tuple(spec.rep_color) if spec.rep_color else (92, 130, 203, 230)
+    # determines badge section color, should be behind the titlebar
+    badge_fill = tuple(spec.badge_col_color) if spec.badge_col_color else (128, 151, 165, 230)
+    info_color = tuple(spec.info_color) if spec.info_color else (30, 30, 30, 220)
+
+    draw.rectangle([(left_pos - 20, vert_pos + title_height), (right_pos, 156)], fill=info_color)  # title box
+    draw.rectangle([(100, 159), (285, 212)], fill=info_color)  # general content
+    draw.rectangle([(100, 215), (285, 285)], fill=info_color)  # info content
+
+    draw.rectangle(
+        [(5, vert_pos), (right_pos, vert_pos + title_height)], fill=(230, 230, 230, 230)
+    )  # name box in front
+
+    # draw level circle
+    multiplier = 8
+    lvl_circle_dia = 104
+    circle_left = 1
+    circle_top = 42
+    raw_length = lvl_circle_dia * multiplier
+
+    # drawing level bar calculate angle
+    start_angle = -90  # from top instead of 3oclock
+    angle = int(360 * xp.progress(spec.level, spec.current_exp)) + start_angle
+
+    # determines exp bar color
+    exp_fill = tuple(spec.exp_color) if spec.exp_color else (255, 255, 255, 230)
+    # level outline with the exp bar, put on level bar circle
+    lvl_circle = level_ring(
+        raw_length,
+        lvl_circle_dia,
+        (badge_fill[0], badge_fill[1], badge_fill[2], 180),
+        (255, 255, 255, 250),
+        exp_fill,
+        (255, 255, 255, 255),
+        angle,
+    )
+    process.paste(lvl_circle, (circle_left, circle_top), circle_mask(raw_length, lvl_circle_dia))
+
+    # draws boxes
+    draw.rectangle([(5, 133), (100, 285)], fill=badge_fill)  # badges
+    draw.rectangle([(10, 138), (95, 168)], fill=rep_fill)  # reps
+
+    # put in profile picture
+    total_gap = 6
+    border = int(total_gap / 2)
+    profile_size = lvl_circle_dia - total_gap
+    profile_image = spec.avatar.resize((profile_size, profile_size), Image.ANTIALIAS)
+    process.paste(profile_image, (circle_left + border, circle_top + border), circle_mask(raw_length, profile_size))
+
+    # write label text
+    white_color = (240, 240, 240, 255)
+    light_color = (160, 160, 160, 255)
+
+    head_align = 105
+    _write_unicode(
+        draw, truncate_text(spec.name, 22), head_align, vert_pos + 3, level_label_fnt, header_u_fnt, (110, 110, 110, 255),
+    )  # NAME
+    _write_unicode(draw, spec.title, head_align, 136, level_label_fnt, header_u_fnt, white_color)
+
+    # draw level box
+    level_right = 290
+    level_left = level_right - 78
+    draw.rectangle(
+        [(level_left, 0), (level_right, 21)], fill=(badge_fill[0], badge_fill[1], badge_fill[2], 160),
+    )  # box
+    lvl_text = "LEVEL {}".format(spec.level)
+    if badge_fill == (128, 151, 165, 230):
+        lvl_color = white_color
+    else:
+        lvl_color = contrast(badge_fill, rep_fill, exp_fill)
+    draw.text(
+        (center(level_left + 2, level_right, lvl_text, level_label_fnt), 2),
+        lvl_text,
+        font=level_label_fnt,
+        fill=(lvl_color[0], lvl_color[1], lvl_color[2], 255),
+    )  # Level #
+
+    rep_text = "{} REP".format(spec.rep)
+    draw.text(
+        (center(7, 100, rep_text, rep_fnt), 144), rep_text, font=rep_fnt, fill=white_color,
+    )
+
+    exp_text = "{}/{}".format(spec.current_exp, xp.required_exp(spec.level))  # Exp
+    exp_color = exp_fill
+    draw.text((105, 99), exp_text, font=exp_fnt, fill=(exp_color[0], exp_color[1], exp_color[2], 255))  # Exp Text
+
+    # determine info text color
+    dark_text = (35, 35, 35, 230)
+    info_text_color = contrast(info_color, light_color, dark_text)
+
+    # lvl_left = 100
+    label_align = 105
+    _write_unicode(draw, "Rank:", label_align, 165, general_info_fnt, general_info_u_fnt, info_text_color)
+    draw.text((label_align, 180), "Exp:", font=general_info_fnt, fill=info_text_color)  # Exp
+    draw.text((label_align, 195), "Credits:", font=general_info_fnt, fill=info_text_color)  # Credits
+
+    # local stats
+    num_local_align = 172
+    # local_symbol = "\U0001F3E0 "
+    if "linux" in platform.system().lower():
+        local_symbol = "\U0001F3E0 "
+    else:
+        local_symbol = "S "
+
+    s_rank_txt = local_symbol + truncate_text(f"#{spec.server_rank}", 8)
+    _write_unicode(
+        draw,
+        s_rank_txt,
+        num_local_align - general_info_u_fnt.getsize(local_symbol)[0],
+        165,
+        general_info_fnt,
+        general_info_u_fnt,
+        info_text_color,
+    )  # Rank
+
+    s_exp_txt = truncate_text(f"{spec.server_exp}", 8)
+    _write_unicode(
+        draw, s_exp_txt, num_local_align, 180, general_info_fnt, general_info_u_fnt, info_text_color
+    )  # Exp
+    credit_txt = "${}".format(spec.credits)
+    draw.text(
+        (num_local_align, 195), truncate_text(credit_txt, 18), font=general_info_fnt, fill=info_text_color,
+    )  # Credits
+
+    # global stats
+    num_align = 230
+    if "linux" in platform.system().lower():
+        global_symbol = "\U0001F30E "
+        fine_adjust = 1
+    else:
+        global_symbol = "G "
+        fine_adjust = 0
+
+    rank_number = spec.global_rank if spec.global_rank else "?"
+    rank_txt = global_symbol + truncate_text(f"#{rank_number}", 8)
+    exp_txt = truncate_text(f"{spec.total_exp}", 8)
+    _write_unicode(
+        draw,
+        rank_txt,
+        num_align - general_info_u_fnt.getsize(global_symbol)[0] + fine_adjust,
+        165,
+        general_info_fnt,
+        general_info_u_fnt,
+        info_text_color,
+    )  # Rank
+    _write_unicode(draw, exp_txt, num_align, 180, general_info_fnt, general_info_u_fnt, info_text_color)  # Exp
+
+    draw.text((105, 220), "Info Box", font=sub_header_fnt, fill=white_color)  # Info Box
+    margin = 105
+    offset = 238
+    for line in textwrap.wrap(spec.info, width=42):
+        # draw.text((margin, offset), line, font=text_fnt, fill=(70,70,70,255))
+        _write_unicode(draw, line, margin, offset, text_fnt, text_u_fnt, info_text_color)
+        offset += text_fnt.getsize(line)[1] + 2
+
+    # TODO: simplify this. it shouldn't be this complicated... sacrifices conciseness for customizability
+    if spec.badge_type == "circles":
+        # circles require antialiasing
+        vert_pos = 171
+        right_shift = 0
+        left = 9 + right_shift
+        # right = 52 + right_shift
+        size = 27
+        total_gap = 4  # /2
+        hor_gap = 3
+        vert_gap = 2
+        border_width = int(total_gap / 2)
+        multiplier = 6  # for antialiasing
+        raw_length = size * multiplier
+        outer_mask = circle_mask(raw_length, size)
+        inner_mask = circle_mask(raw_length, size - total_gap)
+
+        for i, (badge_image, border_color) in enumerate(spec.badges[:12]):
+            try:
+                coord = (
+                    left + (i % 3) * int(hor_gap + size),
+                    vert_pos + (i // 3) * int(vert_gap + size),
+                )
+
+                # structured like this because if border = 0, still leaves outline.
+                if border_color:
+                    square = Image.new("RGBA", (raw_length, raw_length), border_color)
+                    # put border on ellipse/circle
+                    output = square.resize((size, size), Image.ANTIALIAS)
+                    process.paste(output, coord, outer_mask)
+
+                    # put on ellipse/circle
+                    output = ImageOps.fit(badge_image, (raw_length, raw_length), centering=(0.5, 0.5))
+                    output = output.resize((size - total_gap, size - total_gap), Image.ANTIALIAS)
+                    process.paste(
+                        output, (coord[0] + border_width, coord[1] + border_width), inner_mask,
+                    )
+                else:
+                    # put on ellipse/circle
+                    output = ImageOps.fit(badge_image, (raw_length, raw_length), centering=(0.5, 0.5))
+                    output = output.resize((size, size), Image.ANTIALIAS)
+                    process.paste(output, coord, outer_mask)
+            except Exception:
+                log.debug("Could not draw a profile badge", exc_info=True)
+    elif spec.badge_type == "bars":
+        vert_pos = 187
+        left_pos = 10
+        right_pos = 95
+        total_gap = 4
+        border_width = int(total_gap / 2)
+        for i, (badge_image, border_color) in enumerate(spec.badges[:5]):
+            if border_color is not None:
+                draw.rectangle(
+                    [(left_pos, vert_pos + i * 17), (right_pos, vert_pos + 15 + i * 17)],
+                    fill=border_color,
+                    outline=border_color,
+                )  # border
+                process.paste(
+                    badge_image, (left_pos + border_width, vert_pos + border_width + i * 17),
+                )
+            else:
+                process.paste(badge_image, (left_pos, vert_pos + i * 17))
+
+            vert_pos += 3  # spacing
+
+    return _to_png(result, process)
+
+
+def render_rank(spec: RankSpec) -> bytes:
+    # fonts
+    name_fnt = font(spec.data_path, "bold", 22)
+    header_u_fnt = font(spec.data_path, "unicode", 18)
+    level_label_fnt = font(spec.data_path, "bold", 22)
+    general_info_fnt = font(spec.data_path, "bold", 15)
+
+    # set canvas
+    width = 360
+    height = 100
+    bg_color = (255, 255, 255, 0)
+    result = Image.new("RGBA", (width, height), bg_color)
+    process = Image.new("RGBA", (width, height), bg_color)
+
+    # puts in background
+    result.paste(spec.background, (0, 0))
+
+    # draw
+    draw = ImageDraw.Draw(process)
+
+    # draw transparent overlay
+    vert_pos = 5
+    left_pos = 70
+    right_pos = width - vert_pos
+    title_height = 22
+    gap = 3
+
+    draw.rectangle(
+        [(left_pos - 20, vert_pos), (right_pos, vert_pos + title_height)], fill=(230, 230, 230, 230),
+    )  # title box
+    content_top = vert_pos + title_height + gap
+    content_bottom = 100 - vert_pos
+
+    if spec.info_color:
+        info_color = (spec.info_color[0], spec.info_color[1], spec.info_color[2], 160)  # increase transparency
+    else:
+        info_color = (30, 30, 30, 160)
+    draw.rectangle(
+        [(left_pos - 20, content_top), (right_pos, content_bottom)], fill=info_color, outline=(180, 180, 180, 180),
+    )  # content box
+
+    # draw level circle
+    multiplier = 6
+    lvl_circle_dia = 94
+    circle_left = 15
+    circle_top = int((height - lvl_circle_dia) / 2)
+    raw_length = lvl_circle_dia * multiplier
+
+    # drawing level bar calculate angle
+    start_angle = -90  # from top instead of 3oclock
+    angle = int(360 * xp.progress(spec.level, spec.current_exp)) + start_angle
+
+    # determines exp bar color
+    exp_fill = tuple(spec.exp_color) if spec.exp_color else (255, 255, 255, 230)
+    # put on level bar circle
+    lvl_circle = level_ring(
+        raw_length, lvl_circle_dia, (180, 180, 180, 180), (255, 255, 255, 220), exp_fill, (255, 255, 255, 230), angle,
+    )
+    process.paste(lvl_circle, (circle_left, circle_top), circle_mask(raw_length, lvl_circle_dia))
+
+    # put in profile picture
+    total_gap = 10
+    border = int(total_gap / 2)
+    profile_size = lvl_circle_dia - total_gap
+    profile_image = spec.avatar.resize((profile_size, profile_size), Image.ANTIALIAS)
+    process.paste(profile_image, (circle_left + border, circle_top + border), circle_mask(raw_length, profile_size))
+
+    # draw level box
+    level_left = 274
+    level_right = right_pos
+    draw.rectangle([(level_left, vert_pos), (level_right, vert_pos + title_height)], fill="#AAA")  # box
+    lvl_text = "LEVEL {}".format(spec.level)
+    draw.text(
+        (center(level_left, level_right, lvl_text, level_label_fnt), vert_pos + 3),
+        lvl_text,
+        font=level_label_fnt,
+        fill=(110, 110, 110, 255),
+    )  # Level #
+
+    # labels text colors
+    white_text = (240, 240, 240, 255)
+    dark_text = (35, 35, 35, 230)
+    label_text_color = contrast(info_color, white_text, dark_text)
+
+    # draw text
+    grey_color = (110, 110, 110, 255)
+
+    # put in server picture
+    server_size = content_bottom - content_top - 10
+    server_border_size = server_size + 4
+    radius = 20
+    light_border = (150, 150, 150, 180)
+    dark_border = (90, 90, 90, 180)
+    border_color = contrast(info_color, light_border, dark_border)
+
+    draw_server_border = rounded_square(
+        server_border_size * multiplier, server_border_size, border_color, int(radius * multiplier / 2)
+    )
+    server_icon_image = spec.server_icon.resize((server_size * multiplier, server_size * multiplier), Image.ANTIALIAS)
+    server_icon_image = add_corners(server_icon_image, int(radius * multiplier / 2) - 10)
+    server_icon_image = server_icon_image.resize((server_size, server_size), Image.ANTIALIAS)
+    process.paste(
+        draw_server_border, (circle_left + profile_size + 2 * border + 8, content_top + 3), draw_server_border,
+    )
+    process.paste(
+        server_icon_image, (circle_left + profile_size + 2 * border + 10, content_top + 5), server_icon_image,
+    )
+
+    # name
+    left_text_align = 130
+    _write_unicode(
+        draw, truncate_text(spec.name, 20), left_text_align - 12, vert_pos + 3, name_fnt, header_u_fnt, grey_color,
+    )  # Name
+
+    # divider bar
+    draw.rectangle([(187, 45), (188, 85)], fill=(160, 160, 160, 220))
+
+    # labels
+    label_align = 200
+    draw.text((label_align, 38), "Server Rank:", font=general_info_fnt, fill=label_text_color)  # Server Rank
+    draw.text((label_align, 58), "Server Exp:", font=general_info_fnt, fill=label_text_color)  # Server Exp
+    draw.text((label_align, 78), "Credits:", font=general_info_fnt, fill=label_text_color)  # Credit
+    # info
+    right_text_align = 290
+    rank_txt = f"#{spec.server_rank}"
+    draw.text(
+        (right_text_align, 38), truncate_text(rank_txt, 12), font=general_info_fnt, fill=label_text_color,
+    )  # Rank
+    exp_txt = f"{spec.server_exp}"
+    draw.text(
+        (right_text_align, 58), truncate_text(exp_txt, 12), font=general_info_fnt, fill=label_text_color,
+    )  # Exp
+    credit_txt = f"${spec.credits}"
+    draw.text(
+        (right_text_align, 78), truncate_text(credit_txt, 12), font=general_info_fnt, fill=label_text_color,
+    )  # Credits
+
+    return _to_png(result, process)
+
+
+def render_levelup(spec: LevelupSpec) -> bytes:
+    # set canvas
+    width = 175
+    height = 65
+    bg_color = (255, 255, 255, 0)
+    result = Image.new("RGBA", (width, height), bg_color)
+    process = Image.new("RGBA", (width, height), bg_color)
+
+    # draw
+    draw = ImageDraw.Draw(process)
+
+    # puts in background
+    result.paste(spec.background, (0, 0))
+
+    # draw transparent overlay
+    if spec.info_color:
+        info_color = (spec.info_color[0], spec.info_color[1], spec.info_color[2], 150)  # increase transparency
+    else:
+        info_color = (30, 30, 30, 150)
+    draw.rectangle([(38, 5), (170, 60)], fill=info_color)  # info portion
+
+    # draw level circle
+    multiplier = 6
+    lvl_circle_dia = 60
+    circle_left = 4
+    circle_top = int((height - lvl_circle_dia) / 2)
+    raw_length = lvl_circle_dia * multiplier
+
+    # put on level bar circle
+    lvl_circle = level_ring(raw_length, lvl_circle_dia, (255, 255, 255, 220), (255, 255, 255, 220))
+    process.paste(lvl_circle, (circle_left, circle_top), circle_mask(raw_length, lvl_circle_dia))
+
+    # put in profile picture
+    total_gap = 6
+    border = int(total_gap / 2)
+    profile_size = lvl_circle_dia - total_gap
+    profile_image = spec.avatar.resize((profile_size, profile_size), Image.ANTIALIAS)
+    process.paste(profile_image, (circle_left + border, circle_top + border), circle_mask(raw_length, profile_size))
+
+    # fonts
+    level_fnt = font(spec.data_path, "bold", 26)
+
+    # write label text
+    white_text = (240, 240, 240, 255)
+    dark_text = (35, 35, 35, 230)
+    level_up_text = contrast(info_color, white_text, dark_text)
+    lvl_text = "LEVEL {}".format(spec.level)
+    draw.text(
+        (center(50, 170, lvl_text, level_fnt), 22), lvl_text, font=level_fnt, fill=level_up_text,
+    )  # Level Number
+
+    return _to_png(result, process)
+
+
+class RenderPool:
+    """Runs render functions in a thread or process pool, at most `limit` at a time.
+
+    Callers past the limit wait on the event loop rather than piling up inside
+    the executor; `waiting`, `peak_waiting` and the timing totals are kept for
+    `lvladmin stats`.
+    """
+
+    def __init__(self, workers: int = 2, processes: bool = False, initializer=None, initargs=()):
+        self.workers = workers
+        self.processes = processes
+        # run once in every worker process, threads share the parent's state
+        self.initializer = initializer
+        self.initargs = initargs
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.active = 0
+        self.completed = 0
+        self.render_time = 0.0
+        self._executor: Optional[Executor] = None
+        self._slots = asyncio.Semaphore(workers)
+
+    def configure(self, workers: int, processes: bool):
+        if (workers, processes) == (self.workers, self.processes):
+            return
+        self.shutdown()
+        self.workers = workers
+        self.processes = processes
+        self._slots = asyncio.Semaphore(workers)
+
+    async def run(self, func, *args):
+        if self._executor is None:
+            if self.processes:
+                self._executor = ProcessPoolExecutor(
+                    self.workers, initializer=self.initializer, initargs=self.initargs
+                )
+            else:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="leveler-render")
+        slots = self._slots
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        try:
+            await slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.render_time += time.perf_counter() - start
+            self.completed += 1
+            self.active -= 1
+            slots.release()
+
+    def shutdown(self):
+        if self._executor is not None:
+            # running renders still finish, their callers get the result
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,78 @@
+"""In-memory snapshots of the global leaderboards, refreshed on a schedule instead of per command."""
+import asyncio
+import time
+from typing import List, Optional, Tuple
+
+import numpy
+
+
+class BoardSnapshot:
+    """Every user ranked by one field of their user document.
+
+    Ids and scores of all users on the board are kept in numpy arrays sorted by score, one entry per
+    user, next to the ids sorted by themselves, so finding anyone and then their rank are two binary
+    searches; names are only kept for the `size` users that can be paged through.
+    """
+
+    def __init__(self, field: str, minimum: int, size: int = 300):
+        self.field = field
+        self.minimum = minimum
+        self.size = size
+        self.top: List[Tuple[str, int]] = []
+        self.taken_at: Optional[float] = None
+        self.refresh_time = 0.0
+        self._ids = numpy.empty(0, dtype=numpy.int64)
+        self._scores = numpy.empty(0, dtype=numpy.int64)
+        self._sorted_ids = numpy.empty(0, dtype=numpy.int64)
+        self._positions = numpy.empty(0, dtype=numpy.int64)
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, collection):
+        """Rebuild the board from one projected cursor over `collection`, sorted by the indexed field."""
+        async with self._lock:
+            start = time.perf_counter()
+            top, listed, ids, scores = [], set(), [], []
+            cursor = collection.find(
+                {self.field: {"$gte": self.minimum}}, {"_id": 0, "user_id": 1, "username": 1, self.field: 1}
+            ).sort(self.field, -1)
+            async for userinfo in cursor.batch_size(1000):
+                user_id = int(userinfo["user_id"])
+                if len(top) < self.size and user_id not in listed:
+                    listed.add(user_id)
+                    top.append((userinfo.get("username") or userinfo["user_id"], userinfo[self.field]))
+                ids.append(user_id)
+                scores.append(userinfo[self.field])
+            self.top = sorted(top, key=lambda entry: entry[1], reverse=True)
+            ids = numpy.array(ids, dtype=numpy.int64)
+            scores = numpy.array(scores, dtype=numpy.int64)
+            # a user whose score moves while the cursor runs can come back twice, the first sighting stays
+            _, first = numpy.unique(ids, return_index=True)
+            first.sort()
+            ids, scores = ids[first], scores[first]
+            # the cursor's order isn't guaranteed to hold across those moves, the rank search needs it to
+            order = numpy.argsort(-scores, kind="stable")
+            self._ids = ids[order]
+            self._scores = scores[order]
+            # where each id sits on the board, in id order
+            self._positions = numpy.argsort(self._ids, kind="stable")
+            self._sorted_ids = self._ids[self._positions]
+            self.taken_at = time.time()
+            self.refresh_time = time.perf_counter() - start
+
+    def rank(self, user_id: int) -> Optional[Tuple[int, int]]:
+        """(rank, score) of `user_id`, or None if they are not on the board."""
+        i = int(numpy.searchsorted(self._sorted_ids, user_id))
+        if i == len(self._sorted_ids) or self._sorted_ids[i] != user_id:
+            return None
+        score = self._scores[self._positions[i]]
+        # same rule as the count queries: one plus the number of users with a higher score
+        return int(numpy.searchsorted(-self._scores, -score, side="left")) + 1, int(score)
+
+    @property
+    def age(self) -> str:
+        if self.taken_at is None:
+            return "never"
+        seconds = int(time.time() - self.taken_at)
+        if seconds < 60:
+            return f"{seconds}s ago"
+        return f"{seconds // 60}m ago"
@@ -0,0 +1,799 @@
+"""Where Leveler keeps its data: a MongoDB server, or an SQLite file in the cog's data folder.
+
+The cog talks to both through the same collection calls (`find`, `find_one`, `update_one`,
+`find_one_and_update`, `bulk_write`, `aggregate`, ...). On MongoDB those are motor's own;
+`SQLiteDatabase` implements the part of them, and of the query, update and aggregation
+operators, that Leveler uses.
+"""
+import asyncio
+import copy
+import json
+import logging
+import math
+import operator
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import InsertOne, ReturnDocument, UpdateMany, UpdateOne
+from pymongo import errors as mongoerrors
+
+log = logging.getLogger("red.aikaterna.leveler.storage")
+
+BACKENDS = ("mongo", "sqlite")
+# what `connect` raises when the configured backend can't be used
+CONNECT_ERRORS = (
+    mongoerrors.ServerSelectionTimeoutError,
+    mongoerrors.ConfigurationError,
+    mongoerrors.OperationFailure,
+    sqlite3.Error,
+    OSError,
+)
+
+
+class MongoBackend:
+    """The MongoDB server set up with `levelerset host/port/credentials/dbname`."""
+
+    name = "mongo"
+
+    def __init__(self, config: dict):
+        self.config = config
+        self.client = None
+        self.db = None
+
+    async def connect(self):
+        self.client = AsyncIOMotorClient(**{k: v for k, v in self.config.items() if not k == "db_name"})
+        await self.client.server_info()
+        self.db = self.client[self.config["db_name"]]
+
+    def close(self):
+        if self.client:
+            self.client.close()
+
+    def describe(self) -> str:
+        return f"MongoDB at {self.config['host']}:{self.config['port']}, database {self.config['db_name']}"
+
+
+class SQLiteBackend:
+    """An SQLite file, for setups without a database server."""
+
+    name = "sqlite"
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.db = None
+
+    async def connect(self):
+        db = SQLiteDatabase(self.path)
+        try:
+            await db.open()
+        except Exception:
+            db.close()
+            raise
+        self.db = db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+    def describe(self) -> str:
+        return f"SQLite file {self.path}"
+
+
+class WriteResult(NamedTuple):
+    """Counts of a write, named like the fields of pymongo's result objects."""
+
+    matched_count: int = 0
+    modified_count: int = 0
+    upserted_count: int = 0
+    upserted_id: Any = None
+    inserted_id: Any = None
+
+
+class _Update(NamedTuple):
+    matched: int
+    modified: int
+    upserted_id: Optional[int]
+    before: Optional[dict]
+    after: Optional[dict]
+
+
+class SQLiteDatabase:
+    """Collections of JSON documents in one SQLite file, in WAL mode.
+
+    Every call runs on one worker thread, so each read-modify-write is atomic the way single
+    document updates are on MongoDB, and the event loop never waits on the file.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="leveler-sqlite")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._tables = set()
+        self._collections: Dict[str, SQLiteCollection] = {}
+
+    def __getitem__(self, name: str) -> "SQLiteCollection":
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = SQLiteCollection(self, name)
+        return collection
+
+    def __getattr__(self, name: str) -> "SQLiteCollection":
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    async def open(self):
+        await self._run(self._open)
+
+    def close(self):
+        self._executor.submit(self._close)
+        self._executor.shutdown(wait=False)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _write(self, func, *args):
+        return await self._run(self._in_transaction, func, *args)
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # WAL keeps the file consistent on a crash with NORMAL, only the last commits can be lost
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS "_indexes" '
+            "(collection TEXT, name TEXT, keys TEXT, is_unique INTEGER, PRIMARY KEY (collection, name))"
+        )
+        self._tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        self._conn = conn
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _table(self, name: str) -> str:
+        """The quoted table holding collection `name`, created on first use."""
+        if name not in self._tables:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {_quote(name)} (_id INTEGER PRIMARY KEY AUTOINCREMENT, doc TEXT NOT NULL)"
+            )
+            self._tables.add(name)
+        return _quote(name)
+
+    def _in_transaction(self, func, *args):
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(*args)
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        return result
+
+
+class SQLiteCollection:
+    """One collection of an `SQLiteDatabase`, with the motor collection methods Leveler calls."""
+
+    def __init__(self, database: SQLiteDatabase, name: str):
+        self.database = database
+        self.name = name
+
+    def find(self, filter: dict = None, projection: dict = None) -> "SQLiteCursor":
+        return SQLiteCursor(self, filter or {}, projection)
+
+    async def find_one(self, filter: dict = None, projection: dict = None) -> Optional[dict]:
+        docs = await self.database._run(self._select, filter or {}, (), 0, 1, projection)
+        return docs[0] if docs else None
+
+    async def count_documents(self, filter: dict) -> int:
+        return await self.database._run(self._count, filter)
+
+    def aggregate(self, pipeline: List[dict]) -> "_Aggregation":
+        return _Aggregation(self, pipeline)
+
+    async def insert_one(self, document: dict) -> WriteResult:
+        document["_id"] = await self.database._write(self._insert, document)
+        return WriteResult(inserted_id=document["_id"])
+
+    async def update_one(self, filter: dict, update, upsert: bool = False) -> WriteResult:
+        return _write_result(await self.database._write(self._update, filter, update, upsert, False))
+
+    async def update_many(self, filter: dict, update, upsert: bool = False) -> WriteResult:
+        return _write_result(await self.database._write(self._update, filter, update, upsert, True))
+
+    async def find_one_and_update(
+        self,
+        filter: dict,
+        update,
+        projection: dict = None,
+        upsert: bool = False,
+        return_document: bool = ReturnDocument.BEFORE,
+    ) -> Optional[dict]:
+        result = await self.database._write(self._update, filter, update, upsert, False)
+        doc = result.after if return_document == ReturnDocument.AFTER else result.before
+        return None if doc is None else _project(doc, projection)
+
+    async def bulk_write(self, requests, ordered: bool = True) -> WriteResult:
+        result, errors = await self.database._write(self._bulk_write, list(requests), ordered)
+        if errors:
+            raise mongoerrors.BulkWriteError(
+                {"writeErrors": errors, "nMatched": result.matched_count, "nModified": result.modified_count}
+            )
+        return result
+
+    async def create_index(self, keys: List[Tuple[str, int]], unique: bool = False) -> str:
+        return await self.database._run(self._create_index, list(keys), unique)
+
+    async def list_indexes(self):
+        rows = await self.database._run(self._index_rows)
+        yield {"name": "_id_", "key": {"_id": 1}}
+        for name, keys, unique in rows:
+            yield {"name": name, "key": dict(json.loads(keys)), "unique": bool(unique)}
+
+    @property
+    def _table(self) -> str:
+        return self.database._table(self.name)
+
+    def _query(self, filter: dict, sort, skip: int, limit: int, columns: str = "_id, doc"):
+        """SQL for the part of `filter` SQLite can run, and whatever is left to check on the loaded documents.
+
+        Ordering and paging are only done in SQL when nothing is left over.
+        """
+        where, params, residual = _where(filter)
+        order = [(_path_sql(field), direction) for field, direction in sort]
+        if any(column is None for column, _ in order):
+            residual = residual or {"$and": []}
+        sql = f"SELECT {columns} FROM {self._table} WHERE {where}"
+        if residual is None:
+            if order:
+                sql += " ORDER BY " + ", ".join(f"{c} {'DESC' if d == -1 else 'ASC'}" for c, d in order)
+            if limit or skip:
+                sql += " LIMIT ? OFFSET ?"
+                params += [limit or -1, skip]
+        return sql, params, residual
+
+    def _select(self, filter: dict, sort=(), skip: int = 0, limit: int = 0, projection: dict = None) -> List[dict]:
+        sql, params, residual = self._query(filter, sort, skip, limit)
+        docs = [_load(row) for row in self.database._conn.execute(sql, params)]
+        if residual is not None:
+            docs = _sorted([doc for doc in docs if _matches(doc, residual)], sort)
+            docs = docs[skip : skip + limit if limit else None]
+        return [_project(doc, projection) for doc in docs] if projection else docs
+
+    def _count(self, filter: dict) -> int:
+        sql, params, residual = self._query(filter, (), 0, 0, columns="COUNT(*)")
+        if residual is None:
+            return self.database._conn.execute(sql, params).fetchone()[0]
+        return len(self._select(filter))
+
+    def _explain(self, filter: dict, sort, skip: int, limit: int) -> dict:
+        """SQLite's query plan, described with the stage names of a MongoDB `explain()`."""
+        sql, params, residual = self._query(filter, sort, skip, limit)
+        details = [row[-1] for row in self.database._conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+        scan = any(d.startswith("SCAN") and "INDEX" not in d for d in details)
+        plan = {"stage": "COLLSCAN" if scan else "IXSCAN", "details": details}
+        if any("TEMP B-TREE" in d for d in details):
+            plan = {"stage": "SORT", "inputStage": plan}
+        if residual is not None:
+            plan = {"stage": "FILTER", "inputStage": plan}
+        return {"queryPlanner": {"winningPlan": plan}}
+
+    def _aggregate(self, pipeline: List[dict]) -> List[dict]:
+        stages = list(pipeline)
+        # a leading $match runs in SQL, on the indexes
+        first = stages.pop(0)["$match"] if stages and "$match" in stages[0] else {}
+        docs = self._select(first)
+        for stage in stages:
+            (op, spec), = stage.items()
+            if op == "$match":
+                docs = [doc for doc in docs if _matches(doc, spec)]
+            elif op == "$project":
+                docs = [_project(doc, spec) for doc in docs]
+            elif op in ("$set", "$addFields"):
+                docs = [_apply(doc, [stage]) for doc in docs]
+            elif op == "$lookup":
+                self._lookup(docs, spec)
+            elif op == "$sort":
+                docs = _sorted(docs, list(spec.items()))
+            elif op == "$skip":
+                docs = docs[spec:]
+            elif op == "$limit":
+                docs = docs[:spec]
+            elif op == "$count":
+                docs = [{spec: len(docs)}] if docs else []
+            else:
+                raise mongoerrors.OperationFailure(f"{op} is not supported by the SQLite storage")
+        return docs
+
+    def _lookup(self, docs: List[dict], spec: dict):
+        local, foreign, target = spec["localField"], spec["foreignField"], spec["as"]
+        values = list({v for v in (_get_path(doc, local) for doc in docs) if _is_scalar(v)})
+        matches = defaultdict(list)
+        collection = self.database[spec["from"]]
+        for i in range(0, len(values), 500):
+            for joined in collection._select({foreign: {"$in": values[i : i + 500]}}):
+                matches[_get_path(joined, foreign)].append(joined)
+        for doc in docs:
+            value = _get_path(doc, local)
+            doc[target] = list(matches.get(value, ())) if _is_scalar(value) else []
+
+    def _store(self, sql: str, params) -> sqlite3.Cursor:
+        try:
+            return self.database._conn.execute(sql, params)
+        except sqlite3.IntegrityError as exc:
+            raise mongoerrors.DuplicateKeyError(f"{self.name}: {exc}", 11000) from None
+
+    def _insert(self, document: dict) -> int:
+        return self._store(f"INSERT INTO {self._table} (doc) VALUES (?)", (_dump(document),)).lastrowid
+
+    def _update(self, filter: dict, update, upsert: bool = False, multi: bool = False) -> _Update:
+        docs = self._select(filter, (), 0, 0 if multi else 1)
+        if not docs:
+            if not upsert:
+                return _Update(0, 0, None, None, None)
+            doc = _apply(_seed(filter), update, inserting=True)
+            doc["_id"] = self._insert(doc)
+            return _Update(0, 0, doc["_id"], None, doc)
+        modified = 0
+        before = after = None
+        for doc in docs:
+            old = copy.deepcopy(doc)
+            _apply(doc, update)
+            if doc != old:
+                self._store(f"UPDATE {self._table} SET doc = ? WHERE _id = ?", (_dump(doc), doc["_id"]))
+                modified += 1
+            if before is None:
+                before, after = old, doc
+        return _Update(len(docs), modified, None, before, after)
+
+    def _bulk_write(self, requests, ordered: bool):
+        matched = modified = upserted = 0
+        errors = []
+        for index, request in enumerate(requests):
+            try:
+                if isinstance(request, InsertOne):
+                    self._insert(request._doc)
+                elif isinstance(request, (UpdateOne, UpdateMany)):
+                    multi = isinstance(request, UpdateMany)
+                    result = self._update(request._filter, request._doc, request._upsert, multi)
+                    matched += result.matched
+                    modified += result.modified
+                    upserted += result.upserted_id is not None
+                else:
+                    name = type(request).__name__
+                    raise mongoerrors.OperationFailure(f"{name} is not supported by the SQLite storage")
+            except mongoerrors.DuplicateKeyError as exc:
+                errors.append({"index": index, "code": 11000, "errmsg": str(exc)})
+                if ordered:
+                    break
+        return WriteResult(matched, modified, upserted), errors
+
+    def _create_index(self, keys: List[Tuple[str, int]], unique: bool) -> str:
+        name = "_".join(f"{field}_{order}" for field, order in keys)
+        columns = [(_path_sql(field), order) for field, order in keys]
+        if any(column is None for column, _ in columns):
+            raise mongoerrors.OperationFailure(f"Can't index {name} in the SQLite storage")
+        columns = ", ".join(f"{column} {'DESC' if order == -1 else 'ASC'}" for column, order in columns)
+        try:
+            self.database._conn.execute(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS {_quote(f'{self.name}.{name}')} "
+                f"ON {self._table} ({columns})"
+            )
+        except sqlite3.IntegrityError as exc:
+            raise mongoerrors.OperationFailure(str(exc)) from None
+        self.database._conn.execute(
+            'INSERT OR REPLACE INTO "_indexes" VALUES (?, ?, ?, ?)', (self.name, name, json.dumps(keys), unique)
+        )
+        return name
+
+    def _index_rows(self):
+        return self.database._conn.execute(
+            'SELECT name, keys, is_unique FROM "_indexes" WHERE collection = ?', (self.name,)
+        ).fetchall()
+
+
+class _Cursor:
+    """The part of a motor cursor Leveler uses; the query only runs once results are asked for."""
+
+    def batch_size(self, size: int):
+        return self
+
+    async def to_list(self, length: Optional[int] = None) -> List[dict]:
+        results = await self._results()
+        return results if length is None else results[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in await self._results():
+            yield doc
+
+    async def _results(self) -> List[dict]:
+        raise NotImplementedError
+
+
+class SQLiteCursor(_Cursor):
+    def __init__(self, collection: SQLiteCollection, filter: dict, projection: Optional[dict]):
+        self._collection = collection
+        self._filter = filter
+        self._projection = projection
+        self._sort = []
+        self._skip = 0
+        self._limit = 0
+
+    def sort(self, key, direction: int = None):
+        self._sort = [(key, direction or 1)] if isinstance(key, str) else list(key)
+        return self
+
+    def skip(self, skip: int):
+        self._skip = skip
+        return self
+
+    def limit(self, limit: int):
+        self._limit = limit
+        return self
+
+    async def explain(self) -> dict:
+        return await self._collection.database._run(
+            self._collection._explain, self._filter, self._sort, self._skip, self._limit
+        )
+
+    async def _results(self) -> List[dict]:
+        return await self._collection.database._run(
+            self._collection._select, self._filter, self._sort, self._skip, self._limit, self._projection
+        )
+
+
+class _Aggregation(_Cursor):
+    def __init__(self, collection: SQLiteCollection, pipeline: List[dict]):
+        self._collection = collection
+        self._pipeline = pipeline
+
+    async def _results(self) -> List[dict]:
+        return await self._collection.database._run(self._collection._aggregate, self._pipeline)
+
+
+# documents, paths and SQL
+
+
+_MISSING = object()
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _path_sql(field: str) -> Optional[str]:
+    """`field` as an SQL expression over the stored document, or None if SQLite's JSON paths can't address it.
+
+    Queries and index definitions both come from here, so SQLite sees the same expression and uses the index.
+    """
+    if field == "_id":
+        return "_id"
+    parts = field.split(".")
+    # quoted labels can't hold a quote, and "$**" wildcard paths have no SQL equivalent
+    if any('"' in part or part.startswith("$") for part in parts):
+        return None
+    path = "$" + "".join(f'."{part}"' for part in parts)
+    return "json_extract(doc, '" + path.replace("'", "''") + "')"
+
+
+def _load(row) -> dict:
+    return {"_id": row[0], **json.loads(row[1])}
+
+
+def _dump(doc: dict) -> str:
+    return json.dumps({k: v for k, v in doc.items() if k != "_id"}, separators=(",", ":"))
+
+
+def _write_result(result: _Update) -> WriteResult:
+    return WriteResult(result.matched, result.modified, int(result.upserted_id is not None), result.upserted_id)
+
+
+def _is_scalar(value) -> bool:
+    return value is None or isinstance(value, (str, int, float))
+
+
+def _is_operator_dict(value) -> bool:
+    return isinstance(value, dict) and bool(value) and all(str(k).startswith("$") for k in value)
+
+
+def _get_path(doc, path: str):
+    value = doc
+    for part in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list):
+            # "$user.rep" over a looked up array gives the rep of every element
+            value = [v[part] for v in value if isinstance(v, dict) and part in v]
+        else:
+            return _MISSING
+        if value is _MISSING:
+            return _MISSING
+    return value
+
+
+def _set_path(doc: dict, path: str, value):
+    *parents, last = path.split(".")
+    for part in parents:
+        child = doc.get(part)
+        if not isinstance(child, dict):
+            child = doc[part] = {}
+        doc = child
+    doc[last] = value
+
+
+def _unset_path(doc: dict, path: str):
+    *parents, last = path.split(".")
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(last, None)
+
+
+# query operators
+
+_SQL_COMPARISONS = {"$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+_COMPARISONS = {"$gt": operator.gt, "$gte": operator.ge, "$lt": operator.lt, "$lte": operator.le}
+
+
+def _where(filter: dict):
+    """(SQL condition, parameters, residual filter or None) for `filter`."""
+    clauses, params, residual = [], [], {}
+    for key, cond in filter.items():
+        clause = _clause(key, cond)
+        if clause is None:
+            residual[key] = cond
+        else:
+            clauses.append(clause[0])
+            params += clause[1]
+    return " AND ".join(clauses) or "1", params, residual or None
+
+
+def _clause(key: str, cond):
+    if key in ("$or", "$and"):
+        parts = [_where(sub) for sub in cond]
+        if not parts or any(residual is not None for _, _, residual in parts):
+            return None
+        joiner = " OR " if key == "$or" else " AND "
+        return "(" + joiner.join(f"({sql})" for sql, _, _ in parts) + ")", [p for _, ps, _ in parts for p in ps]
+    if key.startswith("$"):
+        return None
+    column = _path_sql(key)
+    if column is None:
+        return None
+    conditions = cond.items() if _is_operator_dict(cond) else [("$eq", cond)]
+    clauses, params = [], []
+    for op, value in conditions:
+        clause = _comparison(key, column, op, value)
+        if clause is None:
+            return None
+        clauses.append(clause[0])
+        params += clause[1]
+    return " AND ".join(clauses), params
+
+
+def _comparison(key: str, column: str, op: str, value):
+    if op in ("$eq", "$ne") and _is_scalar(value):
+        if value is None:
+            return f"{column} IS {'NOT ' if op == '$ne' else ''}NULL", []
+        if op == "$eq":
+            return f"{column} = ?", [value]
+        return f"({column} IS NULL OR {column} != ?)", [value]
+    if op in _SQL_COMPARISONS and _is_scalar(value) and value is not None:
+        return f"{column} {_SQL_COMPARISONS[op]} ?", [value]
+    if op == "$in" and all(_is_scalar(v) and v is not None for v in value):
+        return f"{column} IN ({', '.join('?' * len(value))})", list(value)
+    if op == "$exists" and key != "_id":
+        return f"json_type{column[len('json_extract'):]} IS {'NOT ' if value else ''}NULL", []
+    return None
+
+
+def _matches(doc: dict, filter: dict) -> bool:
+    for key, cond in filter.items():
+        if key == "$or":
+            if not any(_matches(doc, sub) for sub in cond):
+                return False
+        elif key == "$and":
+            if not all(_matches(doc, sub) for sub in cond):
+                return False
+        else:
+            value = _get_path(doc, key)
+            conditions = cond.items() if _is_operator_dict(cond) else [("$eq", cond)]
+            if not all(_test(value, op, arg) for op, arg in conditions):
+                return False
+    return True
+
+
+def _test(value, op: str, arg) -> bool:
+    if op == "$eq":
+        if arg is None:
+            return value is None or value is _MISSING
+        if isinstance(value, list) and not isinstance(arg, list):
+            return arg in value
+        return value == arg
+    if op == "$ne":
+        return not _test(value, "$eq", arg)
+    if op in _COMPARISONS:
+        return _comparable(value, arg) and _COMPARISONS[op](value, arg)
+    if op == "$in":
+        return any(_test(value, "$eq", a) for a in arg)
+    if op == "$nin":
+        return not any(_test(value, "$eq", a) for a in arg)
+    if op == "$exists":
+        return (value is not _MISSING) == bool(arg)
+    if op == "$not":
+        return not all(_test(value, o, a) for o, a in arg.items())
+    if op == "$type":
+        return bool(_type_names(value) & ({arg} if isinstance(arg, str) else set(arg)))
+    raise mongoerrors.OperationFailure(f"{op} is not supported by the SQLite storage")
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _comparable(a, b) -> bool:
+    return (_is_number(a) and _is_number(b)) or (isinstance(a, str) and isinstance(b, str))
+
+
+def _type_names(value) -> set:
+    if value is _MISSING:
+        return set()
+    if value is None:
+        return {"null"}
+    if isinstance(value, bool):
+        return {"bool"}
+    if isinstance(value, int):
+        return {"number", "int", "long"}
+    if isinstance(value, float):
+        return {"number", "double"}
+    if isinstance(value, str):
+        return {"string"}
+    return {"array"} if isinstance(value, list) else {"object"}
+
+
+def _sort_key(value):
+    # MongoDB's order across types: null, numbers, strings, objects, arrays, booleans
+    if value is None or value is _MISSING:
+        return (0, 0)
+    if _is_number(value):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    if isinstance(value, bool):
+        return (5, value)
+    return (3 if isinstance(value, dict) else 4, json.dumps(value, sort_keys=True))
+
+
+def _sorted(docs: List[dict], sort) -> List[dict]:
+    for field, direction in reversed(list(sort)):
+        docs = sorted(docs, key=lambda doc: _sort_key(_get_path(doc, field)), reverse=direction == -1)
+    return docs
+
+
+def _project(doc: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return doc
+    fields = {k: v for k, v in projection.items() if k != "_id"}
+    if any(v not in (0, False) for v in fields.values()) or (not fields and projection.get("_id")):
+        result = {"_id": doc["_id"]} if projection.get("_id", 1) and "_id" in doc else {}
+        for field, spec in fields.items():
+            value = _get_path(doc, field) if spec is True or spec == 1 else _evaluate(spec, doc)
+            if value is not _MISSING:
+                _set_path(result, field, value)
+        return result
+    result = copy.deepcopy(doc)
+    for field in projection:
+        _unset_path(result, field)
+    return result
+
+
+# updates and aggregation expressions
+
+
+def _seed(filter: dict) -> dict:
+    """The document an upsert starts from: the plain equality fields of its filter."""
+    doc = {}
+    for key, value in filter.items():
+        if not key.startswith("$") and key != "_id" and not _is_operator_dict(value):
+            _set_path(doc, key, value)
+    return doc
+
+
+def _apply(doc: dict, update, inserting: bool = False) -> dict:
+    if isinstance(update, list):
+        for stage in update:
+            (op, spec), = stage.items()
+            if op in ("$set", "$addFields"):
+                # every field of a stage sees the document as it was before the stage
+                values = {field: _evaluate(expr, doc) for field, expr in spec.items()}
+                for field, value in values.items():
+                    if value is _MISSING:
+                        _unset_path(doc, field)
+                    else:
+                        _set_path(doc, field, value)
+            elif op == "$unset":
+                for field in [spec] if isinstance(spec, str) else spec:
+                    _unset_path(doc, field)
+            else:
+                raise mongoerrors.OperationFailure(f"{op} is not supported by the SQLite storage")
+        return doc
+    for op, spec in update.items():
+        if op == "$set" or (op == "$setOnInsert" and inserting):
+            for field, value in spec.items():
+                _set_path(doc, field, copy.deepcopy(value))
+        elif op == "$setOnInsert":
+            continue
+        elif op == "$unset":
+            for field in spec:
+                _unset_path(doc, field)
+        elif op == "$inc":
+            for field, amount in spec.items():
+                current = _get_path(doc, field)
+                _set_path(doc, field, (0 if current in (None, _MISSING) else current) + amount)
+        elif op in ("$max", "$min"):
+            pick = max if op == "$max" else min
+            for field, value in spec.items():
+                current = _get_path(doc, field)
+                _set_path(doc, field, value if current in (None, _MISSING) else pick(current, value))
+        else:
+            raise mongoerrors.OperationFailure(f"{op} is not supported by the SQLite storage")
+    return doc
+
+
+def _nullable(func):
+    def evaluate(*args):
+        return None if any(arg is None for arg in args) else func(*args)
+
+    return evaluate
+
+
+def _array_elem_at(array, index):
+    if array is None or index is None:
+        return None
+    return array[index] if -len(array) <= index < len(array) else _MISSING
+
+
+_EXPRESSIONS = {
+    "$add": _nullable(lambda *args: sum(args)),
+    "$subtract": _nullable(operator.sub),
+    "$multiply": _nullable(lambda *args: math.prod(args)),
+    "$divide": _nullable(operator.truediv),
+    "$sqrt": _nullable(math.sqrt),
+    "$floor": _nullable(math.floor),
+    "$toInt": _nullable(int),
+    "$max": lambda *args: max((arg for arg in args if arg is not None), default=None),
+    "$min": lambda *args: min((arg for arg in args if arg is not None), default=None),
+    "$ifNull": lambda *args: next((arg for arg in args if arg is not None), args[-1]),
+    "$arrayElemAt": _array_elem_at,
+}
+
+
+def _evaluate(expr, doc: dict):
+    if isinstance(expr, str):
+        return _get_path(doc, expr[1:]) if expr.startswith("$") else expr
+    if isinstance(expr, list):
+        return [_evaluate(item, doc) for item in expr]
+    if isinstance(expr, dict):
+        if len(expr) == 1:
+            (op, args), = expr.items()
+            if op == "$literal":
+                return copy.deepcopy(args)
+            if op.startswith("$"):
+                func = _EXPRESSIONS.get(op)
+                if func is None:
+                    raise mongoerrors.OperationFailure(f"{op} is not supported by the SQLite storage")
+                args = args if isinstance(args, list) else [args]
+                values = [_evaluate(arg, doc) for arg in args]
+                return func(*[None if value is _MISSING else value for value in values])
+        return {key: _evaluate(value, doc) for key, value in expr.items()}
+    return expr
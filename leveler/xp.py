@@ -0,0 +1,113 @@
+"""Experience curve maths for Leveler.
+
+Finishing level ``n`` takes ``139 * n + 65`` exp, so the exp needed to reach
+level ``n`` from zero is the closed form ``65 * n + 139 * n * (n - 1) / 2``.
+Everything here uses that closed form instead of summing level by level,
+and the ``*_batch`` variants do the same for whole numpy arrays at once.
+
+The ``*_expr`` variants build the same formulas as MongoDB aggregation
+expressions so updates can level users up atomically on the server.
+
+Run this file directly for a micro-benchmark against the old per-level loop.
+"""
+import math
+
+import numpy
+
+
+def required_exp(level: int) -> int:
+    """Exp needed to complete ``level``."""
+    if level < 0:
+        return 0
+    return 139 * level + 65
+
+
+def level_exp(level: int) -> int:
+    """Cumulative exp needed to reach ``level``."""
+    return level * 65 + 139 * level * (level - 1) // 2
+
+
+def server_exp(level: int, current_exp: int) -> int:
+    """Total exp gathered on a server from the stored level and current exp."""
+    return level_exp(level) + current_exp
+
+
+def find_level(total_exp: int) -> int:
+    """Level reached with ``total_exp`` exp (inverse of `level_exp`)."""
+    if total_exp <= 0:
+        return 0
+    return (9 + math.isqrt(81 + 1112 * int(total_exp))) // 278
+
+
+def progress(level: int, current_exp: int) -> float:
+    """Fraction of the current level completed, in ``[0, 1)``."""
+    return current_exp / required_exp(level)
+
+
+def level_exp_batch(levels) -> numpy.ndarray:
+    """Vectorized `level_exp`."""
+    levels = numpy.asarray(levels, dtype=numpy.int64)
+    return levels * 65 + 139 * levels * (levels - 1) // 2
+
+
+def server_exp_batch(levels, current_exps) -> numpy.ndarray:
+    """Vectorized `server_exp`."""
+    return level_exp_batch(levels) + numpy.asarray(current_exps, dtype=numpy.int64)
+
+
+def find_level_batch(total_exps) -> numpy.ndarray:
+    """Vectorized `find_level`."""
+    total_exps = numpy.maximum(numpy.asarray(total_exps, dtype=numpy.int64), 0)
+    levels = ((9 + numpy.sqrt(81 + 1112 * total_exps.astype(numpy.float64))) // 278).astype(numpy.int64)
+    # float sqrt can land one off for very large totals, nudge back onto the curve
+    levels += level_exp_batch(levels + 1) <= total_exps
+    levels -= level_exp_batch(levels) > total_exps
+    return levels
+
+
+# the same curve as MongoDB aggregation expressions, for updates that do the maths server-side;
+# `level` / `current_exp` / `total_exp` are field paths ("$...") or other expressions
+def level_exp_expr(level) -> dict:
+    """`level_exp` as an aggregation expression."""
+    triangle = {"$divide": [{"$multiply": [139, level, {"$subtract": [level, 1]}]}, 2]}
+    return {"$add": [{"$multiply": [level, 65]}, triangle]}
+
+
+def server_exp_expr(level, current_exp) -> dict:
+    """`server_exp` as an aggregation expression."""
+    return {"$add": [level_exp_expr(level), current_exp]}
+
+
+def find_level_expr(total_exp) -> dict:
+    """`find_level` as an aggregation expression, exact while the total fits a double's mantissa."""
+    root = {"$sqrt": {"$add": [81, {"$multiply": [1112, {"$max": [total_exp, 0]}]}]}}
+    return {"$toInt": {"$floor": {"$divide": [{"$add": [9, root]}, 278]}}}
+
+
+def _looped_server_exp(level: int, current_exp: int) -> int:
+    # what every caller used to do
+    total = 0
+    for i in range(level):
+        total += required_exp(i)
+    return total + current_exp
+
+
+if __name__ == "__main__":
+    import timeit
+
+    for level in (50, 500, 5000):
+        assert _looped_server_exp(level, 17) == server_exp(level, 17)
+        loop = timeit.timeit(lambda: _looped_server_exp(level, 17), number=2000)
+        closed = timeit.timeit(lambda: server_exp(level, 17), number=2000)
+        print(f"level {level:>5}: loop {loop * 500:.3f} us/call, closed form {closed * 500:.3f} us/call, "
+              f"x{loop / closed:.0f}")
+
+    rng = numpy.random.default_rng(0)
+    levels = rng.integers(0, 1000, 10000)
+    currents = rng.integers(0, 100, 10000)
+    assert list(server_exp_batch(levels, currents)) == [server_exp(int(l), int(c)) for l, c in zip(levels, currents)]
+    assert list(find_level_batch(server_exp_batch(levels, 0))) == list(levels)
+    scalar = timeit.timeit(lambda: [server_exp(int(l), int(c)) for l, c in zip(levels, currents)], number=10)
+    batch = timeit.timeit(lambda: server_exp_batch(levels, currents), number=10)
+    looped = timeit.timeit(lambda: [_looped_server_exp(int(l), int(c)) for l, c in zip(levels, currents)], number=1)
+    print(f"10k users: loop {looped * 1000:.1f} ms, closed form {scalar * 100:.1f} ms, numpy {batch * 100:.2f} ms")
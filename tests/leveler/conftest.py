@@ -0,0 +1,10 @@
+import sys
+import types
+from pathlib import Path
+
+# the cog's __init__ needs Red and discord.py; the storage, query and exp modules don't,
+# so the package is registered without running it
+if "leveler" not in sys.modules:
+    package = types.ModuleType("leveler")
+    package.__path__ = [str(Path(__file__).resolve().parents[2] / "leveler")]
+    sys.modules["leveler"] = package
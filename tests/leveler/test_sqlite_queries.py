@@ -0,0 +1,210 @@
+"""The cog's own queries, run against the SQLite storage backend."""
+import asyncio
+
+import pytest
+
+pytest.importorskip("pymongo")
+pytest.importorskip("numpy")
+
+from pymongo import ReturnDocument, UpdateOne  # noqa: E402
+
+from leveler import indexes, queries, storage, xp  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    backend = storage.SQLiteBackend(tmp_path / "leveler.db")
+    asyncio.run(backend.connect())
+    asyncio.run(indexes.ensure_indexes(backend.db, backend.name))
+    yield backend.db
+    backend.close()
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def _members(db, server_id="1"):
+    return {entry["user_id"]: entry async for entry in db.members.find({"server_id": server_id})}
+
+
+def _assert_levelled(entry):
+    assert entry["level"] == xp.find_level(entry["exp"])
+    assert entry["current_exp"] == entry["exp"] - xp.level_exp(entry["level"])
+
+
+def test_award_returns_the_entry_before_and_levels_up(db):
+    async def scenario():
+        await db.members.insert_one({"server_id": "1", "user_id": "10", "level": 0, "current_exp": 0, "exp": 0})
+        befores = []
+        for exp in (150, 150, 2000):
+            befores.append(
+                await db.members.find_one_and_update(
+                    {"server_id": "1", "user_id": "10"},
+                    queries.award_pipeline(exp, "Someone"),
+                    projection={"_id": 0, "level": 1, "exp": 1},
+                )
+            )
+        return befores, await db.members.find_one({"server_id": "1", "user_id": "10"})
+
+    befores, entry = run(scenario())
+    assert befores == [{"level": 0, "exp": 0}, {"level": 1, "exp": 150}, {"level": 2, "exp": 300}]
+    assert entry["exp"] == 2300
+    assert entry["username"] == "Someone"
+    assert entry["member"] is True
+    _assert_levelled(entry)
+
+
+def test_award_without_an_entry_matches_nothing(db):
+    before = run(
+        db.members.find_one_and_update({"server_id": "1", "user_id": "10"}, queries.award_pipeline(50, "Someone"))
+    )
+    assert before is None
+    assert run(db.members.count_documents({})) == 0
+
+
+def test_user_setup_only_fills_new_documents(db):
+    account = {"total_exp": 0, "rep": 0, "badges": {}}
+
+    async def scenario():
+        first = await db.users.find_one_and_update(
+            {"user_id": "10"},
+            queries.user_setup("Old name", account),
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        await db.users.update_one({"user_id": "10"}, {"$inc": {"total_exp": 40, "rep": 2}})
+        second = await db.users.find_one_and_update(
+            {"user_id": "10"},
+            queries.user_setup("New name", account),
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return first, second, await db.users.count_documents({})
+
+    first, second, count = run(scenario())
+    assert (first["username"], first["total_exp"], first["badges"]) == ("Old name", 0, {})
+    assert (second["username"], second["total_exp"], second["rep"]) == ("New name", 40, 2)
+    assert count == 1
+
+
+def test_member_setup_keeps_exp_and_marks_presence(db):
+    async def scenario():
+        filter = {"server_id": "1", "user_id": "10"}
+        await db.members.update_one(filter, queries.member_setup("Someone"), upsert=True)
+        await db.members.update_one(filter, queries.award_pipeline(500, "Someone"))
+        await db.members.update_one(filter, {"$set": {"member": False}})
+        await db.members.update_one(filter, queries.member_setup("Renamed"), upsert=True)
+        return await db.members.find_one(filter)
+
+    entry = run(scenario())
+    assert (entry["exp"], entry["username"], entry["member"]) == (500, "Renamed", True)
+    _assert_levelled(entry)
+
+
+def test_count_rank_shares_ties_and_filters_departed_members(db):
+    async def scenario():
+        for user_id, exp, member in (("1", 500, True), ("2", 300, True), ("3", 300, True), ("4", 900, False)):
+            await db.members.insert_one({"server_id": "1", "user_id": user_id, "exp": exp, "member": member})
+        await db.members.insert_one({"server_id": "2", "user_id": "5", "exp": 10000, "member": True})
+        query = queries.member_filter(1)
+        return [await queries.count_rank(db.members, query, "exp", exp) for exp in (500, 300, 100)]
+
+    assert run(scenario()) == [1, 2, 4]
+
+
+def test_server_rep_pipeline_joins_rep_of_present_members(db):
+    async def scenario():
+        for user_id, rep in (("1", 3), ("2", 5), ("3", 0), ("4", 9), ("5", 5)):
+            await db.users.insert_one({"user_id": user_id, "rep": rep})
+        for user_id, member in (("1", True), ("2", True), ("3", True), ("4", False), ("5", True)):
+            await db.members.insert_one(
+                {"server_id": "1", "user_id": user_id, "username": f"u{user_id}", "member": member}
+            )
+        pipeline = queries.server_rep_pipeline(1)
+        board = await db.members.aggregate(pipeline + [{"$sort": {"rep": -1}}]).to_list(length=None)
+        higher = await db.members.aggregate(pipeline + [{"$match": {"rep": {"$gt": 3}}}, {"$count": "n"}]).to_list(
+            length=1
+        )
+        return board, higher
+
+    board, higher = run(scenario())
+    assert [(entry["user_id"], entry["rep"]) for entry in board] == [("2", 5), ("5", 5), ("1", 3)]
+    assert board[0] == {"user_id": "2", "username": "u2", "rep": 5}
+    assert higher == [{"n": 2}]
+
+
+def test_rep_claim_only_succeeds_once_per_cooldown(db):
+    now = 1_000_000.0
+
+    async def claim(user_id, at):
+        return await db.users.find_one_and_update(*queries.rep_claim(user_id, at), projection={"_id": 1})
+
+    async def scenario():
+        await db.users.insert_one({"user_id": "1", "rep_block": 0})
+        await db.users.insert_one({"user_id": "2", "rep_block": ""})
+        await db.users.insert_one({"user_id": "3"})
+        results = [await claim("1", now), await claim("1", now + 60), await claim("1", now + queries.REP_COOLDOWN)]
+        results += [await claim("2", now), await claim("3", now)]
+        return results, await db.users.find_one({"user_id": "1"})
+
+    results, userinfo = run(scenario())
+    assert [result is not None for result in results] == [True, False, True, True, True]
+    assert userinfo["rep_block"] == now + queries.REP_COOLDOWN
+
+
+def test_badge_updates_reach_only_holders(db):
+    badge = {"badge_name": "Cool Badge", "bg_img": "old.png", "price": 5, "priority_num": 0}
+    name = "Cool Badge_1"
+
+    async def scenario():
+        await db.users.insert_one({"user_id": "1", "badges": {name: {**badge, "priority_num": 3}, "Other_1": {"x": 1}}})
+        await db.users.insert_one({"user_id": "2", "badges": {name: dict(badge)}})
+        await db.users.insert_one({"user_id": "3", "badges": {"Other_1": {"x": 1}}})
+        holders = await db.users.count_documents(queries.badge_holders(name))
+        updated = await db.users.update_many(
+            queries.badge_holders(name), queries.badge_update(name, {**badge, "bg_img": "new.png", "price": 7})
+        )
+        after_update = {user["user_id"]: user["badges"] async for user in db.users.find({})}
+        removed = await db.users.update_many(queries.badge_holders(name), queries.badge_removal(name))
+        after_removal = {user["user_id"]: user["badges"] async for user in db.users.find({})}
+        return holders, updated, after_update, removed, after_removal
+
+    holders, updated, after_update, removed, after_removal = run(scenario())
+    assert holders == 2
+    assert updated.modified_count == 2
+    assert after_update["1"][name] == {**badge, "bg_img": "new.png", "price": 7, "priority_num": 3}
+    assert after_update["2"][name]["bg_img"] == "new.png"
+    assert "Cool Badge_1" not in after_update["3"]
+    assert removed.modified_count == 2
+    assert after_removal == {"1": {"Other_1": {"x": 1}}, "2": {}, "3": {"Other_1": {"x": 1}}}
+
+
+def test_migration_replaces_mirrors_and_keeps_exp_earned_since(db):
+    old_exp = xp.server_exp(4, 120)
+
+    def migrate(user_id, present=True):
+        return UpdateOne(
+            {"server_id": "1", "user_id": user_id},
+            queries.migration_pipeline(old_exp, f"u{user_id}", present),
+            upsert=True,
+        )
+
+    async def scenario():
+        # "1" is an entry the old leaderboard kept, out of step here; "2" has no entry yet
+        await db.members.insert_one({"server_id": "1", "user_id": "1", "exp": 7, "username": "kept", "member": False})
+        await db.members.bulk_write([migrate("1"), migrate("2", present=False)], ordered=False)
+        first = await _members(db)
+        await db.members.update_one({"server_id": "1", "user_id": "2"}, queries.award_pipeline(1000, "u2"))
+        # an interrupted run is repeated
+        await db.members.bulk_write([migrate("1"), migrate("2")], ordered=False)
+        return first, await _members(db)
+
+    first, second = run(scenario())
+    assert (first["1"]["exp"], first["1"]["username"], first["1"]["member"]) == (old_exp, "kept", False)
+    assert (first["2"]["exp"], first["2"]["username"], first["2"]["member"]) == (old_exp, "u2", False)
+    assert second["1"]["exp"] == old_exp
+    assert second["2"]["exp"] == old_exp + 1000
+    for entry in (*first.values(), *second.values()):
+        assert entry["legacy_exp"] == old_exp
+        _assert_levelled(entry)